@@ -4,12 +4,47 @@
 
 import os
 import argparse
+import contextlib
+import gzip
+import itertools
 import json
+import re
+import shutil
 import sys
+from typing import Iterable, Iterator, Optional
 import requests
-from osgeo import ogr
+from osgeo import gdal, ogr, osr
 
-ENV_BETYDB_URL_NAME = 'BETYDB_URL'
+import betydb_client
+import plot_footprints
+import plot_geometry_store
+import plot_store_sync
+
+ENV_BETYDB_URL_NAME = betydb_client.ENV_BETYDB_URL_NAME
+
+# The number of characters collected before writing them to the output file
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# The ASCII Record Separator that starts each GeoJSON text sequence record (RFC 8142)
+GEOJSONSEQ_RECORD_SEPARATOR = '\x1e'
+
+# The encoder used for writing features; its output matches json.dumps()
+FEATURE_ENCODER = json.JSONEncoder()
+FEATURE_TEMPLATE = '{"type": "Feature", "properties": {"id": %s, "observationUnitName": %s}, "geometry": %s}'
+FEATURE_BBOX_TEMPLATE = '{"type": "Feature", "bbox": %s, "properties": {"id": %s, "observationUnitName": %s}, ' \
+                        '"geometry": %s}'
+
+# The number of geometries converted together
+CONVERSION_BATCH_SIZE = 1000
+
+# Matches the start of the WKT geometry types converted without using OGR
+WKT_POLYGONAL_RE = re.compile(r'\s*(?:SRID=\d+;)?\s*(POLYGON|MULTIPOLYGON)\s*Z?\s*(?=\()', re.IGNORECASE)
+WKT_POLYGON_SEPARATOR_RE = re.compile(r'\)\s*\)\s*,\s*\(\s*\(')
+WKT_RING_SEPARATOR_RE = re.compile(r'\)\s*,\s*\(')
+
+# Command line arguments that don't change the generated GeoJSON, and aren't part of its cache key
+NON_CONVERSION_ARGS = ('betydb_url', 'outfile', 'stream', 'page_size', 'page_workers', 'page_retries', 'cache_dir',
+                       'max_cache_age', 'plot_store', 'full_sync')
 
 
 def get_arguments() -> argparse.Namespace:
@@ -17,6 +52,24 @@ def get_arguments() -> argparse.Namespace:
     Return:
         Returns the parsed arguments
     """
+    def bounds_type(bounds: str) -> tuple:
+        """Checks that the bounds are a comma separated list of four numbers
+        Parameters:
+            bounds: the bounds to check
+        Return:
+            Returns a tuple of the minimum X, minimum Y, maximum X, and maximum Y values
+        Exceptions:
+            Raises a argparse.ArgumentTypeError if the bounds are not valid
+        """
+        try:
+            values = tuple(float(one_value) for one_value in bounds.split(','))
+        except ValueError:
+            values = ()
+        if len(values) != 4 or values[0] > values[2] or values[1] > values[3]:
+            raise argparse.ArgumentTypeError('Bounds %s are not valid min_lon,min_lat,max_lon,max_lat values' %
+                                             str(bounds))
+        return values
+
     parser = argparse.ArgumentParser(description="BETYdb plots to GeoJSON",
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-u', '--betydb_url',
@@ -25,14 +78,71 @@ def get_arguments() -> argparse.Namespace:
     parser.add_argument('-f', '--filter', nargs='*',
                         help='partial or full string filter for sitename values returned', metavar='str',
                         type=str, default='')
-    parser.add_argument('-o', '--outfile', help='the output file to write GeoJSON to', metavar='FILE',
-                        type=argparse.FileType('wt'),
+    parser.add_argument('-o', '--outfile', help='the output file to write GeoJSON to; compressed when the name ends ' +
+                        'with .gz, and standard output when "-"', metavar='FILE',
+                        type=str,
                         default='out.txt')
+    parser.add_argument('--format', choices=['geojson', 'geojsonseq', 'plotstore'], default='geojson',
+                        help='write a GeoJSON FeatureCollection, a GeoJSON text sequence of features (RFC 8142), ' +
+                        'or an indexed binary plot geometry store (see plot_geometry_store.py)')
+    parser.add_argument('--stream', action='store_true',
+                        help='parse the BETYdb response incrementally and write plots as they are found to keep ' +
+                        'memory use constant')
+    parser.add_argument('--page_size', type=int, default=0, metavar='int',
+                        help='fetch experiments in pages of this many and convert them as each page arrives ' +
+                        '(0 fetches everything in one request)')
+    parser.add_argument('--page_workers', type=int, default=4, metavar='int',
+                        help='the maximum number of pages to fetch concurrently')
+    parser.add_argument('--page_retries', type=int, default=3, metavar='int',
+                        help='the number of times to retry fetching a page before giving up')
+    parser.add_argument('--cache_dir', metavar='DIR', type=str,
+                        help='folder for caching BETYdb responses and the generated GeoJSON between runs')
+    parser.add_argument('--max_cache_age', type=int, default=24 * 60 * 60, metavar='seconds',
+                        help='how long a cached BETYdb response is used before checking with BETYdb for changes')
+    parser.add_argument('--bounds', type=bounds_type, metavar='min_lon,min_lat,max_lon,max_lat',
+                        help='only write plots that intersect these WGS84 bounds')
+    parser.add_argument('--clip_to_raster', action='append', metavar='FILE',
+                        help='only write plots that intersect the footprint of this georeferenced image; may be ' +
+                        'specified more than once')
+    parser.add_argument('--target_crs', metavar='CRS', type=str,
+                        help='reproject the plots to this coordinate system (for example EPSG:32612) and record it ' +
+                        'in the GeoJSON')
+    parser.add_argument('--match_raster', metavar='FILE', type=str,
+                        help='reproject the plots to the coordinate system of this georeferenced image and record it ' +
+                        'in the GeoJSON')
+    parser.add_argument('--precision', type=int, metavar='digits',
+                        help='round coordinates to this many decimal places')
+    parser.add_argument('--simplify', type=float, metavar='tolerance',
+                        help='remove vertices that are closer than this distance to the simplified outline, ' +
+                        'without changing the topology of the plot')
+    parser.add_argument('--bbox', action='store_true',
+                        help='add the bounding box of each plot, and of all plots, to the GeoJSON')
+    parser.add_argument('--plot_store', metavar='FILE', type=str,
+                        help='SQLite file for keeping a local copy of the sites; only the changes since the last ' +
+                        'run are requested from BETYdb and the GeoJSON is generated from the local copy')
+    parser.add_argument('--full_sync', action='store_true',
+                        help='replace the contents of the --plot_store file with all sites from BETYdb')
 
     args = parser.parse_args()
 
     if not args.betydb_url:
         parser.error('--betydb_url is required')
+    if args.page_size < 0 or args.page_workers < 1 or args.page_retries < 0:
+        parser.error('--page_size and --page_retries can not be negative, and --page_workers must be at least 1')
+    if args.cache_dir and args.page_size:
+        parser.error('--cache_dir can not be used with --page_size')
+    if args.precision is not None and args.precision < 0:
+        parser.error('--precision can not be negative')
+    if args.simplify is not None and args.simplify <= 0:
+        parser.error('--simplify must be greater than zero')
+    if args.target_crs and args.match_raster:
+        parser.error('only one of --target_crs and --match_raster can be specified')
+    if (args.target_crs or args.match_raster) and args.format == 'geojsonseq':
+        parser.error('GeoJSON text sequences are always in WGS84 and can not be reprojected')
+    if args.plot_store and (args.cache_dir or args.page_size):
+        parser.error('--plot_store can not be used with --cache_dir or --page_size')
+    if args.format == 'plotstore' and args.outfile.lower().endswith('.gz'):
+        parser.error('plot geometry stores are memory mapped by readers and can not be compressed')
 
     return args
 
@@ -50,15 +160,8 @@ def query_betydb_experiments(betydb_url: str = None) -> dict:
         If either of the parameters are None or not defined (evaluates to False), the environment is queried for that value.
         It's an error to not have the url or key parameters undefined and not have environment variable equivalents defined
     """
-    # Fill in missing values if we can
-    if not betydb_url:
-        betydb_url = os.getenv(ENV_BETYDB_URL_NAME, None)
-    if not betydb_url:
-        raise RuntimeError("Unable to resolve BETYdb URL. Please ensure it's defined and try again.")
-
     # Make the call to get the experiment data
-    url = betydb_url.rstrip('/') + '/api/v1/experiments'
-    params = {'associations_mode': 'full_info', 'limit': 'none'}
+    url, params = betydb_client.get_experiments_query(betydb_url)
 
     req = requests.get(url, params=params, timeout=300)
     req.raise_for_status()
@@ -76,22 +179,45 @@ def get_experiment_site_geometries(experiments_json: dict, site_filter: str = No
         Raises RuntimeError if an expected key is not found in the passed in JSON
         Other exceptions can be raised by misconfigured JSON
     """
-    plots = {}
-
     # Try loading the JSON
     if 'data' not in experiments_json:
         raise RuntimeError('Missing top-level "data" key from JSON: "%s"' % str(experiments_json))
 
-    # Find all the sites in all the returned experiments
-    for one_exp in experiments_json['data']:
+    return dict(iter_experiment_site_geometries(experiments_json['data'], site_filter))
+
+
+def iter_experiment_site_geometries(experiments: Iterable[dict], site_filter: str = None) -> Iterator[tuple]:
+    """Returns each of the found sites with its geometry as Well Known Text (WKT)
+    Arguments:
+        experiments: the experiments retrieved from BETYdb (the entries of the "data" array)
+        site_filter: optional filter string to apply on sitenames
+    Return:
+        Returns a tuple of the site name (plot name) and its geometry for each site found
+    Notes:
+        A site that belongs to more than one experiment is returned once for each experiment
+    """
+    # Find all the sites in all the experiments
+    for one_exp in experiments:
         if 'experiment' in one_exp and 'sites' in one_exp['experiment']:
             for one_site in one_exp['experiment']['sites']:
                 if 'site' in one_site and 'geometry' in one_site['site'] and 'sitename' in one_site['site']:
                     # Check if there's a filter
                     if not site_filter or site_filter in one_site['site']['sitename']:
-                        plots[one_site['site']['sitename']] = one_site['site']['geometry']
+                        yield one_site['site']['sitename'], one_site['site']['geometry']
+
 
-    return plots
+def _unique_sites(sites: Iterable[tuple]) -> Iterator[tuple]:
+    """Returns only the first occurrence of each site name
+    Arguments:
+        sites: the tuples of site names and geometries
+    Return:
+        Returns the tuples of site names that have not been seen before
+    """
+    seen = set()
+    for site_name, geometry in sites:
+        if site_name not in seen:
+            seen.add(site_name)
+            yield site_name, geometry
 
 
 def sites_to_geojson(sites: dict) -> dict:
@@ -103,47 +229,557 @@ def sites_to_geojson(sites: dict) -> dict:
     Exceptions:
         Exceptions may be raised from OGR and OSR library calls
     """
-    plots_geo = {}
+    return dict(iter_sites_to_geojson(sites.items()))
 
+
+def iter_sites_to_geojson(sites: Iterable[tuple]) -> Iterator[tuple]:
+    """Converts each site geometry to GeoJSON format
+    Arguments:
+        sites: tuples of site names with their geometries in WKT (Well Known Text) format
+    Return:
+        Returns a tuple of the site name and its geometry converted into GeoJSON format as a dict
+    Exceptions:
+        Exceptions may be raised from OGR and OSR library calls
+    """
     # Loop through converting the geometry format. We leave off CRS information since it's in WGS 84 lat-lon format
     # (which is the assumed CRS of GeoJSON)
-    for site_name in sites:
-        geom = ogr.CreateGeometryFromWkt(sites[site_name])
-        plots_geo[site_name] = json.loads(geom.ExportToJson())
+    sites = iter(sites)
+    batch = list(itertools.islice(sites, CONVERSION_BATCH_SIZE))
+    while batch:
+        site_names, wkts = zip(*batch)
+        yield from zip(site_names, wkt_to_geojson_batch(wkts))
+        batch = list(itertools.islice(sites, CONVERSION_BATCH_SIZE))
+
+
+def _parse_wkt_rings(rings_text: str) -> list:
+    """Parses the linear rings of a WKT polygon
+    Arguments:
+        rings_text: the text of the polygon's rings
+    Return:
+        Returns the list of rings, each a list of coordinates
+    Exceptions:
+        ValueError is raised if the text isn't a list of rings of 2D or 3D coordinates
+    """
+    rings = []
+    for one_ring in WKT_RING_SEPARATOR_RE.split(rings_text.strip(' \t\r\n()')):
+        coordinates = [list(map(float, one_point.split())) for one_point in one_ring.split(',')]
+        for one_coordinate in coordinates:
+            if not 2 <= len(one_coordinate) <= 3:
+                raise ValueError('Unexpected coordinate dimension in WKT')
+        rings.append(coordinates)
+    return rings
+
+
+def _parse_polygonal_body(geometry_type: str, body: str) -> tuple:
+    """Parses the coordinates of WKT polygons and multipolygons
+    Arguments:
+        geometry_type: the upper case WKT type, POLYGON or MULTIPOLYGON
+        body: the WKT following the type
+    Return:
+        Returns a tuple of the GeoJSON geometry as a dict, and the number of opening parenthesis the body has when
+        it's nested correctly
+    Exceptions:
+        ValueError is raised if the coordinates can't be parsed
+    """
+    if geometry_type == 'POLYGON':
+        rings = _parse_wkt_rings(body)
+        # One set of parenthesis for the polygon and one for each ring
+        return {'type': 'Polygon', 'coordinates': rings}, len(rings) + 1
+
+    polygons = [_parse_wkt_rings(one_polygon) for one_polygon in
+                WKT_POLYGON_SEPARATOR_RE.split(body.strip(' \t\r\n()'))]
+    return ({'type': 'MultiPolygon', 'coordinates': polygons},
+            sum(len(one_polygon) for one_polygon in polygons) + len(polygons) + 1)
+
+
+def parse_polygonal_wkt(wkt: str) -> Optional[dict]:
+    """Converts POLYGON and MULTIPOLYGON WKT (Well Known Text) geometries to GeoJSON without using OGR
+    Arguments:
+        wkt: the geometry to convert
+    Return:
+        Returns the GeoJSON geometry as a dict, or None if the WKT isn't a 2D or 3D polygon or multipolygon or
+        can't be parsed
+    """
+    match = WKT_POLYGONAL_RE.match(wkt)
+    body = wkt[match.end():].rstrip() if match else ''
+    num_parens = body.count('(')
+    if body.endswith(')') and num_parens == body.count(')'):
+        try:
+            geometry, expected_parens = _parse_polygonal_body(match.group(1).upper(), body)
+            # Make sure the nesting was correct
+            if num_parens == expected_parens:
+                return geometry
+        except ValueError:
+            pass
+    return None
+
+
+def wkt_to_geojson_batch(wkts: Iterable[str]) -> list:
+    """Converts a batch of WKT (Well Known Text) geometries to GeoJSON
+    Arguments:
+        wkts: the geometries to convert
+    Return:
+        Returns the list of GeoJSON geometries as dicts in the same order as the WKT
+    Exceptions:
+        Exceptions may be raised from OGR library calls
+    Notes:
+        Polygons and multipolygons, the geometries BETYdb uses, are parsed directly and keep the full precision of
+        their coordinates. OGR is used to convert everything else
+    """
+    geometries = [parse_polygonal_wkt(one_wkt) for one_wkt in wkts]
+    for idx, one_wkt in enumerate(wkts):
+        if geometries[idx] is None:
+            geometries[idx] = json.loads(ogr.CreateGeometryFromWkt(one_wkt).ExportToJson())
+    return geometries
+
+
+def get_geometry_bbox(geometry: dict) -> list:
+    """Returns the GeoJSON bbox of a geometry, which covers all the dimensions of its coordinates
+    Arguments:
+        geometry: the GeoJSON geometry
+    Return:
+        Returns the list of the minimum values of each dimension followed by the maximum values
+    """
+    points = plot_footprints.get_geometry_points(geometry)
+    num_dims = min(len(one_point) for one_point in points)
+    dim_values = [[one_point[idx] for one_point in points] for idx in range(num_dims)]
+    return [min(one_dim) for one_dim in dim_values] + [max(one_dim) for one_dim in dim_values]
+
+
+def _merge_bbox(first: Optional[list], second: list) -> list:
+    """Returns the GeoJSON bbox covering both bboxes
+    Arguments:
+        first: the first bbox, or None
+        second: the second bbox
+    Return:
+        Returns the merged bbox; it only has the dimensions that both bboxes have
+    """
+    if first is None:
+        return list(second)
+    num_dims = min(len(first), len(second)) // 2
+    return [min(first[idx], second[idx]) for idx in range(num_dims)] + \
+           [max(first[len(first) // 2 + idx], second[len(second) // 2 + idx]) for idx in range(num_dims)]
+
+
+def _round_coordinates(coordinates: list, precision: int, is_ring_list: bool) -> list:
+    """Rounds GeoJSON coordinates, dropping repeated points from polygon rings
+    Arguments:
+        coordinates: the coordinates to round
+        precision: the number of decimal places to keep
+        is_ring_list: set to True when the coordinates are a polygon's list of rings
+    Return:
+        Returns the rounded coordinates
+    """
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        return [round(one_value, precision) for one_value in coordinates]
+    if not is_ring_list:
+        return [_round_coordinates(one_list, precision, False) for one_list in coordinates]
+
+    rings = []
+    for one_ring in coordinates:
+        rounded = [[round(one_value, precision) for one_value in one_point] for one_point in one_ring]
+        # Points that became the same are removed, as long as the ring keeps enough points
+        deduplicated = [one_point for idx, one_point in enumerate(rounded) if idx == 0 or one_point != rounded[idx - 1]]
+        rings.append(deduplicated if len(deduplicated) >= 4 else rounded)
+    return rings
+
+
+def round_geometry(geometry: dict, precision: int) -> dict:
+    """Rounds the coordinates of a GeoJSON geometry
+    Arguments:
+        geometry: the GeoJSON geometry
+        precision: the number of decimal places to keep
+    Return:
+        Returns the geometry with rounded coordinates. The geometry parameter is not altered
+    """
+    if geometry['type'] == 'GeometryCollection':
+        return {'type': geometry['type'],
+                'geometries': [round_geometry(one_geom, precision) for one_geom in geometry['geometries']]}
+    if geometry['type'] == 'MultiPolygon':
+        coordinates = [_round_coordinates(one_polygon, precision, True) for one_polygon in geometry['coordinates']]
+    else:
+        coordinates = _round_coordinates(geometry['coordinates'], precision, geometry['type'] == 'Polygon')
+    return {'type': geometry['type'], 'coordinates': coordinates}
+
+
+def iter_reduced_plots(geojson_plots: Iterable[tuple], precision: int = None, tolerance: float = None,
+                       stats: dict = None) -> Iterator[tuple]:
+    """Simplifies and rounds the coordinates of each plot
+    Arguments:
+        geojson_plots: tuples of plot names and their associated GeoJSON geometry
+        precision: optional number of decimal places to keep
+        tolerance: optional simplification tolerance, in the units of the coordinates
+        stats: optional dict that is updated with the number of vertices and the size of the geometry text before
+               and after ("vertices_before", "vertices_after", "size_before", and "size_after" keys)
+    Return:
+        Returns a tuple of the plot name and its reduced geometry for each plot
+    Exceptions:
+        Exceptions may be raised from OGR library calls
+    Notes:
+        Simplification uses OGR's topology preserving simplification so that plots remain valid polygons
+    """
+    for plot_name, geometry in geojson_plots:
+        if stats is not None:
+            stats['vertices_before'] = (stats.get('vertices_before', 0) +
+                                        len(plot_footprints.get_geometry_points(geometry)))
+            stats['size_before'] = stats.get('size_before', 0) + len(FEATURE_ENCODER.encode(geometry))
+
+        if tolerance:
+            simplified = ogr.CreateGeometryFromJson(json.dumps(geometry)).SimplifyPreserveTopology(tolerance)
+            geometry = json.loads(simplified.ExportToJson())
+        if precision is not None:
+            geometry = round_geometry(geometry, precision)
+
+        if stats is not None:
+            stats['vertices_after'] = (stats.get('vertices_after', 0) +
+                                       len(plot_footprints.get_geometry_points(geometry)))
+            stats['size_after'] = stats.get('size_after', 0) + len(FEATURE_ENCODER.encode(geometry))
+        yield plot_name, geometry
+
 
-    return plots_geo
+def _set_geometry_points(geometry: dict, points: Iterator) -> dict:
+    """Returns a copy of a GeoJSON geometry with its points replaced
+    Arguments:
+        geometry: the GeoJSON geometry
+        points: the new points, in the order they're returned by plot_footprints.get_geometry_points()
+    Return:
+        Returns the new geometry. The geometry parameter is not altered
+    """
+    def replace(coordinates: list) -> list:
+        """Replaces the points of the coordinates"""
+        if coordinates and isinstance(coordinates[0], (int, float)):
+            return next(points)
+        return [replace(one_list) for one_list in coordinates]
+
+    if geometry['type'] == 'GeometryCollection':
+        return {'type': geometry['type'],
+                'geometries': [_set_geometry_points(one_geom, points) for one_geom in geometry['geometries']]}
+    return {'type': geometry['type'], 'coordinates': replace(geometry['coordinates'])}
+
+
+def get_target_srs(target_crs: str = None, match_raster: str = None) -> Optional[osr.SpatialReference]:
+    """Returns the coordinate system to reproject the plots to
+    Arguments:
+        target_crs: optional coordinate system definition, such as "EPSG:32612"
+        match_raster: optional georeferenced image to use the coordinate system of
+    Return:
+        Returns the coordinate system, or None if neither parameter is specified
+    Exceptions:
+        A RuntimeError is raised if the coordinate system can't be determined
+    """
+    if not target_crs and not match_raster:
+        return None
+
+    target_srs = osr.SpatialReference()
+    if target_crs:
+        if target_srs.SetFromUserInput(target_crs) != 0:
+            raise RuntimeError('Unable to understand the coordinate system "%s"' % target_crs)
+    else:
+        raster = gdal.Open(match_raster)
+        if raster is None:
+            raise RuntimeError('Unable to open image "%s" to get its coordinate system' % match_raster)
+        if not raster.GetProjection():
+            raise RuntimeError('Image "%s" is not georeferenced' % match_raster)
+        target_srs.ImportFromWkt(raster.GetProjection())
+    target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return target_srs
+
+
+def get_crs_name(srs: osr.SpatialReference) -> str:
+    """Returns the OGC URN of a coordinate system for recording in GeoJSON
+    Arguments:
+        srs: the coordinate system
+    Return:
+        Returns the URN of the coordinate system's EPSG code
+    Exceptions:
+        A RuntimeError is raised if the coordinate system doesn't have an EPSG code
+    """
+    srs = srs.Clone()
+    if srs.GetAuthorityName(None) != 'EPSG':
+        srs.AutoIdentifyEPSG()
+    if srs.GetAuthorityName(None) != 'EPSG' or not srs.GetAuthorityCode(None):
+        raise RuntimeError('Unable to find the EPSG code of the coordinate system to record it in the GeoJSON')
+    return 'urn:ogc:def:crs:EPSG::' + srs.GetAuthorityCode(None)
+
+
+def iter_reprojected_plots(geojson_plots: Iterable[tuple], transform: osr.CoordinateTransformation,
+                           batch_size: int = CONVERSION_BATCH_SIZE) -> Iterator[tuple]:
+    """Reprojects the plot geometries, transforming the points of many plots at a time
+    Arguments:
+        geojson_plots: tuples of plot names and their associated GeoJSON geometry
+        transform: the coordinate transformation to apply
+        batch_size: the number of plots to transform together
+    Return:
+        Returns a tuple of the plot name and its reprojected geometry for each plot
+    Exceptions:
+        A RuntimeError is raised if a different number of points is returned than was transformed.
+        Exceptions may be raised from OSR library calls
+    """
+    geojson_plots = iter(geojson_plots)
+    batch = list(itertools.islice(geojson_plots, batch_size))
+    while batch:
+        all_points = [plot_footprints.get_geometry_points(one_geometry) for _, one_geometry in batch]
+        flat_points = [one_point for points in all_points for one_point in points]
+        transformed = transform.TransformPoints(flat_points)
+        if len(transformed) != len(flat_points):
+            raise RuntimeError('Transformed %d points when reprojecting %d points' %
+                               (len(transformed), len(flat_points)))
+
+        # Each plot's points are the next slice of the transformed points
+        idx = 0
+        for (plot_name, geometry), points in zip(batch, all_points):
+            new_points = [list(new_point[:len(one_point)])
+                          for new_point, one_point in zip(transformed[idx:idx + len(points)], points)]
+            idx += len(points)
+            yield plot_name, _set_geometry_points(geometry, iter(new_points))
+        batch = list(itertools.islice(geojson_plots, batch_size))
+
+
+def _plot_items(geojson_plots) -> Iterable[tuple]:
+    """Returns the plots as (plot name, geometry) tuples
+    Arguments:
+        geojson_plots: a dictionary of plot names and their associated geometry, or an iterable of
+                       (plot name, geometry) tuples
+    Return:
+        Returns the iterable of plot name and geometry tuples
+    """
+    return geojson_plots.items() if isinstance(geojson_plots, dict) else geojson_plots
+
+
+class _BufferedWriter:
+    """Collects text and writes it to a file in large pieces"""
 
+    def __init__(self, out_file, buffer_size: int = WRITE_BUFFER_SIZE):
+        """Initializes the writer
+        Arguments:
+            out_file: where to write the text to (supports .write() as a file-like object)
+            buffer_size: the number of characters to collect before writing them
+        """
+        self._out_file = out_file
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
 
-def write_geojson(out_file, geojson_plots: dict) -> None:
+    def write(self, text: str) -> None:
+        """Adds the text to the buffer, writing the buffer if it's full
+        Arguments:
+            text: the text to write
+        """
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= self._buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes any buffered text to the file"""
+        if self._buffer:
+            self._out_file.write(''.join(self._buffer))
+            self._buffer.clear()
+            self._buffered = 0
+
+
+def _iter_feature_json(geojson_plots, with_bbox: bool = False) -> Iterator[tuple]:
+    """Returns each plot as GeoJSON Feature text
+    Arguments:
+        geojson_plots: a dictionary of plot names and their associated geometry, or an iterable of
+                       (plot name, geometry) tuples
+        with_bbox: when True the Features include the bbox of their geometry
+    Return:
+        Returns a tuple of the text of each Feature, with the plot's position as its ID, and the Feature's bbox (None
+        when with_bbox is False)
+    """
+    encode = FEATURE_ENCODER.encode
+    for plot_idx, (plot_name, plot_geometry) in enumerate(_plot_items(geojson_plots), 1):
+        if with_bbox:
+            bbox = get_geometry_bbox(plot_geometry)
+            yield FEATURE_BBOX_TEMPLATE % (encode(bbox), encode(str(plot_idx)), encode(plot_name),
+                                           encode(plot_geometry)), bbox
+        else:
+            yield FEATURE_TEMPLATE % (encode(str(plot_idx)), encode(plot_name), encode(plot_geometry)), None
+
+
+def write_geojson(out_file, geojson_plots, with_bbox: bool = False, crs_name: str = None) -> int:
     """Writes out the GeoJSON to the specified output file
     Arguments:
-        out_file: where to write GeoJSON to (supports .write() as a file-like object)
-        geojson_plots: a dictionary of plot names and their associated geometry
+        out_file: where to write the plots to (supports .write() as a file-like object)
+        geojson_plots: a dictionary of plot names and their associated geometry, or an iterable of
+                       (plot name, geometry) tuples
+        with_bbox: when True the bbox of each plot, and of the collection, is written
+        crs_name: optional name of the coordinate system of the plots when they're not in WGS84
+    Return:
+        Returns the number of plots written
     Notes:
-        To reduce the memory footprint of writing the GeoJSON, the plots are written one at a time
+        To reduce the memory footprint of writing the GeoJSON, the plots are written as they're received through a
+        fixed size buffer
     """
     preamble = '{"type": "FeatureCollection","name": "BETYdb Sites","features": ['
+    if crs_name:
+        crs = {'type': 'name', 'properties': {'name': crs_name}}
+        preamble = '{"type": "FeatureCollection","name": "BETYdb Sites","crs": ' + FEATURE_ENCODER.encode(crs) + \
+                   ',"features": ['
     postfix = ']}'
-    entry = {'type': 'Feature',
-             'properties': {
-                 'id': '',
-                 'observationUnitName': ''
-             },
-             'geometry': None
-             }
 
     # Loop through the plots and write them out
+    writer = _BufferedWriter(out_file)
     separator = ''
-    plot_idx = 1
-    out_file.write(preamble)
-    for plot_name in geojson_plots:
-        entry['properties']['id'] = str(plot_idx)
-        entry['properties']['observationUnitName'] = plot_name
-        entry['geometry'] = geojson_plots[plot_name]
-        out_file.write(separator + json.dumps(entry))
+    num_plots = 0
+    collection_bbox = None
+    writer.write(preamble)
+    for feature, bbox in _iter_feature_json(geojson_plots, with_bbox):
+        writer.write(separator)
+        writer.write(feature)
         separator = ','
-        plot_idx += 1
-    out_file.write(postfix)
+        num_plots += 1
+        if bbox:
+            collection_bbox = _merge_bbox(collection_bbox, bbox)
+    if collection_bbox:
+        # The bbox is written after the features so that they can be written as they're received
+        writer.write('],"bbox": ' + FEATURE_ENCODER.encode(collection_bbox) + '}')
+    else:
+        writer.write(postfix)
+    writer.flush()
+
+    return num_plots
+
+
+def write_geojsonseq(out_file, geojson_plots, with_bbox: bool = False) -> int:
+    """Writes out the plots as a GeoJSON text sequence (RFC 8142), one Feature per line
+    Arguments:
+        out_file: where to write the plots to (supports .write() as a file-like object)
+        geojson_plots: a dictionary of plot names and their associated geometry, or an iterable of
+                       (plot name, geometry) tuples
+        with_bbox: when True the bbox of each plot is written
+    Return:
+        Returns the number of plots written
+    """
+    writer = _BufferedWriter(out_file)
+    num_plots = 0
+    for feature, _ in _iter_feature_json(geojson_plots, with_bbox):
+        writer.write(GEOJSONSEQ_RECORD_SEPARATOR)
+        writer.write(feature)
+        writer.write('\n')
+        num_plots += 1
+    writer.flush()
+
+    return num_plots
+
+
+def open_output(file_path: str, binary: bool = False):
+    """Opens the output file for writing, compressing it when the file name ends with .gz
+    Arguments:
+        file_path: the path of the file to open; "-" is standard output
+        binary: set to True to open the file for writing bytes instead of text
+    Return:
+        Returns a context manager of the open file
+    """
+    if file_path == '-':
+        return contextlib.nullcontext(sys.stdout.buffer if binary else sys.stdout)
+    if file_path.lower().endswith('.gz'):
+        return gzip.open(file_path, 'wb' if binary else 'wt', encoding=None if binary else 'utf-8')
+    # pylint: disable=consider-using-with
+    return open(file_path, 'wb') if binary else open(file_path, 'w', encoding='utf-8')
+
+
+def _write_plots(out_file, geojson_plots, args: argparse.Namespace) -> None:
+    """Applies the command line plot options to the plots and writes them out
+    Arguments:
+        out_file: where to write the plots to (supports .write() as a file-like object); opened for bytes when
+                  writing a plot geometry store
+        geojson_plots: a dictionary of plot names and their associated geometry, or an iterable of
+                       (plot name, geometry) tuples
+        args: the command line arguments
+    Exceptions:
+        A RuntimeError is raised if there aren't any plots to write
+    """
+    if args.bounds or args.clip_to_raster:
+        footprints = plot_footprints.get_footprints(args.bounds, args.clip_to_raster)
+        if isinstance(geojson_plots, dict):
+            geojson_plots = plot_footprints.filter_plots_to_footprints(geojson_plots, footprints)
+        else:
+            geojson_plots = plot_footprints.iter_plots_in_footprints(geojson_plots, footprints)
+
+    crs_name = None
+    target_srs = get_target_srs(args.target_crs, args.match_raster)
+    if target_srs:
+        crs_name = get_crs_name(target_srs)
+        transform = osr.CoordinateTransformation(plot_footprints.get_wgs84_srs(), target_srs)
+        geojson_plots = iter_reprojected_plots(_plot_items(geojson_plots), transform)
+
+    stats = None
+    if args.precision is not None or args.simplify:
+        stats = {}
+        geojson_plots = iter_reduced_plots(_plot_items(geojson_plots), args.precision, args.simplify, stats)
+
+    if args.format == 'geojsonseq':
+        num_plots = write_geojsonseq(out_file, geojson_plots, args.bbox)
+    elif args.format == 'plotstore':
+        num_plots = plot_geometry_store.write_plot_store(out_file, _plot_items(geojson_plots), crs_name)
+    else:
+        num_plots = write_geojson(out_file, geojson_plots, args.bbox, crs_name)
+    if not num_plots:
+        if args.bounds or args.clip_to_raster:
+            raise RuntimeError("No plots were found within the requested bounds")
+        raise RuntimeError("No plots were found in the data returned from BETYdb")
+
+    if stats:
+        print('Reduced plot vertices from %d to %d (%.1f%%), and geometry text from %d to %d bytes (%.1f%%)' %
+              (stats['vertices_before'], stats['vertices_after'],
+               100.0 * (1 - stats['vertices_after'] / stats['vertices_before']), stats['size_before'],
+               stats['size_after'], 100.0 * (1 - stats['size_after'] / stats['size_before'])), file=sys.stderr)
+
+
+def _get_raster_versions(args: argparse.Namespace) -> list:
+    """Returns what identifies the contents of the images used by the conversion options, so that the cached
+    GeoJSON isn't used once an image is replaced
+    Arguments:
+        args: the command line arguments
+    Return:
+        Returns the list of the path, size, and modification time of each image; the size and time are None for
+        images that can't be found
+    """
+    versions = []
+    for one_path in (args.clip_to_raster or []) + ([args.match_raster] if args.match_raster else []):
+        try:
+            file_stat = os.stat(one_path)
+            versions.append([one_path, file_stat.st_size, file_stat.st_mtime_ns])
+        except OSError:
+            versions.append([one_path, None, None])
+    return versions
+
+
+def _convert_cached(out_file, args: argparse.Namespace, site_filter: str) -> None:
+    """Writes the GeoJSON using the cache folder, only generating it when the cached BETYdb response has changed
+    Arguments:
+        out_file: where to write the plots to (supports .write() as a file-like object)
+        args: the command line arguments
+        site_filter: optional filter string to apply on sitenames
+    Exceptions:
+        A RuntimeError is raised if there aren't any plots found
+    """
+    url, params = betydb_client.get_experiments_query(args.betydb_url)
+    body_path, cache_info = betydb_client.fetch_cached_response(url, params, args.cache_dir, args.max_cache_age)
+
+    # The GeoJSON depends on the response contents, the conversion options, and the images the options use
+    options = {key: value for key, value in vars(args).items() if key not in NON_CONVERSION_ARGS}
+    binary = args.format == 'plotstore'
+    geojson_path = os.path.join(args.cache_dir,
+                                betydb_client.get_cache_key(cache_info['digest'], options, _get_raster_versions(args)) +
+                                ('.pgs' if binary else '.geojson'))
+
+    if not os.path.exists(geojson_path):
+        def write_plots(out_file) -> None:
+            """Generates the GeoJSON from the cached response"""
+            experiments = betydb_client.iter_json_array_items(betydb_client.iter_file_chunks(body_path), 'data')
+            sites = _unique_sites(iter_experiment_site_geometries(experiments, site_filter))
+            _write_plots(out_file, iter_sites_to_geojson(sites), args)
+
+        betydb_client.write_cache_file(args.cache_dir, os.path.basename(geojson_path), write_plots,
+                                       'wb' if binary else 'wt')
+
+    # pylint: disable=consider-using-with
+    with (open(geojson_path, 'rb') if binary else open(geojson_path, 'r', encoding='utf-8')) as in_file:
+        shutil.copyfileobj(in_file, out_file, WRITE_BUFFER_SIZE)
 
 
 def convert() -> None:
@@ -161,16 +797,43 @@ def convert() -> None:
     site_filter = args.filter
     if site_filter:
         site_filter = ' '.join(site_filter)
-    experiments_json = query_betydb_experiments(args.betydb_url)
-    sites = get_experiment_site_geometries(experiments_json, site_filter)
-    if not sites:
-        raise RuntimeError("No plots were found in the data returned from BETYdb")
 
-    # Format each of the plots to their GeoJSON equivalents
-    geojson_plots = sites_to_geojson(sites)
+    with open_output(args.outfile, args.format == 'plotstore') as out_file:
+        if args.cache_dir:
+            _convert_cached(out_file, args, site_filter)
+            return
+
+        if args.plot_store:
+            connection = plot_store_sync.open_plot_store(args.plot_store)
+            try:
+                plot_store_sync.sync_plot_store(connection, args.betydb_url, args.full_sync)
+                sites = plot_store_sync.iter_store_site_geometries(connection, site_filter)
+                _write_plots(out_file, iter_sites_to_geojson(sites), args)
+            finally:
+                connection.close()
+            return
+
+        if args.stream or args.page_size:
+            # Convert and write each plot as it's received
+            if args.page_size:
+                experiments = betydb_client.page_betydb_experiments(args.betydb_url, args.page_size, args.page_workers,
+                                                      args.page_retries)
+            else:
+                experiments = betydb_client.stream_betydb_experiments(args.betydb_url)
+            sites = _unique_sites(iter_experiment_site_geometries(experiments, site_filter))
+            _write_plots(out_file, iter_sites_to_geojson(sites), args)
+            return
+
+        experiments_json = query_betydb_experiments(args.betydb_url)
+        sites = get_experiment_site_geometries(experiments_json, site_filter)
+        if not sites:
+            raise RuntimeError("No plots were found in the data returned from BETYdb")
+
+        # Format each of the plots to their GeoJSON equivalents
+        geojson_plots = sites_to_geojson(sites)
 
-    # Write out the GeoJSON
-    write_geojson(args.outfile, geojson_plots)
+        # Write out the GeoJSON
+        _write_plots(out_file, geojson_plots, args)
 
 
 if __name__ == "__main__":
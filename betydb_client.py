@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+"""Fetches experiments and sites from BETYdb, streaming, paging and caching the responses
+"""
+
+import os
+import codecs
+import collections
+import concurrent.futures
+import hashlib
+import json
+import time
+from typing import Callable, Iterable, Iterator
+import requests
+
+import file_utils
+
+ENV_BETYDB_URL_NAME = 'BETYDB_URL'
+
+# The number of bytes to read at a time when streaming the BETYdb response
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The initial number of seconds to wait before retrying a failed page fetch; doubled for each further retry
+PAGE_RETRY_BACKOFF = 1.0
+
+class _JsonStreamReader:
+    """Pulls JSON values one at a time from an iterable of text or byte chunks"""
+
+    def __init__(self, chunks: Iterable):
+        """Initializes the reader
+        Arguments:
+            chunks: iterable returning bytes (assumed to be UTF-8) or str chunks of a JSON document
+        """
+        self._chunks = iter(chunks)
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, min_chars: int = 1) -> bool:
+        """Reads more data into the buffer
+        Arguments:
+            min_chars: the minimum number of characters to add to the buffer before returning
+        Return:
+            Returns True if data was added and False if the end of the data was reached
+        """
+        # Discard what's been consumed so the buffer only holds the value being parsed
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+
+        added = 0
+        while added < min_chars and not self._eof:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                chunk = self._text_decoder.decode(b'', final=True)
+                self._eof = True
+            else:
+                if isinstance(chunk, bytes):
+                    chunk = self._text_decoder.decode(chunk)
+            self._buf += chunk
+            added += len(chunk)
+
+        return added > 0
+
+    def peek(self) -> str:
+        """Returns the next non-whitespace character without consuming it
+        Return:
+            The next character or an empty string if there's no more data
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        """Consumes the next non-whitespace character and checks that it's the expected one
+        Arguments:
+            char: the expected character
+        Exceptions:
+            A RuntimeError is raised if the character is not found
+        """
+        found = self.peek()
+        if found != char:
+            raise RuntimeError('Malformed JSON: expected "%s" but found "%s"' % (char, found))
+        self._pos += 1
+
+    def value(self):
+        """Decodes and consumes the next complete JSON value
+        Return:
+            Returns the decoded value
+        Exceptions:
+            A json.JSONDecodeError is raised if the data is not valid JSON
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # A number ending at the buffer end may continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            # Grow the buffer by at least what's pending so that re-parsing stays linear overall
+            self._fill(max(len(self._buf) - self._pos, 1))
+
+
+def iter_json_array_items(chunks: Iterable, array_key: str = 'data') -> Iterator:
+    """Incrementally parses a JSON object and returns the items of one of its top level arrays
+    Arguments:
+        chunks: iterable returning the JSON document in pieces (bytes or str)
+        array_key: the top level key of the array to return the items of
+    Return:
+        Returns each item of the array as it's parsed
+    Exceptions:
+        Raises RuntimeError if the document is not an object or the key is not found or is not an array
+    Notes:
+        Only the item currently being parsed is held in memory; other top level values are parsed and discarded
+    """
+    reader = _JsonStreamReader(chunks)
+    found_key = False
+
+    reader.expect('{')
+    while True:
+        next_char = reader.peek()
+        if next_char == '}':
+            break
+        if next_char == ',':
+            reader.expect(',')
+            continue
+        key = reader.value()
+        reader.expect(':')
+        if key != array_key:
+            reader.value()
+            continue
+
+        found_key = True
+        reader.expect('[')
+        while True:
+            next_char = reader.peek()
+            if next_char == ']':
+                reader.expect(']')
+                break
+            if next_char == ',':
+                reader.expect(',')
+                continue
+            yield reader.value()
+
+    if not found_key:
+        raise RuntimeError('Missing top-level "%s" key from JSON' % array_key)
+
+
+def get_betydb_api_url(betydb_url: str, endpoint: str) -> str:
+    """Returns the URL of a BETYdb API endpoint
+    Arguments:
+        betydb_url: the url of the BETYdb instance
+        endpoint: the name of the endpoint
+    Return:
+        The URL of the endpoint
+    Exceptions:
+        A RuntimeError is raised if the needed BETYdb access information is not available.
+    """
+    # Fill in missing values if we can
+    if not betydb_url:
+        betydb_url = os.getenv(ENV_BETYDB_URL_NAME, None)
+    if not betydb_url:
+        raise RuntimeError("Unable to resolve BETYdb URL. Please ensure it's defined and try again.")
+
+    return betydb_url.rstrip('/') + '/api/v1/' + endpoint
+
+
+def get_experiments_query(betydb_url: str = None) -> tuple:
+    """Returns the URL and query parameters for fetching experiment information
+    Arguments:
+        betydb_url: the url of the BETYdb instance
+    Return:
+        A tuple of the URL to query and the dict of query parameters
+    Exceptions:
+        A RuntimeError is raised if the needed BETYdb access information is not available.
+    """
+    url = get_betydb_api_url(betydb_url, 'experiments')
+    params = {'associations_mode': 'full_info', 'limit': 'none'}
+
+    return url, params
+
+
+def stream_betydb_data(url: str, params: dict, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator:
+    """Queries BETYdb and returns each entry of the "data" array in the response as it's received
+    Arguments:
+        url: the URL to query
+        params: the query parameters
+        chunk_size: the number of bytes to read from the response at a time
+    Return:
+        Returns each of the entries in the "data" array
+    Exceptions:
+        A RuntimeError is raised if the response doesn't have a "data" array.
+        Other exceptions may be thrown by the requests.get() or requests.raise_for_status() call
+    """
+    with requests.get(url, params=params, timeout=300, stream=True) as req:
+        req.raise_for_status()
+        yield from iter_json_array_items(req.iter_content(chunk_size=chunk_size), 'data')
+
+
+def stream_betydb_experiments(betydb_url: str = None, chunk_size: int = STREAM_CHUNK_SIZE,
+                              query_params: dict = None) -> Iterator[dict]:
+    """Queries BETYdb for experiment information and returns each experiment as it's received
+    Arguments:
+        betydb_url: the url to query
+        chunk_size: the number of bytes to read from the response at a time
+        query_params: optional additional query parameters
+    Return:
+        Returns each of the experiments found in the "data" array of the response
+    Exceptions:
+        A RuntimeError is raised if the needed BETYdb access information is not available, or the response
+        doesn't have a "data" array.
+        Other exceptions may be thrown by the requests.get() or requests.raise_for_status() call
+    Notes:
+        Unlike query_betydb_experiments(), the response is never held in memory in its entirety
+    """
+    url, params = get_experiments_query(betydb_url)
+    if query_params:
+        params.update(query_params)
+
+    yield from stream_betydb_data(url, params, chunk_size)
+
+
+def get_cache_key(*values) -> str:
+    """Returns a file name safe key for the values
+    Arguments:
+        values: the JSON serializable values to generate a key for
+    Return:
+        The key for the combination of values
+    """
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def write_cache_file(cache_dir: str, file_name: str, write_contents: Callable, mode: str = 'wb') -> str:
+    """Atomically writes a file in the cache folder
+    Arguments:
+        cache_dir: the cache folder
+        file_name: the name of the file to write
+        write_contents: function that's called with the open file to write the contents
+        mode: the mode to open the file with
+    Return:
+        Returns the path to the written file
+    Notes:
+        The contents are written to a temporary file that replaces any existing file once it's complete; text is
+        written as UTF-8
+    """
+    file_path = os.path.join(cache_dir, file_name)
+    file_utils.write_file_atomically(file_path, write_contents, mode)
+    return file_path
+
+
+def iter_file_chunks(file_path: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """Returns the contents of a file in chunks
+    Arguments:
+        file_path: the path of the file to read
+        chunk_size: the maximum number of bytes to return at a time
+    Return:
+        Returns each chunk of the file
+    """
+    with open(file_path, 'rb') as in_file:
+        chunk = in_file.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = in_file.read(chunk_size)
+
+
+def fetch_cached_response(url: str, params: dict, cache_dir: str, max_age: int) -> tuple:
+    """Returns a cached response for the query, only contacting the server when the cached copy is too old
+    Arguments:
+        url: the URL to query
+        params: the query parameters
+        cache_dir: the folder where responses are cached
+        max_age: the number of seconds a cached response is used without checking for changes
+    Return:
+        A tuple of the path to the response body and the dict of cache information on the response. The "digest"
+        key of the cache information holds a hash of the response body
+    Exceptions:
+        Exceptions may be thrown by the requests.get() or requests.raise_for_status() call
+    Notes:
+        Stale responses are revalidated using the ETag and Last-Modified headers received with them, and are
+        reused without downloading when the server indicates they're unchanged
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_key = get_cache_key(url, params)
+    body_path = os.path.join(cache_dir, cache_key + '.body')
+    info_path = os.path.join(cache_dir, cache_key + '.json')
+
+    cache_info = None
+    if os.path.exists(body_path) and os.path.exists(info_path):
+        with open(info_path, 'r', encoding='utf-8') as in_file:
+            cache_info = json.load(in_file)
+        if time.time() - cache_info['fetched'] <= max_age:
+            return body_path, cache_info
+
+    headers = {}
+    if cache_info and cache_info.get('etag'):
+        headers['If-None-Match'] = cache_info['etag']
+    if cache_info and cache_info.get('last_modified'):
+        headers['If-Modified-Since'] = cache_info['last_modified']
+
+    with requests.get(url, params=params, headers=headers, timeout=300, stream=True) as req:
+        if req.status_code == 304 and cache_info:
+            cache_info['fetched'] = time.time()
+        else:
+            req.raise_for_status()
+            digest = hashlib.sha256()
+
+            def write_body(out_file) -> None:
+                """Writes the response to the file while updating the digest"""
+                for one_chunk in req.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    digest.update(one_chunk)
+                    out_file.write(one_chunk)
+
+            write_cache_file(cache_dir, os.path.basename(body_path), write_body)
+            cache_info = {'url': url,
+                          'params': params,
+                          'etag': req.headers.get('ETag'),
+                          'last_modified': req.headers.get('Last-Modified'),
+                          'fetched': time.time(),
+                          'digest': digest.hexdigest()
+                          }
+
+    write_cache_file(cache_dir, os.path.basename(info_path), lambda out_file: json.dump(cache_info, out_file), 'wt')
+    return body_path, cache_info
+
+
+def _get_pooled_session(max_connections: int) -> requests.Session:
+    """Returns a session that keeps up to the specified number of connections open for reuse
+    Arguments:
+        max_connections: the maximum number of concurrent connections to a host
+    Return:
+        The session to use for requests
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def _fetch_experiments_page(session: requests.Session, url: str, params: dict, retries: int) -> list:
+    """Fetches one page of experiments, retrying on connection problems and server errors
+    Arguments:
+        session: the session to make the request with
+        url: the URL to query
+        params: the query parameters, including the page's limit and offset
+        retries: the number of times to retry a failed request
+    Return:
+        Returns the list of experiments in the page
+    Exceptions:
+        Raises RuntimeError if the returned JSON doesn't have a "data" key.
+        Exceptions from requests are raised when a request fails and there are no retries left, or immediately when
+        the server reports a client error
+    """
+    attempt = 0
+    while True:
+        try:
+            req = session.get(url, params=params, timeout=300)
+            req.raise_for_status()
+            page_json = req.json()
+            break
+        except requests.RequestException as ex:
+            # Don't retry requests the server says are wrong
+            status_code = ex.response.status_code if ex.response is not None else None
+            if attempt >= retries or (status_code is not None and 400 <= status_code < 500 and status_code != 429):
+                raise
+            time.sleep(PAGE_RETRY_BACKOFF * (2 ** attempt))
+            attempt += 1
+
+    if 'data' not in page_json:
+        raise RuntimeError('Missing top-level "data" key from JSON page at offset %s' % str(params.get('offset')))
+    return page_json['data']
+
+
+def page_betydb_experiments(betydb_url: str = None, page_size: int = 100, max_workers: int = 4,
+                            retries: int = 3) -> Iterator[dict]:
+    """Queries BETYdb for experiment information one page at a time, fetching pages concurrently
+    Arguments:
+        betydb_url: the url to query
+        page_size: the number of experiments to request per page
+        max_workers: the maximum number of pages to request at the same time
+        retries: the number of times to retry fetching a page
+    Return:
+        Returns each of the experiments, in page order, as their page arrives
+    Exceptions:
+        A RuntimeError is raised if the needed BETYdb access information is not available.
+        Other exceptions may be thrown by failed page requests
+    Notes:
+        Up to max_workers pages beyond the last page may be requested before the end of the data is detected
+    """
+    url, params = get_experiments_query(betydb_url)
+    params['limit'] = page_size
+
+    with _get_pooled_session(max_workers) as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        next_offset = 0
+        while next_offset < max_workers * page_size:
+            pending.append(executor.submit(_fetch_experiments_page, session, url,
+                                           dict(params, offset=next_offset), retries))
+            next_offset += page_size
+
+        # Return pages in order, requesting another page as each full page is received
+        while pending:
+            experiments = pending.popleft().result()
+            if len(experiments) < page_size:
+                # The last page has been received
+                for one_future in pending:
+                    one_future.cancel()
+                pending.clear()
+            else:
+                pending.append(executor.submit(_fetch_experiments_page, session, url,
+                                               dict(params, offset=next_offset), retries))
+                next_offset += page_size
+
+            yield from experiments
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Sorts records that may not fit in memory, by writing sorted runs of them to temporary files and merging the runs
+"""
+
+import heapq
+import pickle
+import tempfile
+from typing import Iterable, Iterator
+
+# The approximate memory used by each record being sorted, in addition to the record itself
+SORT_ENTRY_SIZE = 200
+
+# The largest number of sorted temporary files that are merged at one time
+SORT_MERGE_WIDTH = 64
+
+
+class ExternalSorter:
+    """Sorts records using a limited amount of memory, by writing sorted runs of records to temporary files and then
+    merging them"""
+
+    def __init__(self, memory_limit: int):
+        """Initializes the sorter
+        Arguments:
+            memory_limit: the approximate number of bytes of memory to use for holding records
+        """
+        self.memory_limit = memory_limit
+        # Records, such as CSV headers, that are returned ahead of the sorted records
+        self.headers = []
+        self._records = []
+        self._size = 0
+        self._count = 0
+        self._runs = []
+
+    def add(self, key: tuple, record: bytes) -> None:
+        """Adds a record to be sorted; records with the same key stay in the order they're added
+        Arguments:
+            key: the sort key of the record
+            record: the record
+        """
+        # The count keeps the sort stable and means records are never compared
+        self._records.append((key, self._count, record))
+        self._count += 1
+        self._size += len(record) + SORT_ENTRY_SIZE
+        if self._size >= self.memory_limit:
+            self._spill()
+
+    def _spill(self) -> None:
+        """Sorts the records in memory and writes them to a temporary file"""
+        self._records.sort(key=lambda entry: entry[:2])
+        self._runs.append(self._write_run(self._records))
+        self._records = []
+        self._size = 0
+
+        # Merge runs together to avoid having too many files open when merging at the end
+        if len(self._runs) >= SORT_MERGE_WIDTH:
+            runs = self._runs
+            self._runs = [self._write_run(heapq.merge(*[self._iter_run(one_run) for one_run in runs],
+                                                      key=lambda entry: entry[:2]))]
+            for one_run in runs:
+                one_run.close()
+
+    @staticmethod
+    def _write_run(entries: Iterable[tuple]):
+        """Writes sorted records to a temporary file
+        Arguments:
+            entries: the sorted tuples of key, count, and record
+        Return:
+            Returns the temporary file, which is removed when it's closed
+        """
+        # pylint: disable=consider-using-with
+        run_file = tempfile.TemporaryFile(prefix='merge_csv_')
+        pickler = pickle.Pickler(run_file, protocol=pickle.HIGHEST_PROTOCOL)
+        for one_entry in entries:
+            pickler.dump(one_entry)
+            # Don't let the pickler remember everything written
+            pickler.clear_memo()
+        return run_file
+
+    @staticmethod
+    def _iter_run(run_file) -> Iterator[tuple]:
+        """Reads the sorted records from a temporary file
+        Arguments:
+            run_file: the temporary file
+        Return:
+            Returns each tuple of key, count, and record
+        """
+        run_file.seek(0)
+        unpickler = pickle.Unpickler(run_file)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Returns the headers followed by the records in sorted order"""
+        yield from self.headers
+        self._records.sort(key=lambda entry: entry[:2])
+        for one_entry in heapq.merge(self._records, *[self._iter_run(one_run) for one_run in self._runs],
+                                     key=lambda entry: entry[:2]):
+            yield one_entry[2]
+
+    def close(self) -> None:
+        """Releases the records and removes the temporary files"""
+        self._records = []
+        for one_run in self._runs:
+            one_run.close()
+        self._runs = []
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Helpers for working with files that are shared by the scripts
+"""
+
+import os
+import tempfile
+from typing import Callable
+
+
+def write_file_atomically(file_path: str, write_contents: Callable, mode: str = 'w') -> None:
+    """Writes a file in one step, so that it's never left partially written
+    Arguments:
+        file_path: the path of the file to write
+        write_contents: function that's called with the open file to write the contents
+        mode: the mode to open the file with; text files are written as UTF-8 without translating new lines
+    Notes:
+        The contents are written to a temporary file in the same folder that replaces any existing file once it's
+        complete
+    """
+    temp_handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.',
+                                              prefix='.' + os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        if 'b' in mode:
+            out_file = os.fdopen(temp_handle, mode)
+        else:
+            out_file = os.fdopen(temp_handle, mode, encoding='utf-8', newline='')
+        with out_file:
+            write_contents(out_file)
+        os.replace(temp_path, file_path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
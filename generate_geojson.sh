@@ -7,18 +7,31 @@ else
   DESTINATION_FILE="/output/plots.json"
 fi
 
+# Plot geometry store destinations are converted from the GeoJSON once it's available
+if [[ ${DESTINATION_FILE} == *.pgs ]]; then
+  GEOJSON_FILE="${DESTINATION_FILE%.pgs}.geojson"
+else
+  GEOJSON_FILE="${DESTINATION_FILE}"
+fi
+
 if [[ "${3}" != *"--clean"* ]]; then
   if [[ ${FILE_PARAM} == http* ]]; then
-    scif run betydb2geojson "${FILE_PARAM}" "${DESTINATION_FILE}"
+    scif run betydb2geojson "${FILE_PARAM}" "${GEOJSON_FILE}"
   elif [[ ${FILE_PARAM} == *.shp ]]; then
-    scif run shp2geojson "${FILE_PARAM}" "${DESTINATION_FILE}"
+    scif run shp2geojson "${FILE_PARAM}" "${GEOJSON_FILE}"
   elif [[ ${FILE_PARAM} == *.json || ${FILE_PARAM} == *.geojson ]]; then
     # shellcheck disable=SC2154
-    cp "${SCIF_APPDATA_odm_workflow}/images/${FILE_PARAM}" "${DESTINATION_FILE}"
+    cp "${SCIF_APPDATA_odm_workflow}/images/${FILE_PARAM}" "${GEOJSON_FILE}"
   else
     echo "Unknown plot geometries file specified: \"${FILE_PARAM}\""
     exit 1
   fi
+  if [[ "${GEOJSON_FILE}" != "${DESTINATION_FILE}" ]]; then
+    python3 "$(dirname "${0}")/plot_geometry_store.py" "${GEOJSON_FILE}" "${DESTINATION_FILE}"
+  fi
 else
   rm "${DESTINATION_FILE}"
+  if [[ "${GEOJSON_FILE}" != "${DESTINATION_FILE}" ]]; then
+    rm -f "${GEOJSON_FILE}"
+  fi
 fi
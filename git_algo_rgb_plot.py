@@ -3,160 +3,953 @@
 """
 
 import argparse
+import ast
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import fcntl
+import hashlib
+import importlib.machinery
+import json
 import logging
+import multiprocessing
 import os
+import re
+import runpy
 import shutil
 import subprocess
+import sys
 import tempfile
+import time
+from typing import Iterable, Iterator, Optional
+
+import file_utils
 
 REPO_DIR = os.environ.get('SCIF_APPDATA_git_plot_rgb', os.path.abspath(os.path.dirname(__file__)))
 PLOT_BASE_BRANCH = os.environ.get('PLOT_BASE_BRANCH', 'v1.10')
 PLOT_BASE_REPO = os.environ.get('PLOT_BASE_REPO', 'https://github.com/AgPipeline/plot-base-rgb.git')
 
+# The folder holding the bare mirrors of the git repositories
+GIT_CACHE_DIR = os.environ.get('GIT_CACHE_DIR', os.path.join(REPO_DIR, 'git_cache'))
+# The number of megabytes the mirrors can use before the least recently used ones are removed
+GIT_CACHE_SIZE_MB = float(os.environ.get('GIT_CACHE_SIZE_MB', '2048'))
+# The number of seconds before a mirror is fetched again to find the latest commit of a branch
+GIT_CACHE_MAX_AGE = float(os.environ.get('GIT_CACHE_MAX_AGE', '3600'))
+
+# The folder holding the Python environments with the algorithms' requirements installed
+ENV_CACHE_DIR = os.environ.get('ENV_CACHE_DIR', os.path.join(REPO_DIR, 'env_cache'))
+# The number of megabytes the environments can use before the least recently used ones are removed
+ENV_CACHE_SIZE_MB = float(os.environ.get('ENV_CACHE_SIZE_MB', '4096'))
+
+# The file in each environment that's written once all of its requirements are installed
+ENV_COMPLETE_FILE = '.drone_complete'
+# The file in each environment listing the algorithm's requirements and modules that couldn't be installed; they're
+# tried again by the next run using the environment
+ENV_RETRY_FILE = '.drone_retry.json'
+# The file in each environment with the interpreter's module search path, for checking imports without running it
+ENV_PATHS_FILE = '.drone_paths.json'
+
+# The distributions to install for modules whose names are different from their distribution's name
+IMPORT_DISTRIBUTIONS = {
+    'attr': 'attrs',
+    'bs4': 'beautifulsoup4',
+    'cv2': 'opencv-contrib-python-headless',
+    'dateutil': 'python-dateutil',
+    'gdal': 'GDAL',
+    'osgeo': 'GDAL',
+    'PIL': 'Pillow',
+    'skimage': 'scikit-image',
+    'sklearn': 'scikit-learn',
+    'yaml': 'PyYAML',
+}
+
+# The number of worker pools the plot images are run in when a worker process stops unexpectedly
+BATCH_POOL_ATTEMPTS = 2
+
+# The file in each mirror recording when it was fetched and used, and the commits branches and tags resolved to
+CACHE_INFO_FILE = 'drone_cache.json'
+COMMIT_SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def _run_git(git_dir: Optional[str], *git_args: str, check: bool = True) -> subprocess.CompletedProcess:
+    """Runs a git command
+    Arguments:
+        git_dir: the repository to run the command against, or None
+        git_args: the git command and its arguments
+        check: raise an exception if the command fails
+    Return:
+        Returns the completed process, with its output as text
+    """
+    cmd = ['git'] + (['--git-dir', git_dir] if git_dir else []) + list(git_args)
+    #  We don't always want an exception thrown, so we silence pylint
+    # pylint: disable=subprocess-run-check
+    res = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    if check and res.returncode != 0:
+        raise RuntimeError('git %s failed: %s' % (git_args[0], res.stderr.strip()))
+    return res
+
+
+def _get_mirror_dir(git_repo: str) -> str:
+    """Returns the path of the cached mirror of a repository
+    Arguments:
+        git_repo: the URL of the repository
+    Return:
+        Returns the path of the mirror, which may not exist yet
+    """
+    repo_name = re.sub(r'[^A-Za-z0-9_.-]', '_', os.path.basename(git_repo.rstrip('/')))
+    if repo_name.endswith('.git'):
+        repo_name = repo_name[:-4]
+    url_hash = hashlib.sha256(git_repo.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(GIT_CACHE_DIR, '%s-%s.git' % (repo_name, url_hash))
+
+
+@contextlib.contextmanager
+def _lock_folder(folder: str, blocking: bool = True) -> Iterator[bool]:
+    """Locks a cached mirror or environment so that other runs don't change it at the same time
+    Arguments:
+        folder: the path of the mirror or environment
+        blocking: wait for the lock when another run has it
+    Return:
+        Returns True if the lock is held, or False when not blocking and another run has the lock
+    """
+    os.makedirs(os.path.dirname(folder), exist_ok=True)
+    with open(folder + '.lock', 'a', encoding='utf-8') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_cache_info(mirror_dir: str) -> dict:
+    """Loads the cache information of a mirror
+    Arguments:
+        mirror_dir: the path of the mirror
+    Return:
+        Returns the cache information, which is empty if there isn't any
+    """
+    try:
+        with open(os.path.join(mirror_dir, CACHE_INFO_FILE), 'r', encoding='utf-8') as in_file:
+            return json.load(in_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache_info(mirror_dir: str, cache_info: dict) -> None:
+    """Saves the cache information of a mirror
+    Arguments:
+        mirror_dir: the path of the mirror
+        cache_info: the information to save
+    """
+    info_path = os.path.join(mirror_dir, CACHE_INFO_FILE)
+    with open(info_path + '.tmp', 'w', encoding='utf-8') as out_file:
+        json.dump(cache_info, out_file)
+    os.replace(info_path + '.tmp', info_path)
+
+
+def _resolve_ref(mirror_dir: str, git_ref: str) -> Optional[str]:
+    """Finds the commit of a branch, tag, or commit in a mirror
+    Arguments:
+        mirror_dir: the path of the mirror
+        git_ref: the branch, tag, or commit
+    Return:
+        Returns the SHA of the commit, or None if it's not in the mirror
+    """
+    res = _run_git(mirror_dir, 'rev-parse', '--verify', '--quiet', git_ref + '^{commit}', check=False)
+    return res.stdout.strip() if res.returncode == 0 else None
+
+
+def _is_tag(mirror_dir: str, git_ref: str) -> bool:
+    """Returns whether the name is a tag in the mirror; tags aren't fetched again to check for changes
+    Arguments:
+        mirror_dir: the path of the mirror
+        git_ref: the name to check
+    """
+    res = _run_git(mirror_dir, 'show-ref', '--verify', '--quiet', 'refs/tags/' + git_ref, check=False)
+    return res.returncode == 0
+
+
+def _update_mirror(git_repo: str, git_ref: str, mirror_dir: str) -> str:
+    """Makes sure the mirror of a repository has the commit for a branch, tag, or commit, only fetching when the
+    commit isn't known or the branch hasn't been fetched recently
+    Arguments:
+        git_repo: the URL of the repository
+        git_ref: the branch, tag, or commit
+        mirror_dir: the path of the mirror; must be locked
+    Return:
+        Returns the SHA of the commit
+    Exceptions:
+        A RuntimeError is raised if the repository can't be fetched or the commit can't be found
+    """
+    if not os.path.isdir(mirror_dir):
+        logging.info('Creating a mirror of repo %s', git_repo)
+        temp_dir = mirror_dir + '.tmp'
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        _run_git(None, 'clone', '--mirror', '--quiet', git_repo, temp_dir)
+        os.replace(temp_dir, mirror_dir)
+        cache_info = {'url': git_repo, 'fetched': time.time()}
+    else:
+        cache_info = _load_cache_info(mirror_dir)
+        commit = _resolve_ref(mirror_dir, git_ref)
+        stale = time.time() - cache_info.get('fetched', 0) > GIT_CACHE_MAX_AGE
+        if commit is None or (stale and not COMMIT_SHA_RE.match(git_ref) and not _is_tag(mirror_dir, git_ref)):
+            logging.info('Fetching repo %s for %s', git_repo, git_ref)
+            _run_git(mirror_dir, 'fetch', '--prune', '--quiet', 'origin')
+            cache_info['fetched'] = time.time()
+
+    commit = _resolve_ref(mirror_dir, git_ref)
+    if commit is None:
+        raise RuntimeError('Unable to find branch or tag %s in repo %s' % (git_ref, git_repo))
+    cache_info['used'] = time.time()
+    _save_cache_info(mirror_dir, cache_info)
+    return commit
+
+
+def checkout_repo(git_repo: str, git_ref: str, dest_dir: str) -> str:
+    """Checks out a branch, tag, or commit of a repository into a new folder, using a cached mirror of the repository
+    Arguments:
+        git_repo: the URL of the repository
+        git_ref: the branch, tag, or commit
+        dest_dir: the folder to check out into; it must not exist, or be empty
+    Return:
+        Returns the SHA of the checked out commit
+    Exceptions:
+        A RuntimeError is raised if the repository can't be fetched or checked out
+    """
+    mirror_dir = _get_mirror_dir(git_repo)
+    with _lock_folder(mirror_dir):
+        commit = _update_mirror(git_repo, git_ref, mirror_dir)
+        # Clean up after any earlier runs that didn't finish
+        _run_git(mirror_dir, 'worktree', 'prune', check=False)
+        _run_git(mirror_dir, 'worktree', 'add', '--detach', '--force', '--quiet', dest_dir, commit)
+    logging.info('Checked out repo %s %s at %s', git_repo, git_ref, commit)
+    return commit
+
 
-def _check_install_requirements(requirements_file: str) -> None:
+def remove_checkout(git_repo: str, dest_dir: str) -> None:
+    """Removes a folder checked out by checkout_repo()
+    Arguments:
+        git_repo: the URL of the repository
+        dest_dir: the checked out folder
+    """
+    mirror_dir = _get_mirror_dir(git_repo)
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    if os.path.isdir(mirror_dir):
+        with _lock_folder(mirror_dir):
+            _run_git(mirror_dir, 'worktree', 'prune', check=False)
+
+
+def _get_folder_size(folder: str) -> int:
+    """Returns the number of bytes used by the files in a folder"""
+    total_size = 0
+    for root, _, files in os.walk(folder):
+        for one_file in files:
+            try:
+                total_size += os.lstat(os.path.join(root, one_file)).st_size
+            except OSError:
+                pass
+    return total_size
+
+
+def _remove_least_used(folders: list, max_size: float, keep: tuple = ()) -> None:
+    """Removes the least recently used cached folders until they're within their size
+    Arguments:
+        folders: the list of tuples of when each folder was last used and its path
+        max_size: the number of megabytes the folders can use
+        keep: the paths of folders that are not removed
+    """
+    folders = [(last_used, one_folder, _get_folder_size(one_folder)) for last_used, one_folder in folders]
+    total_size = sum(one_folder[2] for one_folder in folders)
+    for _, one_folder, folder_size in sorted(folders):
+        if total_size <= max_size * 1024 * 1024:
+            break
+        if one_folder in keep:
+            continue
+        # Leave folders alone that are being used by other runs
+        with _lock_folder(one_folder, blocking=False) as locked:
+            if not locked:
+                continue
+            logging.info('Removing cached folder %s', one_folder)
+            shutil.rmtree(one_folder, ignore_errors=True)
+        total_size -= folder_size
+
+
+def evict_cache(max_size: float = GIT_CACHE_SIZE_MB, keep: tuple = ()) -> None:
+    """Removes the least recently used mirrors until the cache is within its size
+    Arguments:
+        max_size: the number of megabytes the mirrors can use
+        keep: the URLs of the repositories whose mirrors are not removed
+    """
+    if not os.path.isdir(GIT_CACHE_DIR):
+        return
+    mirrors = [(_load_cache_info(one_entry.path).get('used', 0), one_entry.path)
+               for one_entry in os.scandir(GIT_CACHE_DIR) if one_entry.is_dir() and one_entry.name.endswith('.git')]
+    _remove_least_used(mirrors, max_size, tuple(_get_mirror_dir(one_repo) for one_repo in keep))
+
+
+def _get_environment_hash(requirements_files: list, modules: Iterable[str] = ()) -> str:
+    """Returns the hash identifying the environment for a set of requirements
+    Arguments:
+        requirements_files: the list of requirements files; files that don't exist, or are None, are skipped
+        modules: the top level modules imported by the algorithm
+    Return:
+        Returns the hash of the Python interpreter, the contents of the requirements files, and the modules
+    """
+    env_hash = hashlib.sha256()
+    python_path = shutil.which('python3') or 'python3'
+    env_hash.update(os.path.realpath(python_path).encode('utf-8') + b'\0')
+    for one_file in requirements_files:
+        if one_file and os.path.exists(one_file):
+            with open(one_file, 'rb') as in_file:
+                env_hash.update(in_file.read())
+        env_hash.update(b'\0')
+    env_hash.update(' '.join(sorted(modules)).encode('utf-8'))
+    return env_hash.hexdigest()[:24]
+
+
+def _install_algorithm_packages(env_dir: str, requirements_file: Optional[str], modules: set) -> None:
+    """Installs the algorithm's requirements, and any other modules it imports, into an environment, recording the
+    ones that couldn't be installed so that they're tried again by the next run instead of the environment being
+    created again
+    Arguments:
+        env_dir: the folder of the environment; it must be locked for this run alone
+        requirements_file: the requirements file of the algorithm, or None to only install modules
+        modules: the top level modules imported by the algorithm
+    """
+    python = os.path.join(env_dir, 'bin', 'python3')
+    retry_path = os.path.join(env_dir, ENV_RETRY_FILE)
+    failed = {}
+    if requirements_file is not None and not _check_install_requirements(requirements_file, python):
+        failed['requirements'] = True
+    missing = _install_missing_modules(modules, python)
+    if missing:
+        failed['modules'] = sorted(missing)
+
+    if failed:
+        file_utils.write_file_atomically(retry_path, lambda out_file: json.dump(failed, out_file))
+    elif os.path.exists(retry_path):
+        os.remove(retry_path)
+
+
+def _build_environment(env_dir: str, base_requirements: str, requirements_file: str, modules: set) -> None:
+    """Creates a Python environment and installs the requirements, and any other modules the algorithm imports, into
+    it
+    Arguments:
+        env_dir: the folder of the environment; any existing incomplete environment there is replaced
+        base_requirements: the requirements file of the base code, which must install
+        requirements_file: the requirements file of the algorithm
+        modules: the top level modules imported by the algorithm
+    Exceptions:
+        A subprocess.CalledProcessError is raised if the environment can't be created or the base requirements
+        can't be installed
+    Notes:
+        The environment is complete once the base requirements are installed; the algorithm's requirements and
+        modules that couldn't be installed are tried again by later runs
+    """
+    logging.info('Creating Python environment %s', env_dir)
+    shutil.rmtree(env_dir, ignore_errors=True)
+    # Packages installed with the system's Python are available, as they were when installing into it
+    cmd = ('python3', '-m', 'venv', '--system-site-packages', env_dir)
+    _ = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+    python = os.path.join(env_dir, 'bin', 'python3')
+
+    cmd = (python, '-m', 'pip', 'install', '--no-cache-dir', '-r', base_requirements)
+    _ = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+
+    _install_algorithm_packages(env_dir, requirements_file, modules)
+    with open(os.path.join(env_dir, ENV_COMPLETE_FILE), 'w', encoding='utf-8'):
+        pass
+
+
+def _load_retry_info(env_dir: str) -> dict:
+    """Loads the algorithm's requirements and modules that couldn't be installed into an environment
+    Arguments:
+        env_dir: the folder of the environment
+    Return:
+        Returns the dictionary of what couldn't be installed, which is empty when everything was installed
+    """
+    try:
+        with open(os.path.join(env_dir, ENV_RETRY_FILE), 'r', encoding='utf-8') as in_file:
+            return json.load(in_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as ex:
+        # Try installing everything again when the file can't be read
+        logging.warning('Unable to read the packages to install again into %s: %s', env_dir, str(ex))
+        return {'requirements': True, 'modules': []}
+
+
+@contextlib.contextmanager
+def use_environment(base_requirements: str, requirements_file: str = None, modules: set = None) -> Iterator[str]:
+    """Finds or creates the cached Python environment with the requirements installed, and keeps it from being
+    removed while it's being used
+    Arguments:
+        base_requirements: the requirements file of the base code
+        requirements_file: the optional requirements file of the algorithm
+        modules: the optional set of top level modules imported by the algorithm; any that aren't installed by the
+                 requirements are installed when the environment is created
+    Return:
+        Returns the path to the environment's Python interpreter
+    Notes:
+        The environment is only changed while it's locked for this run alone; it's shared with other runs once it's
+        ready
+    """
+    modules = modules or set()
+    env_dir = os.path.join(ENV_CACHE_DIR, _get_environment_hash([base_requirements, requirements_file], modules))
+    os.makedirs(ENV_CACHE_DIR, exist_ok=True)
+    with open(env_dir + '.lock', 'a', encoding='utf-8') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(os.path.join(env_dir, ENV_COMPLETE_FILE)):
+                _build_environment(env_dir, base_requirements, requirements_file, modules)
+            else:
+                logging.info('Using cached Python environment %s', env_dir)
+                retry = _load_retry_info(env_dir)
+                if retry:
+                    logging.info('Trying again to install the algorithm packages missing from the environment')
+                    _install_algorithm_packages(env_dir, requirements_file if retry.get('requirements') else None,
+                                                set(retry.get('modules', ())))
+            # The lock file's modification time is when the environment was last used
+            os.utime(env_dir + '.lock')
+            # Let other runs use the environment at the same time
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            yield os.path.join(env_dir, 'bin', 'python3')
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def evict_environments(max_size: float = ENV_CACHE_SIZE_MB) -> None:
+    """Removes the least recently used Python environments until the cache is within its size
+    Arguments:
+        max_size: the number of megabytes the environments can use
+    """
+    if not os.path.isdir(ENV_CACHE_DIR):
+        return
+    environments = [(os.path.getmtime(one_entry.path + '.lock'), one_entry.path)
+                    for one_entry in os.scandir(ENV_CACHE_DIR)
+                    if one_entry.is_dir() and os.path.exists(one_entry.path + '.lock')]
+    _remove_least_used(environments, max_size)
+
+
+def _check_install_requirements(requirements_file: str, python: str = 'python3') -> bool:
     """Attempts to  install requirements in the specified file
     Arguments:
         requirements_file: the file containing the requirements
+        python: the Python interpreter to install the requirements for
+    Return:
+        Returns False if the requirements couldn't be installed, and True otherwise
     """
-    if os.path.exists(requirements_file):
-        cmd = ('python3', '-m', 'pip', 'install', '--upgrade', '--no-cache-dir', '-r', requirements_file)
+    if requirements_file is not None and os.path.exists(requirements_file):
+        cmd = (python, '-m', 'pip', 'install', '--upgrade', '--no-cache-dir', '-r', requirements_file)
         #  We don't want an exception thrown, so we silence pylint
         # pylint: disable=subprocess-run-check
         res = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         if res.returncode != 0:
             logging.warning('Unable to pip install requirements file "%s"', os.path.basename(requirements_file))
+            return False
     elif requirements_file is not None:
         logging.warning('Specified requirements file was not found "%s"', requirements_file)
     else:
         logging.info('No requirements file specified for repository')
+    return True
+
 
+class _ImportFinder(ast.NodeVisitor):
+    """Finds the modules imported by Python source code, leaving out imports that are allowed to fail"""
 
-def _check_install_packages(source_file: str, working_dir: str, requirements_file: str = None) -> None:
-    """Checks for missing Python packages in the specified file
+    def __init__(self):
+        """Initializes the finder"""
+        self.modules = set()
+        self.relative_modules = set()
+        self._optional_depth = 0
+
+    def visit_Try(self, node: ast.Try) -> None:  # pylint: disable=invalid-name
+        """Imports in a try block that catches ImportError are optional"""
+        handled = set()
+        for one_handler in node.handlers:
+            if one_handler.type is None:
+                handled.add('BaseException')
+                continue
+            handler_types = one_handler.type.elts if isinstance(one_handler.type, ast.Tuple) else [one_handler.type]
+            handled.update(one_type.id for one_type in handler_types if isinstance(one_type, ast.Name))
+        optional = bool(handled & {'ImportError', 'ModuleNotFoundError', 'Exception', 'BaseException'})
+        self._optional_depth += optional
+        for one_node in node.body:
+            self.visit(one_node)
+        self._optional_depth -= optional
+        for one_node in node.handlers + node.orelse + node.finalbody:
+            self.visit(one_node)
+
+    def visit_Import(self, node: ast.Import) -> None:  # pylint: disable=invalid-name
+        """Adds the modules of an import statement"""
+        if not self._optional_depth:
+            self.modules.update(one_alias.name.split('.')[0] for one_alias in node.names)
+
+    def visit_ImportFrom(self, node: ast.ImportFrom) -> None:  # pylint: disable=invalid-name
+        """Adds the module of a from ... import statement"""
+        if self._optional_depth:
+            return
+        if node.level:
+            # Relative imports name modules in the same folder, or the names are modules in it
+            self.relative_modules.update([node.module.split('.')[0]] if node.module else
+                                         [one_alias.name for one_alias in node.names])
+        elif node.module != '__future__':
+            self.modules.add(node.module.split('.')[0])
+
+
+def find_imports(source_file: str) -> set:
+    """Finds the top level modules imported by a Python file, and by the files in its folder that it imports
     Arguments:
-        source_file: the source file to check
-        working_dir: folder where to place temporary files
-        requirements_file: optional file containing requires Python modules
+        source_file: the Python file to check
+    Return:
+        Returns the set of module names that aren't files in the source file's folder
+    Exceptions:
+        A SyntaxError is raised if a file can't be parsed
     """
-    # Check for a requirements file and try to install those packages
-    _check_install_requirements(requirements_file)
+    source_dir = os.path.dirname(os.path.abspath(source_file))
+    modules = set()
+    checked = set()
+    to_check = [os.path.abspath(source_file)]
+    while to_check:
+        one_file = to_check.pop()
+        if one_file in checked:
+            continue
+        checked.add(one_file)
+        with open(one_file, 'rb') as in_file:
+            tree = ast.parse(in_file.read(), filename=one_file)
+        finder = _ImportFinder()
+        finder.visit(tree)
 
-    with open(source_file, 'r', encoding='utf-8') as in_file:
-        all_lines = in_file.read()
+        for one_module in finder.modules | finder.relative_modules:
+            for local_file in (os.path.join(source_dir, one_module + '.py'),
+                               os.path.join(source_dir, one_module, '__init__.py')):
+                if os.path.isfile(local_file):
+                    to_check.append(local_file)
+                    break
+            else:
+                if one_module in finder.modules and not os.path.isdir(os.path.join(source_dir, one_module)):
+                    modules.add(one_module)
+    return modules
 
-    # Perform a simple check on imports
-    check_file = os.path.join(working_dir, '__check_import.py')
-    module_lines = []
-    module_names = []
-    with open(check_file, 'w', encoding='utf-8') as out_file:
-        for one_line in all_lines:
-            if one_line.startswith('import ') or one_line.startswith('from '):
-                out_file.write(one_line + '\n')
-                line_chunks = one_line.split()
-                if len(line_chunks) >= 2:
-                    module_names.append(line_chunks[1])
-                module_lines.append(one_line)
 
-    # If there's nothing to do, just return
-    if len(module_lines) <= 0:
-        return
+def _get_python_paths(python: str) -> tuple:
+    """Returns the module search path and the built in modules of a Python interpreter; these are saved with cached
+    environments so that the interpreter only needs to be started once
+    Arguments:
+        python: the Python interpreter
+    Return:
+        Returns a tuple of the list of folders searched for modules and the set of built in module names
+    """
+    paths_file = os.path.join(os.path.dirname(os.path.dirname(python)), ENV_PATHS_FILE)
+    in_environment = os.path.isabs(python) and os.path.exists(os.path.join(os.path.dirname(paths_file),
+                                                                           ENV_COMPLETE_FILE))
+    python_paths = None
+    if in_environment and os.path.exists(paths_file):
+        with open(paths_file, 'r', encoding='utf-8') as in_file:
+            python_paths = json.load(in_file)
+    else:
+        cmd = (python, '-c', 'import json, sys; print(json.dumps({"path": sys.path[1:], '
+                             '"builtins": sorted(sys.builtin_module_names)}))')
+        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                             universal_newlines=True)
+        python_paths = json.loads(res.stdout)
+        if in_environment:
+            temp_path = '%s.%d' % (paths_file, os.getpid())
+            with open(temp_path, 'w', encoding='utf-8') as out_file:
+                json.dump(python_paths, out_file)
+            os.replace(temp_path, paths_file)
+    return python_paths['path'], set(python_paths['builtins'])
 
-    num_tries = 0
-    while True:
-        # Try to run the file to catch missing includes
-        cmd = ('python3', check_file)
-        #  We don't want an exception thrown, so we silence pylint
-        # pylint: disable=subprocess-run-check
-        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        if res.returncode == 0:
-            break
-        num_tries += 1
-        if num_tries >= 2:
-            break
-        logging.info('Initial module check failed for "%s"', os.path.basename(check_file))
+
+def find_missing_modules(modules: set, python: str = 'python3') -> set:
+    """Finds the modules that can't be imported by a Python interpreter, without running it
+    Arguments:
+        modules: the names of the top level modules to look for
+        python: the Python interpreter
+    Return:
+        Returns the set of the names of the modules that weren't found
+    """
+    search_path, builtin_modules = _get_python_paths(python)
+    importlib.invalidate_caches()
+    return {one_module for one_module in modules if one_module not in builtin_modules and
+            importlib.machinery.PathFinder.find_spec(one_module, search_path) is None}
+
+
+def _install_missing_modules(modules: set, python: str = 'python3') -> set:
+    """Installs the distributions of the modules a Python interpreter can't find
+    Arguments:
+        modules: the names of the top level modules the algorithm imports
+        python: the Python interpreter to check and install the modules for
+    Return:
+        Returns the set of the modules that still can't be found
+    """
+    missing = find_missing_modules(modules, python)
+    if not missing:
+        return missing
+
+    distributions = sorted({IMPORT_DISTRIBUTIONS.get(one_module, one_module) for one_module in missing})
+    logging.info('Trying to install missing modules %s', ' '.join(sorted(missing)))
+    cmd = [python, '-m', 'pip', 'install', '--no-cache-dir'] + distributions
+    #  We don't want an exception thrown, so we silence pylint
+    # pylint: disable=subprocess-run-check
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if res.returncode != 0:
+        logging.warning('Unable to install all modules %s', ' '.join(distributions))
         logging.debug(res.stdout)
 
-        # Try installing the modules
-        if module_names:
-            logging.debug('Trying to install modules %s', str(module_names))
-            cmd = ('python3', '-m', 'pip', 'install', '--no-cache-dir', ' '.join(module_names))
-            #  We don't want an exception thrown, so we silence pylint
-            # pylint: disable=subprocess-run-check
-            res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            if res.returncode != 0:
-                logging.warning('Unable to install all modules %s', ' '.join(module_names))
-                logging.debug(res.stdout)
+    missing = find_missing_modules(missing, python)
+    if missing:
+        logging.warning('Not all modules may be available for running the algorithm: %s', ' '.join(sorted(missing)))
+    return missing
+
+
+def get_algorithm_imports(source_file: str) -> set:
+    """Finds the top level modules imported by the algorithm, reporting files that can't be checked
+    Arguments:
+        source_file: the algorithm's source file
+    Return:
+        Returns the set of module names, which is empty if the imports couldn't be found
+    """
+    try:
+        return find_imports(source_file)
+    except SyntaxError as ex:
+        logging.warning('Unable to check the imports of "%s": %s', os.path.basename(source_file), str(ex))
+        return set()
+
+
+def load_file_list(file_list_path: str) -> list:
+    """Loads the plot images to process from a JSON file written by find_files2json.sh
+    Arguments:
+        file_list_path: the path of the JSON file
+    Return:
+        Returns the list of tuples of each plot image and the folder to write its results to
+    Exceptions:
+        A RuntimeError is raised if the file doesn't have the expected contents
+    """
+    with open(file_list_path, 'r', encoding='utf-8') as in_file:
+        file_list = json.load(in_file)
+    try:
+        return [(one_entry['FILE'], one_entry['DIR']) for one_entry in file_list['FILE_LIST']]
+    except (KeyError, TypeError) as ex:
+        raise RuntimeError('Expected a FILE_LIST of FILE and DIR entries in "%s"' % file_list_path) from ex
+
+
+def _init_plot_worker(working_dir: str, search_path: list) -> None:
+    """Prepares a worker process for running the algorithm
+    Arguments:
+        working_dir: the folder containing the algorithm and the base code
+        search_path: the module search path of the worker's interpreter
+    """
+    # The worker is given this script's module search path when it's started, so it's put back to the path of the
+    # environment's interpreter
+    sys.path[:] = [working_dir] + search_path
+
+
+def _run_plot(plot_task: tuple) -> tuple:
+    """Runs the algorithm on one plot image in a worker process
+    Arguments:
+        plot_task: a tuple of the path to transformer.py, the plot image, and the command line arguments
+    Return:
+        Returns a tuple of the plot image and the exit code of the algorithm
+    """
+    run_file, plot_file, run_args = plot_task
+    sys.argv = [run_file] + run_args
+    try:
+        runpy.run_path(run_file, run_name='__main__')
+    except SystemExit as ex:
+        if ex.code is None or isinstance(ex.code, int):
+            return plot_file, ex.code or 0
+        logging.error(ex.code)
+        return plot_file, 1
+    except Exception:  # pylint: disable=broad-except
+        # Report the problem and let the worker go on to the next plot image
+        logging.exception('Algorithm raised an exception for plot image %s', plot_file)
+        return plot_file, 1
+    return plot_file, 0
+
+
+def _run_plot_pool(tasks: list, context, num_jobs: int, initargs: tuple) -> tuple:
+    """Runs the algorithm on plot images in a new pool of worker processes
+    Arguments:
+        tasks: the list of plot tasks for _run_plot()
+        context: the multiprocessing context used to start the workers
+        num_jobs: the number of worker processes
+        initargs: the arguments for _init_plot_worker()
+    Return:
+        Returns a tuple of the list of tasks that weren't finished because a worker process stopped unexpectedly (such
+        as being killed when out of memory), and the number of plot images the algorithm failed on
+    """
+    unfinished = []
+    num_failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_jobs, mp_context=context,
+                                                initializer=_init_plot_worker, initargs=initargs) as executor:
+        futures = {executor.submit(_run_plot, one_task): one_task for one_task in tasks}
+        for one_future in concurrent.futures.as_completed(futures):
+            try:
+                plot_file, exit_code = one_future.result()
+            except concurrent.futures.process.BrokenProcessPool:
+                unfinished.append(futures[one_future])
+                continue
+            if exit_code != 0:
+                logging.error('Algorithm failed with exit code %s for plot image %s', str(exit_code), plot_file)
+                num_failed += 1
+    return unfinished, num_failed
+
+
+def run_batch(run_file: str, python: str, file_list: list, run_args: list, num_jobs: int = None) -> int:
+    """Runs the algorithm on each plot image in a pool of processes, with each process running the algorithm many
+    times so that it only needs to start up and import its modules once
+    Arguments:
+        run_file: the path to transformer.py
+        python: the Python interpreter to run the algorithm with
+        file_list: the list of tuples of each plot image and the folder to write its results to
+        run_args: the command line arguments passed to the algorithm for each plot image
+        num_jobs: the number of processes to use; defaults to the number of CPUs
+    Return:
+        Returns the number of plot images the algorithm failed on
+    Notes:
+        If a worker process stops unexpectedly, the plot images that weren't finished are run again in a new pool;
+        ones that still aren't finished after BATCH_POOL_ATTEMPTS pools are counted as failed
+    """
+    search_path, _ = _get_python_paths(python)
+    tasks = [(run_file, plot_file, [plot_file] + run_args + ['--working_space', plot_dir])
+             for plot_file, plot_dir in file_list]
+
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(python)
+    initargs = (os.path.dirname(run_file), search_path)
+    remaining = tasks
+    num_failed = 0
+    for _ in range(BATCH_POOL_ATTEMPTS):
+        remaining, pool_failed = _run_plot_pool(remaining, context, num_jobs or os.cpu_count(), initargs)
+        num_failed += pool_failed
+        if not remaining:
+            break
+        logging.warning('A worker process stopped unexpectedly with %d plot images not finished', len(remaining))
+
+    for one_task in remaining:
+        logging.error('Algorithm did not finish for plot image %s', one_task[1])
+    num_failed += len(remaining)
+    logging.info('Ran the algorithm on %d plot images, %d failed', len(tasks), num_failed)
+    return num_failed
+
+
+def _check_task_dependencies(tasks: dict) -> None:
+    """Checks that the tasks only depend on tasks that are defined
+    Arguments:
+        tasks: a dictionary of task names and tuples of the task function and the names of the tasks it depends on
+    Exceptions:
+        A RuntimeError is raised if a task depends on a task that isn't defined
+    """
+    for name, (_, depends_on) in tasks.items():
+        unknown = [one_name for one_name in depends_on if one_name not in tasks]
+        if unknown:
+            raise RuntimeError('Task %s depends on unknown tasks %s' % (name, ', '.join(unknown)))
+
+
+def _submit_ready_tasks(waiting: dict, results: dict, submit) -> dict:
+    """Starts the waiting tasks whose dependencies have all finished
+    Arguments:
+        waiting: the dictionary of tasks that haven't been started; the started tasks are removed from it
+        results: the dictionary of the results of the tasks that have finished
+        submit: the function called with the name and function of a task to start it, returning its future
+    Return:
+        Returns the dictionary of the futures of the started tasks and the task names
+    """
+    started = {}
+    for name, (task_function, depends_on) in list(waiting.items()):
+        if all(one_name in results for one_name in depends_on):
+            started[submit(name, task_function)] = name
+            del waiting[name]
+    return started
+
+
+def _collect_finished_tasks(running: dict, results: dict, error: Optional[Exception]) -> Optional[Exception]:
+    """Waits for at least one running task to finish and stores the results of the finished tasks
+    Arguments:
+        running: the dictionary of the futures of the running tasks and the task names; the finished tasks are
+                 removed from it
+        results: the dictionary the results of the finished tasks are added to
+        error: the first exception raised by a task, or None if no task has failed
+    Return:
+        Returns the first exception raised by a task, or None if no task has failed
+    """
+    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+    for one_future in done:
+        name = running.pop(one_future)
+        try:
+            results[name] = one_future.result()
+        except Exception as ex:  # pylint: disable=broad-except
+            if error is None:
+                error = ex
+    return error
+
+
+def run_tasks(tasks: dict) -> dict:
+    """Runs tasks in threads, with each task started as soon as the tasks it depends on have finished, and logs
+    how long each task took
+    Arguments:
+        tasks: a dictionary of task names and tuples of the task function and the names of the tasks it depends on;
+               each function is called with the dictionary of results of the tasks that have finished
+    Return:
+        Returns the dictionary of the names of the tasks and the values their functions returned
+    Exceptions:
+        A RuntimeError is raised if a task depends on an unknown task or the tasks depend on each other.
+        The first exception raised by a task is raised again once the running tasks have finished; tasks that
+        haven't started are not run
+    """
+    _check_task_dependencies(tasks)
+    results = {}
+    timings = {}
+    waiting = dict(tasks)
+    running = {}
+    error = None
+    start_time = time.monotonic()
+
+    def time_task(name: str, task_function):
+        """Runs a task and records how long it took"""
+        task_start = time.monotonic()
+        try:
+            return task_function(dict(results))
+        finally:
+            timings[name] = time.monotonic() - task_start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(tasks), 1)) as executor:
+        while True:
+            if error is None:
+                running.update(_submit_ready_tasks(waiting, results,
+                                                   lambda name, task: executor.submit(time_task, name, task)))
+            if not running:
+                if waiting and error is None:
+                    raise RuntimeError('Tasks depend on each other: %s' % ', '.join(waiting))
+                break
+            error = _collect_finished_tasks(running, results, error)
 
-    if num_tries == 2:
-        logging.warning('Not all modules may be available for running script "%s"',  os.path.basename(check_file))
+    for name in tasks:
+        if name in timings:
+            logging.info('%s: %.2f seconds', name, timings[name])
+    logging.info('Setup took %.2f seconds', time.monotonic() - start_time)
+    if error is not None:
+        raise error
+    return results
 
 
 def get_args() -> tuple:
     """Returns the command line arguments
     Returns:
-        A tuple containing the git repo URI, the git branch or tag to use, and the command line
-        arguments for the code
+        A tuple containing the git repo URI, the git branch or tag to use, the requirements file, the command line
+        arguments for the code, the JSON file of plot images to process in batch mode, and the number of processes
+        to use in batch mode
     """
     parser = argparse.ArgumentParser('Run Plot-level-RGB image code from a git repo')
 
     parser.add_argument('--requires', help='the file containing required Python packages')
+    parser.add_argument('--file-list', help='JSON file from find_files2json.sh listing plot images to run the '
+                        'algorithm on in one batch; the arguments are passed to the algorithm for each image, '
+                        'followed by the image and its folder as the --working_space')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of processes running the algorithm in batch mode (default: %(default)s)')
     parser.add_argument('git_repo', help='git repository containing the plot-level RGB algorithm')
     parser.add_argument('git_branch', help='branch or tag of the git repository to use')
     parser.add_argument('arguments', help='arguments to pass to  the algorithm', nargs=argparse.REMAINDER)
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
 
-    return args.git_repo, args.git_branch, args.requires, args.arguments
+    return args.git_repo, args.git_branch, args.requires, args.arguments, args.file_list, args.jobs
 
 
-def run_git_code() -> None:
-    """Fetches, checks, and runs code from a  git repository
+def _get_setup_tasks(git_repo: str, git_branch: str, working_dir: str, base_dir: str) -> dict:
+    """Returns the tasks that fetch and check the algorithm, for run_tasks()
+    Arguments:
+        git_repo: the repository of the algorithm
+        git_branch: the branch or tag of the algorithm's repository
+        working_dir: the folder the algorithm is checked out to and run from
+        base_dir: the folder the plot-base-rgb code is checked out to
+    Return:
+        Returns the dictionary of tasks; the 'find imports' task returns the modules the algorithm imports
     """
-    git_repo, git_branch, requirements_file, run_args = get_args()
-
-    # Get our working path
-    working_dir = tempfile.mkdtemp(dir=REPO_DIR)
-    os.makedirs(working_dir, exist_ok=True)
+    check_file = os.path.join(working_dir, 'algorithm_rgb.py')
 
-    try:
-        base_dir = tempfile.mkdtemp(dir=REPO_DIR)
-        os.makedirs(base_dir, exist_ok=True)
-        # Get the base code from the repo
-        cmd = ('git', 'clone', '--depth', '1', '--quiet', '--branch', PLOT_BASE_BRANCH, PLOT_BASE_REPO, base_dir)
-        _ = subprocess.run(cmd, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
-
-        # Install basic packages
-        req_file = os.path.join(base_dir, 'requirements.txt')
-        cmd = ('python3', '-m', 'pip', 'install', '--no-cache-dir', '-r', req_file)
-        _ = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
-
-        # Get the code from the repo
-        cmd = ('git', 'clone', '--depth', '1', '--quiet', '--branch', git_branch, git_repo, working_dir)
-        _ = subprocess.run(cmd, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
-
-        # Check the repo for validity
-        check_file = os.path.join(working_dir, 'algorithm_rgb.py')
+    def check_repo(_: dict) -> None:
+        """Checks the repo for validity"""
         if not os.path.exists(check_file):
             msg = 'Missing required file: algorithm_rgb.py in repo %s branch %s' % (git_repo, git_branch)
             logging.warning(msg)
             raise RuntimeError(msg)
 
-        # Install packages
-        req_file = requirements_file if requirements_file else os.path.join(working_dir, 'requirements.txt')
-        _check_install_packages(check_file, working_dir, req_file)
-
-        # Copy the base python files over
+    def copy_base_files(_: dict) -> None:
+        """Copies the base python files over"""
         for one_file in os.listdir(base_dir):
             if one_file.endswith('.py'):
-                shutil.move(os.path.join(base_dir, one_file), os.path.join(working_dir, one_file))
-        shutil.rmtree(base_dir)
+                shutil.copy(os.path.join(base_dir, one_file), os.path.join(working_dir, one_file))
+
+    return {
+        'checkout base': (lambda _: checkout_repo(PLOT_BASE_REPO, PLOT_BASE_BRANCH, base_dir), ()),
+        'checkout algorithm': (lambda _: checkout_repo(git_repo, git_branch, working_dir), ()),
+        'check algorithm': (check_repo, ('checkout algorithm',)),
+        'copy base files': (copy_base_files, ('checkout base', 'check algorithm')),
+        'find imports': (lambda _: get_algorithm_imports(check_file), ('copy base files',)),
+    }
+
+
+def _get_environment_task(working_dir: str, base_dir: str, requirements_file: Optional[str],
+                          environment_stack: contextlib.ExitStack) -> tuple:
+    """Returns the task that prepares the Python environment with the basic packages and the algorithm's packages
+    installed, for run_tasks()
+    Arguments:
+        working_dir: the folder the algorithm is checked out to
+        base_dir: the folder the plot-base-rgb code is checked out to
+        requirements_file: the requirements file for the algorithm, or None to use the one in its repository
+        environment_stack: the stack that keeps the Python environment in use until the algorithm has been run
+    Return:
+        Returns the task, which depends on the 'find imports' task and returns the Python interpreter to use
+    """
+    base_req_file = os.path.join(base_dir, 'requirements.txt')
+    req_file = requirements_file if requirements_file else os.path.join(working_dir, 'requirements.txt')
+    return (lambda done: environment_stack.enter_context(use_environment(base_req_file, req_file,
+                                                                         done['find imports'])),
+            ('find imports',))
 
-        # Run the algorithm
-        run_file = os.path.join(working_dir, 'transformer.py')
-        cmd = ['python3', run_file]
-        cmd = cmd + run_args
-        _ = subprocess.run(cmd, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+
+def run_git_code() -> int:
+    """Fetches, checks, and runs code from a  git repository
+    Return:
+        Returns the exit status for the script: 0 when everything succeeded, and 1 when there was a problem or the
+        algorithm failed on any plot image
+    """
+    git_repo, git_branch, requirements_file, run_args, file_list_path, num_jobs = get_args()
+
+    # Get our working path
+    working_dir = tempfile.mkdtemp(dir=REPO_DIR)
+    base_dir = tempfile.mkdtemp(dir=REPO_DIR)
+    exit_status = 0
+
+    try:
+        file_list = load_file_list(file_list_path) if file_list_path else None
+
+        with contextlib.ExitStack() as environment_stack:
+            # The two repos are fetched at the same time, and the later steps start once what they need is ready
+            results = run_tasks({
+                **_get_setup_tasks(git_repo, git_branch, working_dir, base_dir),
+                'environment': _get_environment_task(working_dir, base_dir, requirements_file, environment_stack),
+            })
+
+            # Run the algorithm
+            run_file = os.path.join(working_dir, 'transformer.py')
+            if file_list is not None:
+                if run_batch(run_file, results['environment'], file_list, run_args, num_jobs) > 0:
+                    exit_status = 1
+            else:
+                cmd = [results['environment'], run_file]
+                cmd = cmd + run_args
+                _ = subprocess.run(cmd, stdin=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
 
     except Exception as ex:
         if logging.getLogger().level == logging.DEBUG:
@@ -164,9 +957,20 @@ def run_git_code() -> None:
         else:
             logging.error('Exception caught for repo %s branch/tag %s', git_repo, git_branch)
             logging.error(ex)
+        exit_status = 1
     finally:
-        shutil.rmtree(working_dir)
+        remove_checkout(PLOT_BASE_REPO, base_dir)
+        remove_checkout(git_repo, working_dir)
+        try:
+            evict_cache(keep=(PLOT_BASE_REPO, git_repo))
+            evict_environments()
+        except OSError as ex:
+            logging.warning('Unable to clean up the repo and environment caches: %s', str(ex))
+
+    return exit_status
 
 
 if __name__ == '__main__':
-    run_git_code()
+    # Show the progress messages, including how long each setup step took
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(run_git_code())
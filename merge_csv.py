@@ -3,83 +3,1126 @@
 """
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import math
 import os
+import re
+import sqlite3
 import sys
+import tempfile
+from typing import Callable, Iterable, Iterator, Optional
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # pylint: disable=invalid-name
 
-def _merge_csv(source_path: str, target_path: str, has_headers: bool = True, header_count: int = 1) -> None:
-    """Merges the source CSV file into the target CSV file
+import external_sort
+import file_utils
+import parquet_table
+
+# The size of the blocks used when copying CSV data
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# The buffer size of each merged file
+WRITE_BUFFER_SIZE = 256 * 1024
+
+# The compression level of gzip compressed merged files
+GZIP_COMPRESS_LEVEL = 6
+
+# The extensions of compressed files and the compression used
+COMPRESSION_EXTENSIONS = {'.gz': 'gz', '.zst': 'zst'}
+
+# The maximum number of merged files that are kept open at one time
+MAX_OPEN_DESTINATIONS = 64
+
+# The number of files merged between progress messages
+PROGRESS_INTERVAL = 500
+
+# The manifest of merged source files is saved next to the merged file with this suffix
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+
+# The default amount of memory used for finding duplicate rows in each merged file
+DEDUPE_MEMORY = 256 * 1024 * 1024
+
+# The approximate memory used by each row hash held in memory
+DEDUPE_ENTRY_SIZE = 120
+
+# The number of bytes in the hash of each row
+ROW_HASH_SIZE = 16
+
+# The number of bits set in the Bloom filter for each row
+BLOOM_HASH_COUNT = 7
+
+# Summary statistics are saved next to the merged file, named with this suffix in place of the extension
+SUMMARY_SUFFIX = '_summary.csv'
+
+# The state of the summary statistics and the hashes of the rows seen when removing duplicates are saved next to the
+# merged file with these suffixes, so that later merges don't need to read the merged file again
+SUMMARY_STATE_SUFFIX = '_summary.state.json'
+DEDUPE_STATE_SUFFIX = '.dedupe'
+STATE_VERSION = 1
+
+# The default amount of memory used for sorting each merged file
+SORT_MEMORY = 256 * 1024 * 1024
+
+
+
+def _get_csv_name(file_name: str) -> Optional[str]:
+    """Returns the name of a CSV file without any compression extension
+    Arguments:
+        file_name: the name of the file
+    Return:
+        Returns the name of the CSV file, or None if the file isn't a CSV file (compressed or not)
+    """
+    csv_name, extension = os.path.splitext(file_name)
+    if extension.lower() not in COMPRESSION_EXTENSIONS:
+        csv_name = file_name
+    return csv_name if os.path.splitext(csv_name)[1].lower() == '.csv' else None
+
+
+def _open_file(file_path: str, mode: str = 'rb'):
+    """Opens a file for reading or appending bytes, decompressing or compressing it when its name ends with .gz or .zst
+    Arguments:
+        file_path: the path of the file
+        mode: 'rb' to read the file, or 'ab' to append to it
+    Return:
+        Returns the open binary file
+    Exceptions:
+        A RuntimeError is raised if the file is zstd compressed and the zstandard package isn't installed
+    """
+    # pylint: disable=consider-using-with
+    compression = COMPRESSION_EXTENSIONS.get(os.path.splitext(file_path)[1].lower())
+    if compression == 'gz':
+        return gzip.open(file_path, mode, compresslevel=GZIP_COMPRESS_LEVEL)
+    if compression == 'zst':
+        if zstandard is None:
+            raise RuntimeError('The zstandard package is needed for file %s' % file_path)
+        return zstandard.open(file_path, mode)
+    return open(file_path, mode, buffering=WRITE_BUFFER_SIZE if 'a' in mode else -1)
+
+
+def _has_contents(file_path: str) -> bool:
+    """Returns whether a file has any contents once it's decompressed; an empty compressed file isn't empty on disk
+    Arguments:
+        file_path: the path of the file
+    """
+    if not os.path.exists(file_path) or os.path.getsize(file_path) <= 0:
+        return False
+    if os.path.splitext(file_path)[1].lower() not in COMPRESSION_EXTENSIONS:
+        return True
+    with _open_file(file_path) as in_file:
+        return len(in_file.read(1)) > 0
+
+
+def _iter_text_blocks(in_file) -> Iterator[bytes]:
+    """Reads a binary file in large blocks, converting line endings to '\\n' the same as reading in text mode
+    Arguments:
+        in_file: the file to read (supports .read() as a binary file-like object)
+    Return:
+        Returns each block read
+    """
+    while True:
+        block = in_file.read(COPY_BLOCK_SIZE)
+        if not block:
+            return
+        if b'\r' in block:
+            # Make sure a '\r\n' split across blocks is seen as one line ending
+            while block.endswith(b'\r'):
+                next_byte = in_file.read(1)
+                if not next_byte:
+                    break
+                block += next_byte
+            block = block.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        yield block
+
+
+def _copy_csv_data(in_file, out_file, skip_lines: int) -> bool:
+    """Copies CSV data, skipping leading lines and making sure the data ends with a new line
+    Arguments:
+        in_file: the source file (supports .read() as a binary file-like object)
+        out_file: the destination file (supports .write() as a binary file-like object)
+        skip_lines: the number of lines to skip at the start of the source file
+    Return:
+        Returns True if any data was copied and False if not
+    """
+    last_byte = b''
+    for block in _iter_text_blocks(in_file):
+        # Skip over the headers, which may be spread over more than one block
+        while skip_lines > 0 and block:
+            line_end = block.find(b'\n')
+            if line_end < 0:
+                block = b''
+            else:
+                block = block[line_end + 1:]
+                skip_lines -= 1
+
+        if block:
+            out_file.write(block)
+            last_byte = block[-1:]
+
+    if last_byte and last_byte != b'\n':
+        out_file.write(b'\n')
+
+    return last_byte != b''
+
+
+def _iter_csv_records(blocks: Iterable[bytes]) -> Iterator[bytes]:
+    """Splits CSV data into records, keeping new lines that are within quoted values in their record
+    Arguments:
+        blocks: the blocks of CSV data, with '\\n' line endings
+    Return:
+        Returns each record, always ending with a new line
+    """
+    pending = b''
+    for block in blocks:
+        start = 0
+        while True:
+            line_end = block.find(b'\n', start)
+            if line_end < 0:
+                pending += block[start:]
+                break
+            pending += block[start:line_end + 1]
+            start = line_end + 1
+            # An odd number of quotes means the record continues on the next line
+            if pending.count(b'"') % 2 == 0:
+                yield pending
+                pending = b''
+
+    if pending:
+        yield pending if pending.endswith(b'\n') else pending + b'\n'
+
+
+def _parse_record(record: bytes) -> list:
+    """Returns the list of values in a CSV record
+    Arguments:
+        record: the record to parse
+    """
+    return next(csv.reader([record.decode('utf-8', errors='replace')]), [])
+
+
+def _get_column_indexes(columns: list, header: Optional[bytes], file_path: str) -> list:
+    """Finds where columns are in a file
+    Arguments:
+        columns: the list of columns to find; columns are names found in the header, or are numbered from 1 when
+                 there isn't a header
+        header: the first header line of the file, or None if the file doesn't have a header
+        file_path: the path of the file, for reporting problems
+    Return:
+        Returns the list of the indexes of the columns
+    Exceptions:
+        A RuntimeError is raised if a column can't be found
+    """
+    if header is not None:
+        column_names = _parse_record(header)
+        missing = [one_column for one_column in columns if one_column not in column_names]
+        if missing:
+            raise RuntimeError('Columns %s were not found in the header of file %s' % (str(missing), file_path))
+        return [column_names.index(one_column) for one_column in columns]
+
+    if not all(one_column.isdigit() and int(one_column) > 0 for one_column in columns):
+        raise RuntimeError('Columns must be numbered from 1 when files don\'t have headers')
+    return [int(one_column) - 1 for one_column in columns]
+
+
+def _get_key_function(key_columns: Optional[list], header: Optional[bytes], file_path: str) -> Callable:
+    """Returns the function for getting the bytes that identify a record
+    Arguments:
+        key_columns: the optional list of columns identifying records; whole records are used when not specified.
+                     Columns are names found in the header, or are numbered from 1 when there isn't a header
+        header: the first header line of the file, or None if the file doesn't have a header
+        file_path: the path of the file, for reporting problems
+    Return:
+        Returns the function that takes a record and returns the bytes identifying it
+    Exceptions:
+        A RuntimeError is raised if a key column can't be found
+    """
+    if not key_columns:
+        return lambda record: record.rstrip(b'\n')
+
+    indexes = _get_column_indexes(key_columns, header, file_path)
+
+    def get_key(record: bytes) -> bytes:
+        """Returns the key values of the record"""
+        values = _parse_record(record)
+        return '\x1f'.join(values[idx] if idx < len(values) else '' for idx in indexes).encode('utf-8')
+
+    return get_key
+
+
+class _SummaryStatistics:
+    """Calculates the count, mean, standard deviation, minimum and maximum of columns for each value of a key column,
+    one row at a time"""
+
+    def __init__(self, key_column: str, value_columns: list):
+        """Initializes the statistics
+        Arguments:
+            key_column: the column whose values the statistics are gathered for, such as the plot name
+            value_columns: the list of columns to calculate statistics of
+        """
+        self.key_column = key_column
+        self.value_columns = value_columns
+        # Each key has a list of count, mean, sum of squared differences from the mean, minimum, and maximum for each
+        # value column
+        self._statistics = {}
+
+    def get_indexes(self, header: Optional[bytes], file_path: str) -> list:
+        """Finds the key column and the value columns in a file
+        Arguments:
+            header: the first header line of the file, or None if the file doesn't have a header
+            file_path: the path of the file, for reporting problems
+        Return:
+            Returns the list of indexes of the key column followed by the value columns; value columns that aren't in
+            the file have an index of None
+        Exceptions:
+            A RuntimeError is raised if the key column can't be found
+        """
+        indexes = _get_column_indexes([self.key_column], header, file_path)
+        if header is None:
+            return indexes + _get_column_indexes(self.value_columns, None, file_path)
+        column_names = _parse_record(header)
+        return indexes + [column_names.index(one_column) if one_column in column_names else None
+                          for one_column in self.value_columns]
+
+    def add(self, values: list, indexes: list) -> None:
+        """Adds a row to the statistics; values that are empty or aren't numbers are skipped
+        Arguments:
+            values: the row's values
+            indexes: the indexes of the key column and value columns returned by get_indexes()
+        """
+        key = values[indexes[0]] if indexes[0] < len(values) else ''
+        statistics = self._statistics.get(key)
+        if statistics is None:
+            statistics = [[0, 0.0, 0.0, math.inf, -math.inf] for _ in self.value_columns]
+            self._statistics[key] = statistics
+
+        for column_statistics, idx in zip(statistics, indexes[1:]):
+            try:
+                value = float(values[idx])
+            except (IndexError, TypeError, ValueError):
+                continue
+            if math.isnan(value):
+                continue
+
+            # Welford's online update of the mean and variance
+            column_statistics[0] += 1
+            delta = value - column_statistics[1]
+            column_statistics[1] += delta / column_statistics[0]
+            column_statistics[2] += delta * (value - column_statistics[1])
+            column_statistics[3] = min(column_statistics[3], value)
+            column_statistics[4] = max(column_statistics[4], value)
+
+    def get_state(self) -> dict:
+        """Returns the state of the statistics, for saving and loading with set_state()"""
+        return {'key_column': self.key_column, 'value_columns': self.value_columns, 'statistics': self._statistics}
+
+    def set_state(self, state: dict) -> bool:
+        """Replaces the statistics with ones returned by get_state()
+        Arguments:
+            state: the state of the statistics
+        Return:
+            Returns True if the state is for the same columns and was loaded, and False if not
+        """
+        if state.get('key_column') != self.key_column or state.get('value_columns') != self.value_columns:
+            return False
+        self._statistics = state['statistics']
+        return True
+
+    def write(self, out_file) -> None:
+        """Writes the statistics as CSV, one row for each key in the order they were first seen
+        Arguments:
+            out_file: the file to write to (supports .write() as a text file-like object)
+        """
+        writer = csv.writer(out_file, lineterminator='\n')
+        writer.writerow([self.key_column] + ['%s_%s' % (one_column, one_name) for one_column in self.value_columns
+                                             for one_name in ('count', 'mean', 'std', 'min', 'max')])
+        for key, statistics in self._statistics.items():
+            row = [key]
+            for count, mean, squares, minimum, maximum in statistics:
+                if count:
+                    row.extend([count, mean, math.sqrt(squares / (count - 1)) if count > 1 else '', minimum, maximum])
+                else:
+                    row.extend([0, '', '', '', ''])
+            writer.writerow(row)
+
+
+class _RowIndex:
+    """Remembers the rows that have been seen using a limited amount of memory
+
+    Row hashes are kept in a set until the memory limit is reached. After that they're moved to a temporary SQLite
+    file and a Bloom filter using the memory limit is used to avoid looking up rows that haven't been seen before.
+    """
+
+    def __init__(self, memory_limit: int):
+        """Initializes the index
+        Arguments:
+            memory_limit: the approximate number of bytes of memory to use
+        """
+        self.memory_limit = memory_limit
+        self.max_entries = max(1, memory_limit // DEDUPE_ENTRY_SIZE)
+        self._hashes = set()
+        self._bloom = None
+        self._store = None
+        self._store_path = None
+
+    def add(self, key: bytes) -> bool:
+        """Adds a row to the index
+        Arguments:
+            key: the bytes identifying the row
+        Return:
+            Returns True if the row hasn't been seen before, and False if it has
+        """
+        return self.add_hash(hashlib.blake2b(key, digest_size=ROW_HASH_SIZE).digest())
+
+    def add_hash(self, row_hash: bytes) -> bool:
+        """Adds a row's hash to the index
+        Arguments:
+            row_hash: the hash of the row, as made by add()
+        Return:
+            Returns True if the row hasn't been seen before, and False if it has
+        """
+        if self._bloom is None:
+            if row_hash in self._hashes:
+                return False
+            self._hashes.add(row_hash)
+            if len(self._hashes) > self.max_entries:
+                self._spill()
+            return True
+
+        bits = self._bloom_bits(row_hash)
+        if all(self._bloom[one_bit >> 3] & (1 << (one_bit & 7)) for one_bit in bits):
+            # Possibly seen before, check for certain
+            if self._store.execute('SELECT 1 FROM rows WHERE hash=?', (row_hash,)).fetchone():
+                return False
+        for one_bit in bits:
+            self._bloom[one_bit >> 3] |= 1 << (one_bit & 7)
+        self._store.execute('INSERT INTO rows (hash) VALUES (?)', (row_hash,))
+        return True
+
+    def _bloom_bits(self, row_hash: bytes) -> list:
+        """Returns the Bloom filter bits of a row hash
+        Arguments:
+            row_hash: the hash of the row
+        """
+        num_bits = len(self._bloom) * 8
+        first = int.from_bytes(row_hash[:8], 'little')
+        second = int.from_bytes(row_hash[8:], 'little') | 1
+        return [(first + idx * second) % num_bits for idx in range(BLOOM_HASH_COUNT)]
+
+    def _spill(self) -> None:
+        """Moves the row hashes to a temporary file and switches to using the Bloom filter"""
+        store_handle, self._store_path = tempfile.mkstemp(prefix='merge_csv_', suffix='.sqlite')
+        os.close(store_handle)
+        self._store = sqlite3.connect(self._store_path)
+        self._store.execute('PRAGMA journal_mode=OFF')
+        self._store.execute('PRAGMA synchronous=OFF')
+        self._store.execute('CREATE TABLE rows (hash BLOB PRIMARY KEY) WITHOUT ROWID')
+
+        self._bloom = bytearray(self.memory_limit)
+        for row_hash in self._hashes:
+            for one_bit in self._bloom_bits(row_hash):
+                self._bloom[one_bit >> 3] |= 1 << (one_bit & 7)
+        self._store.executemany('INSERT INTO rows (hash) VALUES (?)', ((row_hash,) for row_hash in self._hashes))
+        self._hashes = set()
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Returns the hashes of the rows in the index"""
+        if self._store is None:
+            return iter(self._hashes)
+        return (one_row[0] for one_row in self._store.execute('SELECT hash FROM rows'))
+
+    def close(self) -> None:
+        """Releases the index and removes any temporary file"""
+        self._hashes = set()
+        self._bloom = None
+        if self._store is not None:
+            self._store.close()
+            os.unlink(self._store_path)
+            self._store = None
+
+
+#  The reader stands in for a file and only needs its read() method, so we silence pylint
+class _HashingReader:  # pylint: disable=too-few-public-methods
+    """Hashes the contents of a file as it's read"""
+
+    def __init__(self, in_file):
+        """Initializes the reader
+        Arguments:
+            in_file: the file to read (supports .read() as a binary file-like object)
+        """
+        self.in_file = in_file
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        """Reads from the file
+        Arguments:
+            size: the maximum number of bytes to read; everything remaining is read when negative
+        Return:
+            Returns the bytes read
+        """
+        data = self.in_file.read(size)
+        self.hash.update(data)
+        return data
+
+
+def _hash_file(file_path: str) -> str:
+    """Returns the SHA-256 of a file's contents as a hex string, after decompressing it
+    Arguments:
+        file_path: the path of the file
+    """
+    hasher = hashlib.sha256()
+    with _open_file(file_path) as in_file:
+        for block in iter(lambda: in_file.read(COPY_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _get_sort_key_function(sort_columns: list, header: Optional[bytes], file_path: str) -> Callable:
+    """Returns the function for getting the sort key of a record's values
+    Arguments:
+        sort_columns: the list of columns to sort by; columns are names found in the header, or are numbered from 1
+                      when there isn't a header
+        header: the first header line of the file, or None if the file doesn't have a header
+        file_path: the path of the file, for reporting problems
+    Return:
+        Returns the function that takes a record's values and returns its sort key
+    Exceptions:
+        A RuntimeError is raised if a sort column can't be found
+    """
+    indexes = _get_column_indexes(sort_columns, header, file_path)
+
+    def get_sort_key(values: list) -> tuple:
+        """Returns the sort key of the values, with numbers sorted numerically before other values"""
+        key = []
+        for idx in indexes:
+            value = values[idx] if idx < len(values) else ''
+            try:
+                key.append((0, float(value), ''))
+            except ValueError:
+                key.append((1, 0.0, value))
+        return tuple(key)
+
+    return get_sort_key
+
+
+def _format_record(values: list) -> bytes:
+    """Formats values as a CSV record
+    Arguments:
+        values: the values to format
+    Return:
+        Returns the record, ending with a new line
+    """
+    record = io.StringIO()
+    csv.writer(record, lineterminator='\n').writerow(values)
+    return record.getvalue().encode('utf-8')
+
+
+# The settings for leaving out rows that are already in the merged file: the optional list of columns that identify
+# rows (whole rows are compared when None), and the approximate number of bytes of memory to use
+_DedupeOptions = collections.namedtuple('_DedupeOptions', ['key_columns', 'memory'], defaults=(None, DEDUPE_MEMORY))
+
+# The settings for writing a Parquet file instead of a CSV file: the list of all the columns in the files (files
+# without headers have columns named column_1, column_2, and so on), the optional dict of column names and their type
+# names, and the number of rows in each row group
+_ParquetOptions = collections.namedtuple('_ParquetOptions', ['columns', 'column_types', 'row_group_size'],
+                                         defaults=(None, parquet_table.ROW_GROUP_SIZE))
+
+# The settings for calculating summary statistics: the key column, and the list of value columns to calculate the
+# statistics of for each key value
+_AggregateOptions = collections.namedtuple('_AggregateOptions', ['key_column', 'value_columns'])
+
+# The settings for sorting merged files: the list of columns to sort by, and the approximate number of bytes of memory
+# to use
+_SortOptions = collections.namedtuple('_SortOptions', ['columns', 'memory'], defaults=(SORT_MEMORY,))
+
+# The settings of merged files. A manifest of the merged source files is kept next to incremental merged files so that
+# later merges only add new and changed files, and it records the SHA-256 of each source file with hash_sources so
+# that files which were only touched aren't merged again. The dedupe, parquet, aggregate and sort settings are None
+# when they're not used
+_DestinationOptions = collections.namedtuple('_DestinationOptions',
+                                             ['incremental', 'hash_sources', 'header_count', 'dedupe', 'parquet',
+                                              'aggregate', 'sort'],
+                                             defaults=(False, False, 1, None, None, None, None))
+
+
+class _RowWriter:
+    """Merges files row by row to leave out duplicate rows, calculate summary statistics, sort the rows, or write a
+    Parquet file"""
+
+    def __init__(self, path: str, options: _DestinationOptions):
+        """Initializes the writer
+        Arguments:
+            path: the path of the merged file
+            options: the settings of the merged file
+        """
+        self.path = path
+        self.options = options
+        self.row_index = _RowIndex(options.dedupe.memory) if options.dedupe else None
+        self.rows_dropped = 0
+        self.summary = _SummaryStatistics(*options.aggregate) if options.aggregate else None
+        self.table = parquet_table.ParquetTable(path, *options.parquet) if options.parquet else None
+        self.sorter = external_sort.ExternalSorter(options.sort.memory) if options.sort else None
+
+    @staticmethod
+    def is_needed(options: _DestinationOptions) -> bool:
+        """Checks if the settings need files to be merged row by row, instead of copying their contents
+        Arguments:
+            options: the settings of the merged file
+        """
+        return any((options.dedupe, options.parquet, options.aggregate, options.sort))
+
+    @property
+    def writes_file(self) -> bool:
+        """Returns True if rows are written to the merged file as they're merged, and False if the file is written
+        when merging is finished"""
+        return self.table is None and self.sorter is None
+
+    @property
+    def key_columns(self) -> Optional[list]:
+        """Returns the columns that identify rows when removing duplicates, or None if whole rows are compared"""
+        return self.options.dedupe.key_columns if self.options.dedupe else None
+
+    @property
+    def summary_path(self) -> str:
+        """Returns the path of the summary statistics file"""
+        name = os.path.basename(self.path)
+        if os.path.splitext(name)[1].lower() in COMPRESSION_EXTENSIONS:
+            name = os.path.splitext(name)[0]
+        return os.path.join(os.path.dirname(self.path), os.path.splitext(name)[0] + SUMMARY_SUFFIX)
+
+    @property
+    def summary_state_path(self) -> str:
+        """Returns the path of the saved state of the summary statistics"""
+        return self.summary_path[:-len(SUMMARY_SUFFIX)] + SUMMARY_STATE_SUFFIX
+
+    @property
+    def dedupe_state_path(self) -> str:
+        """Returns the path of the saved hashes of the rows in the merged file"""
+        return self.path + DEDUPE_STATE_SUFFIX
+
+    def _load_summary_state(self) -> bool:
+        """Loads the saved state of the summary statistics
+        Return:
+            Returns True if the state was loaded, and False if there isn't one for the merged file as it is now
+        """
+        try:
+            with open(self.summary_state_path, 'r', encoding='utf-8') as in_file:
+                state = json.load(in_file)
+        except (OSError, ValueError):
+            return False
+        if state.get('version') != STATE_VERSION or state.get('target_size') != os.path.getsize(self.path):
+            return False
+        return self.summary.set_state(state)
+
+    def _load_dedupe_state(self) -> bool:
+        """Loads the saved hashes of the rows in the merged file into the index of rows seen
+        Return:
+            Returns True if the hashes were loaded, and False if there aren't any for the merged file as it is now
+        """
+        try:
+            with open(self.dedupe_state_path, 'rb') as in_file:
+                state = json.loads(in_file.readline())
+                if state.get('version') != STATE_VERSION or state.get('target_size') != os.path.getsize(self.path) \
+                        or state.get('key_columns') != self.key_columns:
+                    return False
+                while True:
+                    hashes = in_file.read(ROW_HASH_SIZE * 4096)
+                    if not hashes:
+                        return True
+                    for offset in range(0, len(hashes), ROW_HASH_SIZE):
+                        self.row_index.add_hash(hashes[offset:offset + ROW_HASH_SIZE])
+        except (OSError, ValueError, AttributeError):
+            return False
+
+    def _save_states(self) -> None:
+        """Saves the state of the summary statistics and the hashes of the rows seen, for the next merge"""
+        if not os.path.exists(self.path) or self.table is not None:
+            return
+        target_size = os.path.getsize(self.path)
+        if self.summary is not None:
+            state = dict(self.summary.get_state(), version=STATE_VERSION, target_size=target_size)
+            file_utils.write_file_atomically(self.summary_state_path, lambda out_file: json.dump(state, out_file))
+
+        if self.row_index is not None:
+            def write_hashes(out_file) -> None:
+                """Writes the state followed by the row hashes"""
+                state = {'version': STATE_VERSION, 'target_size': target_size, 'key_columns': self.key_columns}
+                out_file.write(json.dumps(state).encode('utf-8') + b'\n')
+                for one_hash in self.row_index:
+                    out_file.write(one_hash)
+            file_utils.write_file_atomically(self.dedupe_state_path, write_hashes, 'wb')
+
+    def read_existing(self) -> None:
+        """Adds the rows already in the merged file to the index of rows seen, the summary statistics, and the rows
+        to sort; the saved state is used instead of reading the merged file when it's up to date"""
+        read_index = self.row_index is not None and not self._load_dedupe_state()
+        read_summary = self.summary is not None and not self._load_summary_state()
+        if not read_index and not read_summary and self.sorter is None:
+            return
+
+        with _open_file(self.path) as in_file:
+            records = _iter_csv_records(_iter_text_blocks(in_file))
+            headers = list(itertools.islice(records, self.options.header_count))
+            header = headers[0] if headers else None
+            get_key = _get_key_function(self.key_columns, header, self.path)
+            summary_indexes = self.summary.get_indexes(header, self.path) if read_summary else None
+            get_sort_key = _get_sort_key_function(self.options.sort.columns, header, self.path) if self.sorter \
+                else None
+            if self.sorter is not None:
+                self.sorter.headers = headers
+            for one_record in records:
+                if read_index:
+                    self.row_index.add(get_key(one_record))
+                values = _parse_record(one_record) if read_summary or self.sorter is not None else None
+                if read_summary:
+                    self.summary.add(values, summary_indexes)
+                if self.sorter is not None:
+                    self.sorter.add(get_sort_key(values), one_record)
+
+    def write_headers(self, headers: list, out_file) -> bool:
+        """Writes the headers of the first file merged into a new CSV file, ahead of the sorted rows when sorting
+        Arguments:
+            headers: the header records of the file
+            out_file: the merged file, when it's written as rows are merged
+        Return:
+            Returns True if the headers were written, and False if there aren't any or they aren't used
+        """
+        if not headers or self.table is not None:
+            return False
+        if self.sorter is not None:
+            self.sorter.headers = headers
+        else:
+            out_file.write(b''.join(headers))
+        return True
+
+    def _get_write_function(self, headers: list, source_path: str, out_file) -> Callable:
+        """Returns the function for writing a row of a source file to the Parquet table, the rows to sort, or the
+        merged file
+        Arguments:
+            headers: the header records of the source file
+            source_path: the path of the source file
+            out_file: the merged file, when it's written as rows are merged
+        Return:
+            Returns the function that takes a record and its values, which are None when they're not needed
+        """
+        header = headers[0] if headers else None
+        get_sort_key = _get_sort_key_function(self.options.sort.columns, header, source_path) if self.sorter \
+            else None
+        if self.table is None:
+            if self.sorter is None:
+                return lambda record, _: out_file.write(record)
+            return lambda record, values: self.sorter.add(get_sort_key(values), record)
+
+        # Find where each Parquet column is in the file
+        if headers:
+            file_columns = _parse_record(header)
+            positions = [file_columns.index(one_column) if one_column in file_columns else None
+                         for one_column in self.table.columns]
+        else:
+            positions = list(range(len(self.table.columns)))
+
+        def write_table_row(_, values: list) -> None:
+            """Writes the values of the Parquet columns"""
+            row = [values[idx] if idx is not None and idx < len(values) else '' for idx in positions]
+            if self.sorter is not None:
+                # Sorted Parquet rows are kept in the table's column order
+                self.sorter.add(get_sort_key(values), _format_record(row))
+            else:
+                self.table.add_row(row)
+
+        return write_table_row
+
+    def write_rows(self, records: Iterator[bytes], headers: list, source_path: str, out_file) -> bool:
+        """Writes the rows of a source file that are wanted
+        Arguments:
+            records: the rows of the source file following its headers
+            headers: the header records of the source file
+            source_path: the path of the source file
+            out_file: the merged file, when it's written as rows are merged
+        Return:
+            Returns True if any rows were written, and False if not
+        """
+        header = headers[0] if headers else None
+        get_key = _get_key_function(self.key_columns, header, source_path) if self.row_index is not None else None
+        summary_indexes = self.summary.get_indexes(header, source_path) if self.summary is not None else None
+        write_row = self._get_write_function(headers, source_path, out_file)
+        need_values = not self.writes_file or self.summary is not None
+
+        written = False
+        for one_record in records:
+            if get_key is not None and not self.row_index.add(get_key(one_record)):
+                self.rows_dropped += 1
+                continue
+            values = _parse_record(one_record) if need_values else None
+            if self.summary is not None:
+                self.summary.add(values, summary_indexes)
+            write_row(one_record, values)
+            written = True
+
+        return written
+
+    def _write_sorted(self) -> None:
+        """Writes the sorted rows, replacing the merged file"""
+        try:
+            if self.table is not None:
+                for one_record in self.sorter:
+                    self.table.add_row(_parse_record(one_record))
+                return
+
+            # Write a new file compressed the same way as the merged file, and then replace the merged file
+            temp_handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.merge_',
+                                                      suffix=os.path.splitext(self.path)[1])
+            os.close(temp_handle)
+            try:
+                with _open_file(temp_path, 'ab') as out_file:
+                    for one_record in self.sorter:
+                        out_file.write(one_record)
+                os.replace(temp_path, self.path)
+            except Exception:
+                os.unlink(temp_path)
+                raise
+        finally:
+            self.sorter.close()
+
+    def finish(self) -> None:
+        """Writes the sorted rows and the Parquet file, and saves the summary statistics and the state for the next
+        merge"""
+        if self.sorter is not None:
+            self._write_sorted()
+        if self.table is not None:
+            self.table.close()
+            print("Wrote %d rows to %s" % (self.table.num_rows, self.path))
+        self._save_states()
+        if self.row_index is not None:
+            self.row_index.close()
+            if self.rows_dropped:
+                print("Dropped %d duplicate rows from %s" % (self.rows_dropped, self.path))
+        if self.summary is not None:
+            file_utils.write_file_atomically(self.summary_path, self.summary.write)
+            print("Wrote summary statistics to %s" % self.summary_path)
+
+
+class _Destination:
+    """A merged CSV file"""
+
+    def __init__(self, path: str, options: _DestinationOptions = _DestinationOptions()):
+        """Initializes the destination
+        Arguments:
+            path: the path of the merged file
+            options: the settings of the merged file
+        """
+        self.path = path
+        self.options = options
+        self.rows = _RowWriter(path, options) if _RowWriter.is_needed(options) else None
+        # An existing CSV file already has its headers, Parquet files are replaced
+        self.has_headers = options.parquet is None and _has_contents(path)
+        self.file = None
+        self.manifest = self._load_manifest() if options.incremental else None
+        self._manifest_changed = False
+        if self.has_headers and self.rows is not None:
+            self.rows.read_existing()
+
+    @property
+    def uses_rows(self) -> bool:
+        """Returns True if the files need to be merged row by row, instead of copying their contents"""
+        return self.rows is not None
+
+    def write_rows(self, records: Iterator[bytes], headers: list, source_path: str) -> bool:
+        """Writes the rows of a source file that are wanted, and its headers if the merged file doesn't have any
+        Arguments:
+            records: the rows of the source file following its headers
+            headers: the header records of the source file
+            source_path: the path of the source file
+        Return:
+            Returns True if anything was written, and False if not
+        """
+        written = not self.has_headers and self.rows.write_headers(headers, self.file)
+        return self.rows.write_rows(records, headers, source_path, self.file) or written
+
+    @property
+    def manifest_path(self) -> str:
+        """Returns the path of the manifest of merged source files"""
+        return self.path + MANIFEST_SUFFIX
+
+    def _load_manifest(self) -> dict:
+        """Loads the dict of merged source files from the manifest
+        Return:
+            Returns the dict of source file paths with their size, modification time, and optional SHA-256. An empty
+            dict is returned when there isn't a manifest, or the merged file has changed since the manifest was saved
+        """
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as in_file:
+                manifest = json.load(in_file)
+        except (OSError, ValueError):
+            return {}
+
+        target_size = os.path.getsize(self.path) if os.path.exists(self.path) else None
+        if manifest.get('version') != MANIFEST_VERSION or manifest.get('target_size') != target_size:
+            print("Ignoring out of date manifest %s" % self.manifest_path)
+            return {}
+        return manifest['sources']
+
+    def is_merged(self, source_path: str, source_stat: os.stat_result) -> bool:
+        """Checks the manifest for a source file that's already merged and hasn't changed since
+        Arguments:
+            source_path: the path of the source file
+            source_stat: the file system information on the source file
+        Return:
+            Returns True if the file was already merged, and False if not
+        """
+        entry = self.manifest.get(source_path)
+        if not entry or entry['size'] != source_stat.st_size:
+            return False
+        if entry['mtime_ns'] == source_stat.st_mtime_ns:
+            return True
+
+        # Check the contents of files that have been touched
+        if self.options.hash_sources and entry.get('sha256') and entry['sha256'] == _hash_file(source_path):
+            entry['mtime_ns'] = source_stat.st_mtime_ns
+            self._manifest_changed = True
+            return True
+        return False
+
+    def add_merged(self, source_path: str, source_stat: os.stat_result, sha256: str = None) -> None:
+        """Records a merged source file in the manifest
+        Arguments:
+            source_path: the path of the source file
+            source_stat: the file system information on the source file from before it was merged
+            sha256: optional hex SHA-256 of the source file's contents
+        """
+        self.manifest[source_path] = {'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns}
+        if sha256:
+            self.manifest[source_path]['sha256'] = sha256
+        self._manifest_changed = True
+
+    def open(self):
+        """Opens the merged file for appending if it's not already open
+        Return:
+            Returns the open binary file, or None when writing a Parquet file or sorting; these files are written when
+            merging is finished
+        """
+        if self.file is None and (self.rows is None or self.rows.writes_file):
+            self.file = _open_file(self.path, 'ab')
+        return self.file
+
+    def close(self) -> None:
+        """Flushes and closes the merged file if it's open"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def finish(self) -> None:
+        """Closes the merged file and saves the summary statistics, the state for the next merge, and the manifest"""
+        self.close()
+        if self.rows is not None:
+            self.rows.finish()
+
+        if self.manifest is None or not self._manifest_changed:
+            return
+
+        manifest = {'version': MANIFEST_VERSION, 'target_size': os.path.getsize(self.path), 'sources': self.manifest}
+        file_utils.write_file_atomically(self.manifest_path, lambda out_file: json.dump(manifest, out_file, indent=1))
+        self._manifest_changed = False
+
+
+class _DestinationPool:
+    """Keeps the most recently used merged files open while merging"""
+
+    def __init__(self, max_open: int = MAX_OPEN_DESTINATIONS, options: _DestinationOptions = _DestinationOptions()):
+        """Initializes the pool
+        Arguments:
+            max_open: the maximum number of merged files to keep open at one time
+            options: the settings of each merged file
+        """
+        self.max_open = max_open
+        self.options = options
+        self.destinations = {}
+        self._open = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, path: str) -> _Destination:
+        """Returns a destination with its file open, closing the least recently used file if too many are open
+        Arguments:
+            path: the path of the merged file
+        Return:
+            Returns the destination
+        """
+        destination = self.destinations.get(path)
+        if destination is None:
+            destination = _Destination(path, self.options)
+            self.destinations[path] = destination
+
+        if path in self._open:
+            self._open.move_to_end(path)
+        else:
+            while len(self._open) >= self.max_open:
+                self._open.popitem(last=False)[1].close()
+            destination.open()
+            self._open[path] = destination
+
+        return destination
+
+    def close(self) -> None:
+        """Flushes and closes all the merged files, in the order they were first used"""
+        for destination in self.destinations.values():
+            destination.finish()
+        self._open.clear()
+
+
+def _merge_csv(source_path: str, destination: _Destination, has_headers: bool = True, header_count: int = 1) -> bool:
+    """Merges the source CSV file into the destination CSV file
     Arguments:
         source_path: path to the source CSV file
-        target_path: path of CSV file to merge into
+        destination: the destination to merge into, with its file open
         has_headers: source files have headers when set to True, otherwise there's no headers
         header_count: the number of header lines in the source file
+    Return:
+        Returns True if the file was merged, and False if it was skipped because the manifest shows it's already merged
     """
-    have_dest_file = os.path.exists(target_path)
-    skip_lines = header_count if has_headers and have_dest_file else 0
-
-    # Read in the lines and append to the output file
-    with open(target_path, 'a', encoding='utf-8') as out_file:
-        print("Merging: ", source_path)
-        with open(source_path, 'r', encoding='utf-8') as infile:
-            # Read in a line, return if everything was read and skip over headers
-            one_line = infile.readline()
-            while one_line:
-                if skip_lines <= 0:
-                    # Write to the output file
-                    if not one_line.endswith('\n'):
-                        one_line = one_line + '\n'
-                    out_file.write(one_line)
-                else:
-                    skip_lines -= 1
+    source_stat = None
+    if destination.manifest is not None:
+        source_stat = os.stat(source_path)
+        if destination.is_merged(source_path, source_stat):
+            return False
+
+    with _open_file(source_path) as in_file:
+        reader = _HashingReader(in_file) if source_stat and destination.options.hash_sources else in_file
+        if destination.uses_rows:
+            records = _iter_csv_records(_iter_text_blocks(reader))
+            headers = list(itertools.islice(records, header_count if has_headers else 0))
+            written = destination.write_rows(records, headers, source_path)
+        else:
+            # Copy the data in blocks instead of line by line
+            skip_lines = header_count if has_headers and destination.has_headers else 0
+            written = _copy_csv_data(reader, destination.file, skip_lines)
+        if written:
+            destination.has_headers = True
 
-                # Read in the next line
-                one_line = infile.readline()
+    if source_stat:
+        destination.add_merged(source_path, source_stat, reader.hash.hexdigest() if reader is not in_file else None)
+    return True
 
 
-def _path_in_ignore_dirs(source_path: str, ignore_dirs: list) -> bool:
-    """Checks if the source path is to be ignored using a case sensitive match
+def _glob_to_regex(pattern: str) -> str:
+    """Converts a glob pattern of a single folder name to a regular expression
     Arguments:
-        source_path: the path to check
-        ignore_dirs: the list of directories to ignore
+        pattern: the pattern to convert; '*', '?' and '[...]' are supported
     Return:
-        Returns True if the path is to be ignored, and False if not
+        Returns the regular expression of the pattern, which doesn't match across path separators
     """
-    # Break apart the source path for later checking
-    if '/' in source_path:
-        source_parts = source_path.split('/')
-        test_join_char = '/'
-    elif '\\' in source_path:
-        source_parts = source_path.split('\\')
-        test_join_char = '\\'
-    else:
-        source_parts = [source_path]
-        test_join_char = '/'
+    regex = []
+    idx = 0
+    while idx < len(pattern):
+        one_char = pattern[idx]
+        idx += 1
+        # A ']' immediately after the opening '[' (or '[!') is part of the set
+        set_end = pattern.find(']', idx + 2 if pattern[idx:idx + 1] == '!' else idx + 1)
+        if one_char == '*':
+            regex.append('[^/]*')
+        elif one_char == '?':
+            regex.append('[^/]')
+        elif one_char == '[' and set_end >= 0:
+            char_set = pattern[idx:set_end].replace('\\', '\\\\')
+            if char_set.startswith('!'):
+                char_set = '^' + char_set[1:]
+            regex.append('[' + char_set + ']')
+            idx = set_end + 1
+        else:
+            regex.append(re.escape(one_char))
+    return ''.join(regex)
 
+
+def compile_ignore_dirs(ignore_dirs: list) -> Optional[Callable[[str], bool]]:
+    """Prepares a case sensitive matcher of the folders to ignore
+    Arguments:
+        ignore_dirs: the list of folder names, or partial paths, to ignore; each name in a path can be a glob pattern
+                     (eg: bad_folder, path/ignore, plot_*/tmp)
+    Return:
+        Returns a function that returns True if a path is to be ignored and False if not, or None if there aren't any
+        folders to ignore
+    Notes:
+        Only whole names in a path are matched; 'test' matches '/data/test/1' but not '/data/testing/1'
+    """
+    patterns = []
     for one_dir in ignore_dirs:
-        # Check for multiple folders
-        if '/' in one_dir:
-            dir_parts = one_dir.split('/')
-        elif '\\' in one_dir:
-            dir_parts = one_dir.split('\\')
-        else:
-            dir_parts = [one_dir]
+        one_dir = one_dir.strip().replace('\\', '/')
+        if one_dir:
+            patterns.append('/'.join(_glob_to_regex(one_part) for one_part in one_dir.split('/')))
+    if not patterns:
+        return None
 
-        # See if the entire path to check is to be found
-        if test_join_char.join(dir_parts) not in source_path:
-            continue
+    matcher = re.compile('(?:^|/)(?:' + '|'.join(patterns) + ')(?:/|$)')
+    if os.sep == '/':
+        return lambda path: matcher.search(path) is not None
+    return lambda path: matcher.search(path.replace(os.sep, '/')) is not None
 
-        # Check path particles to ensure the entire path names match and not just parts of path names
-        # 'test' vs. 'testing' for example
-        parts_matched = 0
-        for one_part in dir_parts:
-            if one_part not in source_parts:
-                break
-            parts_matched += 1
-        if parts_matched == len(dir_parts):
-            return True
 
-    return False
+def _scan_dir(dir_path: str, root_len: int, is_ignored_dir: Optional[Callable[[str], bool]]) -> tuple:
+    """Lists the contents of a folder
+    Arguments:
+        dir_path: the folder to list
+        root_len: the length of the starting folder's path, which is left off the paths that are checked for ignoring
+        is_ignored_dir: optional function returning True for sub-folders that are to be skipped
+    Return:
+        Returns a tuple of the list of file paths and the list of sub-folder paths
+    """
+    files = []
+    sub_dirs = []
+    with os.scandir(dir_path) as entries:
+        for one_entry in entries:
+            # The entry type is usually returned with the listing, saving a stat of every entry
+            if one_entry.is_dir():
+                if is_ignored_dir is None or not is_ignored_dir(one_entry.path[root_len:]):
+                    sub_dirs.append(one_entry.path)
+            else:
+                files.append(one_entry.path)
+    return files, sub_dirs
+
+
+def find_source_files(source_folder: str, is_ignored_dir: Optional[Callable[[str], bool]] = None,
+                      num_threads: int = 0) -> Iterator[str]:
+    """Walks the folder tree breadth first, returning the files found
+    Arguments:
+        source_folder: the folder to start in
+        is_ignored_dir: optional function returning True for folders that are to be skipped, along with everything
+                        under them; it's called with the part of the path below the source folder
+        num_threads: the number of threads for listing the folders of each level of the tree at the same time; the
+                     folders are listed one at a time when 0
+    Return:
+        Returns the path of each file found, in the same order whether or not threads are used
+    """
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if num_threads > 0:
+            executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=num_threads))
+
+        root_len = len(os.path.join(source_folder, ''))
+        check_dirs = [source_folder]
+        while check_dirs:
+            if executor:
+                listings = executor.map(lambda dir_path: _scan_dir(dir_path, root_len, is_ignored_dir), check_dirs)
+            else:
+                listings = (_scan_dir(dir_path, root_len, is_ignored_dir) for dir_path in check_dirs)
+
+            next_dirs = []
+            for files, sub_dirs in listings:
+                yield from files
+                next_dirs.extend(sub_dirs)
+            check_dirs = next_dirs
 
 
 def get_arg_parser() -> argparse.ArgumentParser:
@@ -107,60 +1150,308 @@ def get_arg_parser() -> argparse.ArgumentParser:
     parser.add_argument('--header-count', '-c', type=int, default=1, help='number of header lines in files')
     parser.add_argument('--filter', '-f', help='comma separated list of files to filter in')
     parser.add_argument('--ignore', '-i', help='comma separated list of files to ignore')
-    parser.add_argument('--ignore-dirs', help='comma separated list of directory names to ignore (eg: bad_folder, path/ignore)')
+    parser.add_argument('--ignore-dirs', help='comma separated list of directory names to ignore, glob patterns are '
+                        'supported (eg: bad_folder, path/ignore, plot_*/tmp)')
+    parser.add_argument('--walk-threads', type=int, default=0,
+                        help='number of folders to list at the same time to hide network file system latency')
     parser.add_argument('--output-file', help='merge all CSV files into this one file')
+    parser.add_argument('--max-open-files', type=int, default=MAX_OPEN_DESTINATIONS,
+                        help='maximum number of merged files to keep open at one time')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep a manifest of the merged files next to each merged file and only merge files that '
+                        'are new or changed since the last merge')
+    parser.add_argument('--hash-sources', action='store_true',
+                        help='record the SHA-256 of each file in the --incremental manifest so that files which are '
+                        'only touched are not merged again')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='leave out rows that are already in the merged file')
+    parser.add_argument('--dedupe-key',
+                        help='comma separated list of the columns identifying a row when removing duplicates, instead '
+                        'of the whole row; columns are numbered from 1 when files do not have headers')
+    parser.add_argument('--dedupe-memory', type=float, default=DEDUPE_MEMORY / (1024 * 1024),
+                        help='megabytes of memory to use for finding duplicate rows in each merged file; a temporary '
+                        'file is used for checking rows beyond this')
+    parser.add_argument('--aggregate', nargs=2, metavar=('key=col', 'values=col[,col...]'),
+                        help='calculate the count, mean, standard deviation, minimum and maximum of the value columns '
+                        'for each value of the key column while merging, and save them next to each merged file')
+    parser.add_argument('--sort-by', metavar='col[,col...]',
+                        help='sort the rows of each merged file by these columns, including any rows already in the '
+                        'file; columns are numbered from 1 when files do not have headers')
+    parser.add_argument('--sort-memory', type=float, default=SORT_MEMORY / (1024 * 1024),
+                        help='megabytes of memory to use for sorting each merged file; sorted rows are written to '
+                        'temporary files beyond this')
+    parser.add_argument('--compress', choices=sorted(set(COMPRESSION_EXTENSIONS.values())),
+                        help='compress the merged CSV files with gzip or zstd (the zstandard package is needed for '
+                        'zstd)')
+    parser.add_argument('--output-format', choices=['csv', 'parquet'], default='csv',
+                        help='write merged CSV files, or Parquet files with all the columns found in the CSV files '
+                        '(the pyarrow package is needed for Parquet)')
+    parser.add_argument('--column-types',
+                        help='comma separated list of Parquet column types as name:type where type is one of ' +
+                        ', '.join(parquet_table.COLUMN_TYPES) + '; other column types are found from the first rows')
+    parser.add_argument('--row-group-size', type=int, default=parquet_table.ROW_GROUP_SIZE,
+                        help='number of rows in each Parquet row group')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of merged files to write at the same time, each in its own process')
     parser.add_argument('source_folder', type=dir_type, help='the folder to search in')
     parser.add_argument('target_folder', type=dir_type, help='folder for combined CSV files')
 
     return parser
 
 
-def merge():
-    """Discovers and merges CSV files
+def _iter_merge_files(args: argparse.Namespace) -> Iterator[tuple]:
+    """Finds the CSV files to merge
+    Arguments:
+        args: the command line arguments
+    Return:
+        Returns a tuple of the path of each source file and the path of the file it's merged into
     """
-    args = get_arg_parser().parse_args()
-
     # Prepare any filters for inclusion or exclusion
-    have_headers = not args.no_header
     includes = [one_name.strip() for one_name in args.filter.split(',')] if args.filter else []
     excludes = [one_name.strip() for one_name in args.ignore.split(',')] if args.ignore else []
-    ignore_dirs = args.ignore_dirs.split(',') if args.ignore_dirs else []
-
-    # Loop through the folders until we run out of folders to process
-    # This list only contains complete paths
-    check_dirs = [os.path.realpath(args.source_folder)]
-    while check_dirs:
-        next_dir = check_dirs.pop(0)
-        for one_file in os.listdir(next_dir):
-            source_path = os.path.join(next_dir, one_file)
-
-            # If it's a folder, save it for recursion
-            if os.path.isdir(source_path):
-                if not ignore_dirs or not _path_in_ignore_dirs(source_path, ignore_dirs):
-                    check_dirs.append(source_path)
-                continue
+    is_ignored_dir = compile_ignore_dirs(args.ignore_dirs.split(',')) if args.ignore_dirs else None
 
-            # Ignore non-CSV files
-            if os.path.splitext(one_file)[1].lower() != '.csv':
-                continue
+    for source_path in find_source_files(os.path.realpath(args.source_folder), is_ignored_dir, args.walk_threads):
+        one_file = os.path.basename(source_path)
+
+        # Ignore non-CSV files, and compressed CSV files that can't be read
+        csv_name = _get_csv_name(one_file)
+        if not csv_name:
+            continue
+        if zstandard is None and one_file.lower().endswith('.zst'):
+            print("Skipping %s: the zstandard package is needed to read it" % source_path)
+            continue
 
-            # Get the target path and see if the source and destination are the same
-            dest_file = os.path.basename(one_file) if not args.output_file else args.output_file
-            dest_path = os.path.join(args.target_folder, dest_file)
-            if dest_path.lower() == source_path.lower():
+        # Get the target path and see if the source and destination are the same
+        dest_file = csv_name if not args.output_file else args.output_file
+        if args.output_format == 'parquet' and not args.output_file:
+            dest_file = os.path.splitext(dest_file)[0] + '.parquet'
+        if args.compress and not dest_file.lower().endswith('.' + args.compress):
+            dest_file += '.' + args.compress
+        dest_path = os.path.join(args.target_folder, dest_file)
+        if dest_path.lower() == source_path.lower():
+            continue
+
+        # Skip over any file not included or explicitly excluded, with or without any compression extension
+        if includes:
+            if one_file not in includes and csv_name not in includes:
+                continue
+        if excludes:
+            if one_file in excludes or csv_name in excludes:
                 continue
 
-            # Skip over any file not included or explicitly excluded
-            if includes:
-                if one_file not in includes:
-                    continue
-            if excludes:
-                if one_file in excludes:
-                    continue
+        yield source_path, dest_path
+
+
+def _get_destination_options(args: argparse.Namespace) -> _DestinationOptions:
+    """Returns the settings of the merged files from the command line arguments
+    Arguments:
+        args: the command line arguments
+    Notes:
+        The Parquet columns aren't known until the source files are found, and are left as None
+    """
+    dedupe, parquet, aggregate, sort = None, None, None, None
+    if args.dedupe:
+        key_columns = [one_column.strip() for one_column in args.dedupe_key.split(',')] if args.dedupe_key else None
+        dedupe = _DedupeOptions(key_columns, int(args.dedupe_memory * 1024 * 1024))
+    if args.output_format == 'parquet':
+        parquet = _ParquetOptions(None, _parse_column_types(args.column_types), args.row_group_size)
+    if args.aggregate:
+        aggregate = _parse_aggregate(args.aggregate)
+    if args.sort_by:
+        sort = _SortOptions([one_column.strip() for one_column in args.sort_by.split(',')],
+                            int(args.sort_memory * 1024 * 1024))
+    return _DestinationOptions(args.incremental, args.hash_sources, 0 if args.no_header else args.header_count,
+                               dedupe, parquet, aggregate, sort)
+
+
+def _parse_aggregate(aggregate: list) -> tuple:
+    """Parses the summary statistics columns
+    Arguments:
+        aggregate: the list of 'key=<column>' and 'values=<column>,<column>,...' strings
+    Return:
+        Returns the key column and the list of value columns
+    Exceptions:
+        A ValueError is raised if the columns aren't valid
+    """
+    settings = {}
+    for one_setting in aggregate:
+        name, _, value = one_setting.partition('=')
+        settings[name.strip()] = value.strip()
+    value_columns = [one_column.strip() for one_column in settings.get('values', '').split(',') if one_column.strip()]
+    if set(settings) != {'key', 'values'} or not settings['key'] or not value_columns:
+        raise ValueError('--aggregate must be given as key=<column> values=<column>[,<column>...]')
+    return _AggregateOptions(settings['key'], value_columns)
+
+
+def _parse_column_types(column_types: Optional[str]) -> dict:
+    """Parses the declared column types
+    Arguments:
+        column_types: the comma separated list of column names and their types, separated by colons
+    Return:
+        Returns the dict of column names and their types
+    Exceptions:
+        A ValueError is raised if the column types aren't valid
+    """
+    types = {}
+    for one_column in column_types.split(',') if column_types else []:
+        name, _, type_name = one_column.rpartition(':')
+        if not name.strip() or type_name.strip() not in parquet_table.COLUMN_TYPES:
+            raise ValueError('Column types must be given as name:type, where type is one of %s' %
+                             ', '.join(parquet_table.COLUMN_TYPES))
+        types[name.strip()] = type_name.strip()
+    return types
+
+
+def _get_union_columns(source_paths: list, header_count: int) -> list:
+    """Finds all the columns of the files, in the order they are first found
+    Arguments:
+        source_paths: the paths of the files
+        header_count: the number of header lines in the files; columns are named column_1, column_2, and so on
+                      when there aren't any headers
+    Return:
+        Returns the list of column names
+    """
+    columns = {}
+    for source_path in source_paths:
+        with _open_file(source_path) as in_file:
+            first_record = next(_iter_csv_records(_iter_text_blocks(in_file)), None)
+        if first_record is None:
+            continue
+        values = _parse_record(first_record)
+        for one_column in values if header_count else ['column_%d' % (idx + 1) for idx in range(len(values))]:
+            columns.setdefault(one_column, None)
+    return list(columns)
+
+
+def _merge_group(dest_path: str, source_paths: list, args: argparse.Namespace) -> int:
+    """Merges source files into one destination, in order; run by the workers when merging in parallel
+    Arguments:
+        dest_path: the path of the file to merge into
+        source_paths: the list of the source files to merge
+        args: the command line arguments
+    Return:
+        Returns the number of files merged
+    """
+    options = _get_destination_options(args)
+    if options.parquet is not None:
+        columns = _get_union_columns(source_paths, options.header_count)
+        options = options._replace(parquet=options.parquet._replace(columns=columns))
+
+    num_merged = 0
+    with _DestinationPool(1, options) as pool:
+        for source_path in source_paths:
+            if _merge_csv(source_path, pool.get(dest_path), not args.no_header, args.header_count):
+                num_merged += 1
+    return num_merged
+
+
+def _merge_groups(args: argparse.Namespace) -> None:
+    """Finds all the source files and then merges them one destination at a time, with each destination merged in a
+    separate process when merging in parallel
+    Arguments:
+        args: the command line arguments
+    """
+    # Group the source files by destination, keeping the order they're found in
+    groups = {}
+    for source_path, dest_path in _iter_merge_files(args):
+        groups.setdefault(dest_path, []).append(source_path)
+
+    num_merged = 0
+    if args.jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {executor.submit(_merge_group, dest_path, source_paths, args): dest_path
+                       for dest_path, source_paths in groups.items()}
+            for one_future in concurrent.futures.as_completed(futures):
+                group_merged = one_future.result()
+                num_merged += group_merged
+                print("Merged %d files into %s" % (group_merged, futures[one_future]))
+    else:
+        for dest_path, source_paths in groups.items():
+            num_merged += _merge_group(dest_path, source_paths, args)
+
+    print("Merged %d files into %d files" % (num_merged, len(groups)))
+
+
+def _check_output_args(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Checks the command line arguments for the format and compression of the merged files
+    Arguments:
+        parser: the argument parser, for reporting problems
+        args: the command line arguments
+    Notes:
+        The parser exits the program when a problem is found
+    """
+    if args.output_format == 'parquet':
+        if parquet_table.pyarrow is None:
+            parser.error('--output-format parquet needs the pyarrow package to be installed')
+        if args.incremental:
+            parser.error('Parquet files are written in full and can not be merged into with --incremental')
+        try:
+            _parse_column_types(args.column_types)
+        except ValueError as ex:
+            parser.error(str(ex))
+        if args.compress:
+            parser.error('Parquet files are compressed internally and can not be used with --compress')
+    elif args.column_types:
+        parser.error('--column-types can only be used with --output-format parquet')
+    if args.compress == 'zst' and zstandard is None:
+        parser.error('--compress zst needs the zstandard package to be installed')
+    if args.row_group_size < 1:
+        parser.error('--row-group-size must be at least 1')
+
+
+def _check_args(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Checks that the command line arguments are valid together
+    Arguments:
+        parser: the argument parser, for reporting problems
+        args: the command line arguments
+    Notes:
+        The parser exits the program when a problem is found
+    """
+    if args.walk_threads < 0 or args.max_open_files < 1 or args.jobs < 1:
+        parser.error('--walk-threads can not be negative, and --max-open-files and --jobs must be at least 1')
+    if args.hash_sources and not args.incremental:
+        parser.error('--hash-sources can only be used with --incremental')
+    if (args.dedupe_key and not args.dedupe) or args.dedupe_memory <= 0:
+        parser.error('--dedupe-key can only be used with --dedupe, and --dedupe-memory must be greater than 0')
+    _check_output_args(parser, args)
+    if args.sort_memory <= 0 or (args.sort_by is not None and not args.sort_by.strip(',').strip()):
+        parser.error('--sort-by needs at least one column, and --sort-memory must be greater than 0')
+    if args.aggregate:
+        try:
+            _parse_aggregate(args.aggregate)
+        except ValueError as ex:
+            parser.error(str(ex))
+
+
+def merge():
+    """Discovers and merges CSV files
+    """
+    parser = get_arg_parser()
+    args = parser.parse_args()
+    _check_args(parser, args)
+
+    # Parquet files need to know all the columns before writing, and sorting one merged file at a time keeps memory
+    # use within the limit
+    if args.jobs > 1 or args.output_format == 'parquet' or args.sort_by:
+        _merge_groups(args)
+        return
+
+    num_merged = 0
+    with _DestinationPool(args.max_open_files, _get_destination_options(args)) as pool:
+        for source_path, dest_path in _iter_merge_files(args):
+            if not _merge_csv(source_path, pool.get(dest_path), not args.no_header, args.header_count):
+                continue
+            num_merged += 1
+            if num_merged % PROGRESS_INTERVAL == 0:
+                print("Merged %d files" % num_merged)
 
-            _merge_csv(source_path, dest_path, have_headers, args.header_count)
+        print("Merged %d files into %d files" % (num_merged, len(pool.destinations)))
 
 
 if __name__ == "__main__":
-    merge()
+    try:
+        merge()
+    except RuntimeError as ex:
+        sys.exit('Error: %s' % str(ex))
     sys.exit()
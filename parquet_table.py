@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""Writes rows of CSV values to a Parquet file one row group at a time, finding the column types from the values
+"""
+
+import os
+import tempfile
+from typing import Iterable
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # pylint: disable=invalid-name
+
+# The column types that can be declared for Parquet files
+COLUMN_TYPES = ('int', 'float', 'bool', 'string')
+
+# The wider types a column's type is changed to when later values don't fit, in order of preference
+WIDER_COLUMN_TYPES = {'int': ('float', 'string'), 'float': ('string',), 'bool': ('string',), 'string': ('string',)}
+
+# The default number of rows in each row group
+ROW_GROUP_SIZE = 64 * 1024
+
+# The values recognized as booleans in bool columns
+TRUE_VALUES = ('true', 't', 'yes', 'y')
+FALSE_VALUES = ('false', 'f', 'no', 'n')
+
+
+def convert_values(values: Iterable[str], type_name: str) -> list:
+    """Converts CSV values to a column type, with empty values becoming None
+    Arguments:
+        values: the values to convert
+        type_name: the name of the type to convert to, one of COLUMN_TYPES
+    Return:
+        Returns the list of converted values
+    Exceptions:
+        A ValueError is raised if a value can't be converted
+    """
+    def to_bool(value: str) -> bool:
+        """Converts a value to a boolean"""
+        value = value.strip().lower()
+        if value not in TRUE_VALUES and value not in FALSE_VALUES:
+            raise ValueError('Value "%s" is not a boolean' % value)
+        return value in TRUE_VALUES
+
+    convert = {'int': int, 'float': float, 'bool': to_bool, 'string': str}[type_name]
+    return [convert(one_value) if one_value != '' else None for one_value in values]
+
+
+def infer_type(values: list) -> str:
+    """Finds the narrowest column type that all the values can be converted to
+    Arguments:
+        values: the column values
+    Return:
+        Returns the name of the type, one of COLUMN_TYPES
+    """
+    if all(one_value == '' for one_value in values):
+        return 'string'
+    for type_name in COLUMN_TYPES[:-1]:
+        try:
+            convert_values(values, type_name)
+            return type_name
+        except ValueError:
+            pass
+    return 'string'
+
+
+def widen_type(type_name: str, values: list) -> str:
+    """Finds the type a column is widened to so that it can hold the values
+    Arguments:
+        type_name: the column's type, one of COLUMN_TYPES
+        values: the values that don't fit in the column's type
+    Return:
+        Returns the name of the wider type
+    """
+    for one_type in WIDER_COLUMN_TYPES[type_name]:
+        try:
+            convert_values(values, one_type)
+            return one_type
+        except ValueError:
+            pass
+    return 'string'
+
+
+def _get_arrow_type(type_name: str):
+    """Returns the Arrow data type of a column type
+    Arguments:
+        type_name: the name of the column type, one of COLUMN_TYPES
+    """
+    arrow_types = {'int': pyarrow.int64, 'float': pyarrow.float64, 'bool': pyarrow.bool_, 'string': pyarrow.string}
+    return arrow_types[type_name]()
+
+
+class ColumnTypes:
+    """The types of a table's columns; the types that aren't declared are found from the first values, and are widened
+    if later values don't fit"""
+
+    def __init__(self, columns: list, declared: dict = None):
+        """Initializes the column types
+        Arguments:
+            columns: the names of the columns
+            declared: optional dict of column names and the names of their types (one of COLUMN_TYPES)
+        """
+        self.columns = columns
+        self.types = dict(declared or {})
+        self._declared = set(self.types)
+
+    def infer(self, column_values: list) -> None:
+        """Finds the types of the columns that don't have one yet
+        Arguments:
+            column_values: the list of the values of each column
+        """
+        for name, values in zip(self.columns, column_values):
+            if name not in self.types:
+                self.types[name] = infer_type(values)
+
+    def widen(self, column_values: list) -> dict:
+        """Widens the types of columns whose types were found from earlier values when the new values don't fit
+        Arguments:
+            column_values: the list of the new values of each column
+        Return:
+            Returns the dict of the names of the widened columns and their new types
+        """
+        widened = {}
+        for name, values in zip(self.columns, column_values):
+            if name in self._declared:
+                continue
+            try:
+                convert_values(values, self.types[name])
+            except ValueError:
+                widened[name] = widen_type(self.types[name], values)
+        self.types.update(widened)
+        return widened
+
+    def get_schema(self):
+        """Returns the Arrow schema of the columns"""
+        return pyarrow.schema([(name, _get_arrow_type(self.types[name])) for name in self.columns])
+
+
+class ParquetTable:
+    """Writes rows to a Parquet file one row group at a time"""
+
+    def __init__(self, path: str, columns: list, column_types: dict = None, row_group_size: int = ROW_GROUP_SIZE):
+        """Initializes the table
+        Arguments:
+            path: the path of the Parquet file; the file is replaced once all rows are written
+            columns: the names of the columns
+            column_types: optional dict of column names and the names of their types (one of COLUMN_TYPES); the
+                          types of the other columns are found from the first row group, and are widened if later
+                          values don't fit
+            row_group_size: the number of rows in each row group
+        """
+        self.path = path
+        self.types = ColumnTypes(columns, column_types)
+        self.row_group_size = row_group_size
+        self.num_rows = 0
+        self._rows = []
+        self._writer = None
+        self._temp_path = self._make_temp_path()
+
+    @property
+    def columns(self) -> list:
+        """Returns the names of the columns"""
+        return self.types.columns
+
+    def _make_temp_path(self) -> str:
+        """Creates the temporary file that's written before replacing the Parquet file
+        Return:
+            Returns the path of the temporary file
+        """
+        temp_handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.merge_',
+                                                  suffix='.parquet')
+        os.close(temp_handle)
+        return temp_path
+
+    def add_row(self, values: list) -> None:
+        """Adds a row to the table
+        Arguments:
+            values: the row's values, one for each column
+        """
+        self._rows.append(values)
+        if len(self._rows) >= self.row_group_size:
+            self._write_row_group()
+
+    def _write_row_group(self) -> None:
+        """Writes the pending rows as a row group
+        Exceptions:
+            A RuntimeError is raised if a value can't be converted to its column's type
+        """
+        column_values = list(zip(*self._rows)) if self._rows else [()] * len(self.columns)
+        if self._writer is None:
+            self.types.infer(column_values)
+            self._writer = pyarrow.parquet.ParquetWriter(self._temp_path, self.types.get_schema())
+        else:
+            self._widen_types(column_values)
+
+        schema = self._writer.schema
+        arrays = []
+        for name, values, field in zip(self.columns, column_values, schema):
+            try:
+                arrays.append(pyarrow.array(convert_values(values, self.types.types[name]), type=field.type))
+            except ValueError as ex:
+                raise RuntimeError('Column "%s" of %s has a value that is not %s; use --column-types to declare the '
+                                   'column type' % (name, self.path, self.types.types[name])) from ex
+        self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        self.num_rows += len(self._rows)
+        self._rows = []
+
+    def _widen_types(self, column_values: list) -> None:
+        """Widens the types of columns when the new values don't fit, and rewrites the row groups already written with
+        the wider types
+        Arguments:
+            column_values: the list of the new values of each column
+        """
+        widened = self.types.widen(column_values)
+        if not widened:
+            return
+
+        print("Widening columns %s of %s" % (', '.join('%s to %s' % (name, type_name)
+                                                       for name, type_name in widened.items()), self.path))
+        schema = self.types.get_schema()
+
+        # Copy the row groups that are already written one at a time, converting them to the wider types
+        self._writer.close()
+        old_path = self._temp_path
+        self._temp_path = self._make_temp_path()
+        self._writer = pyarrow.parquet.ParquetWriter(self._temp_path, schema)
+        try:
+            old_file = pyarrow.parquet.ParquetFile(old_path)
+            for idx in range(old_file.num_row_groups):
+                self._writer.write_table(old_file.read_row_group(idx).cast(schema))
+        finally:
+            os.unlink(old_path)
+
+    def close(self) -> None:
+        """Writes any remaining rows and replaces the Parquet file with the one written"""
+        try:
+            if self._rows or self._writer is None:
+                self._write_row_group()
+            self._writer.close()
+            os.replace(self._temp_path, self.path)
+        except Exception:
+            if self._writer is not None:
+                self._writer.close()
+            os.unlink(self._temp_path)
+            raise
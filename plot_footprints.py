@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Finds the plots that fall within bounds or the footprints of images, using a spatial index of the plots
+"""
+
+import json
+import math
+from typing import Iterable, Iterator
+from osgeo import gdal, ogr, osr
+
+# The maximum number of children of each node of a spatial index
+INDEX_NODE_CAPACITY = 16
+
+# The number of points added along each edge of a raster's footprint, to follow curved edges after reprojection
+FOOTPRINT_EDGE_POINTS = 16
+
+
+def get_geometry_points(geometry: dict) -> list:
+    """Returns all the points of a GeoJSON geometry
+    Arguments:
+        geometry: the GeoJSON geometry
+    Return:
+        Returns the list of points
+    """
+    if geometry['type'] == 'GeometryCollection':
+        return [one_point for one_geom in geometry['geometries'] for one_point in get_geometry_points(one_geom)]
+
+    # Drill down to the lists of points
+    points = [geometry['coordinates']]
+    while points and not isinstance(points[0][0], (int, float)):
+        points = [one_point for one_list in points for one_point in one_list]
+    return points
+
+
+def get_geometry_bounds(geometry: dict) -> tuple:
+    """Returns the bounding box of a GeoJSON geometry
+    Arguments:
+        geometry: the GeoJSON geometry
+    Return:
+        Returns a tuple of the minimum X, minimum Y, maximum X, and maximum Y values
+    """
+    points = get_geometry_points(geometry)
+    x_values = [one_point[0] for one_point in points]
+    y_values = [one_point[1] for one_point in points]
+    return min(x_values), min(y_values), max(x_values), max(y_values)
+
+
+def get_wgs84_srs() -> osr.SpatialReference:
+    """Returns the WGS84 coordinate system of the plots from BETYdb
+    Return:
+        Returns the coordinate system, with longitude before latitude
+    """
+    geographic = osr.SpatialReference()
+    geographic.ImportFromEPSG(4326)
+    geographic.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return geographic
+
+
+def _bounds_intersect(first: tuple, second: tuple) -> bool:
+    """Checks if two bounding boxes intersect
+    Arguments:
+        first: the first bounding box as minimum X, minimum Y, maximum X, maximum Y values
+        second: the second bounding box
+    Return:
+        Returns True if the bounding boxes touch or overlap
+    """
+    return first[0] <= second[2] and second[0] <= first[2] and first[1] <= second[3] and second[1] <= first[3]
+
+
+def _bounds_contain(outer: tuple, inner: tuple) -> bool:
+    """Checks if a bounding box is inside of another one
+    Arguments:
+        outer: the containing bounding box as minimum X, minimum Y, maximum X, maximum Y values
+        inner: the bounding box to check
+    Return:
+        Returns True if the inner bounding box is completely inside the outer one
+    """
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+
+#  The index is built once and then only queried, so we silence pylint
+class STRtree:  # pylint: disable=too-few-public-methods
+    """Read-only spatial index of bounding boxes, bulk loaded using Sort-Tile-Recursive packing"""
+
+    def __init__(self, boxes: list, node_capacity: int = INDEX_NODE_CAPACITY):
+        """Builds the index
+        Arguments:
+            boxes: the list of bounding boxes to index, each a tuple of minimum X, minimum Y, maximum X, maximum Y
+            node_capacity: the maximum number of children of each node
+        """
+        self._node_capacity = node_capacity
+
+        # Leaf entries are a box and its index, and node entries are the bounds and list of their child entries
+        level = [(one_box, idx) for idx, one_box in enumerate(boxes)]
+        self._height = 0
+        while len(level) > node_capacity:
+            level = self._pack(level)
+            self._height += 1
+        self._root = level
+
+    def _pack(self, entries: list) -> list:
+        """Groups entries into nodes by sorting them into vertical slices and then sorting each slice
+        Arguments:
+            entries: the list of entries to group
+        Return:
+            Returns the list of nodes
+        """
+        num_nodes = math.ceil(len(entries) / self._node_capacity)
+        slice_size = math.ceil(math.sqrt(num_nodes)) * self._node_capacity
+
+        nodes = []
+        entries = sorted(entries, key=lambda entry: entry[0][0] + entry[0][2])
+        for slice_start in range(0, len(entries), slice_size):
+            one_slice = sorted(entries[slice_start:slice_start + slice_size],
+                               key=lambda entry: entry[0][1] + entry[0][3])
+            for node_start in range(0, len(one_slice), self._node_capacity):
+                children = one_slice[node_start:node_start + self._node_capacity]
+                bounds = (min(child[0][0] for child in children), min(child[0][1] for child in children),
+                          max(child[0][2] for child in children), max(child[0][3] for child in children))
+                nodes.append((bounds, children))
+
+        return nodes
+
+    def query(self, bounds: tuple) -> list:
+        """Finds the boxes that intersect the bounds
+        Arguments:
+            bounds: the bounds to check as minimum X, minimum Y, maximum X, maximum Y
+        Return:
+            Returns the sorted list of indexes of the intersecting boxes
+        """
+        found = []
+        pending = [(self._root, self._height)]
+        while pending:
+            entries, height = pending.pop()
+            for one_entry in entries:
+                if _bounds_intersect(one_entry[0], bounds):
+                    if height == 0:
+                        found.append(one_entry[1])
+                    else:
+                        pending.append((one_entry[1], height - 1))
+
+        return sorted(found)
+
+
+def _get_bounds_footprint(bounds: tuple) -> ogr.Geometry:
+    """Returns the footprint of WGS84 bounds
+    Arguments:
+        bounds: the bounds as minimum longitude, minimum latitude, maximum longitude, maximum latitude
+    Return:
+        Returns the footprint polygon as an OGR geometry
+    """
+    return ogr.CreateGeometryFromWkt('POLYGON ((%.15g %.15g,%.15g %.15g,%.15g %.15g,%.15g %.15g,%.15g %.15g))' %
+                                     (bounds[0], bounds[1], bounds[2], bounds[1], bounds[2], bounds[3],
+                                      bounds[0], bounds[3], bounds[0], bounds[1]))
+
+
+def _get_edge_ring(geo_transform: tuple, width: int, height: int) -> ogr.Geometry:
+    """Returns the outline of an image in its own coordinate system
+    Arguments:
+        geo_transform: the GDAL geo transform of the image
+        width: the width of the image in pixels
+        height: the height of the image in pixels
+    Return:
+        Returns the closed OGR linear ring around the image
+    """
+    # Walk the image edges in pixel space, adding points to follow any curvature after the transformation
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    corners = [(0, 0), (width, 0), (width, height), (0, height), (0, 0)]
+    for (start_x, start_y), (end_x, end_y) in zip(corners[:-1], corners[1:]):
+        for step in range(FOOTPRINT_EDGE_POINTS):
+            pixel_x = start_x + (end_x - start_x) * step / FOOTPRINT_EDGE_POINTS
+            pixel_y = start_y + (end_y - start_y) * step / FOOTPRINT_EDGE_POINTS
+            ring.AddPoint_2D(geo_transform[0] + pixel_x * geo_transform[1] + pixel_y * geo_transform[2],
+                             geo_transform[3] + pixel_x * geo_transform[4] + pixel_y * geo_transform[5])
+    ring.CloseRings()
+    return ring
+
+
+def _get_raster_footprint(raster_path: str, geographic: osr.SpatialReference) -> ogr.Geometry:
+    """Returns the footprint of a georeferenced image
+    Arguments:
+        raster_path: the path of the image
+        geographic: the coordinate system to return the footprint in
+    Return:
+        Returns the footprint polygon as an OGR geometry
+    Exceptions:
+        A RuntimeError is raised if the image can't be opened or isn't georeferenced
+    """
+    raster = gdal.Open(raster_path)
+    if raster is None:
+        raise RuntimeError('Unable to open image "%s" to get its footprint' % raster_path)
+    projection = raster.GetProjection()
+    if not projection:
+        raise RuntimeError('Image "%s" is not georeferenced' % raster_path)
+    raster_srs = osr.SpatialReference(wkt=projection)
+    raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    footprint = ogr.Geometry(ogr.wkbPolygon)
+    footprint.AddGeometry(_get_edge_ring(raster.GetGeoTransform(), raster.RasterXSize, raster.RasterYSize))
+    footprint.Transform(osr.CoordinateTransformation(raster_srs, geographic))
+    return footprint
+
+
+def get_footprints(bounds: tuple = None, raster_paths: list = None) -> list:
+    """Returns the footprints of the bounds and rasters as WGS84 geometries
+    Arguments:
+        bounds: optional WGS84 bounds as minimum longitude, minimum latitude, maximum longitude, maximum latitude
+        raster_paths: optional list of georeferenced images to get the footprints of
+    Return:
+        Returns the list of footprint polygons as OGR geometries in longitude, latitude order
+    Exceptions:
+        A RuntimeError is raised if an image can't be opened or isn't georeferenced
+    """
+    footprints = [_get_bounds_footprint(bounds)] if bounds else []
+    geographic = get_wgs84_srs()
+    footprints.extend(_get_raster_footprint(one_path, geographic) for one_path in raster_paths or [])
+    return footprints
+
+
+def _plot_in_footprints(geometry: dict, geometry_bounds: tuple, footprints: list, candidates: Iterable = None) -> bool:
+    """Checks if a plot intersects any of the footprints
+    Arguments:
+        geometry: the GeoJSON geometry of the plot
+        geometry_bounds: the bounding box of the plot
+        footprints: the footprint information returned by _get_footprint_info()
+        candidates: optional indexes of the footprints to check; all footprints are checked by default
+    Return:
+        Returns True if the plot intersects a footprint
+    """
+    ogr_geometry = None
+    for idx in candidates if candidates is not None else range(len(footprints)):
+        footprint_bounds, footprint, is_box = footprints[idx]
+        if not _bounds_intersect(footprint_bounds, geometry_bounds):
+            continue
+        # Only build the OGR geometry when the bounding box checks can't decide
+        if is_box and _bounds_contain(footprint_bounds, geometry_bounds):
+            return True
+        if ogr_geometry is None:
+            ogr_geometry = ogr.CreateGeometryFromJson(json.dumps(geometry))
+        if footprint.Intersects(ogr_geometry):
+            return True
+
+    return False
+
+
+def filter_plots_to_footprints(geojson_plots: dict, footprints: list) -> dict:
+    """Returns the plots that intersect any of the footprints, using a spatial index of the plots
+    Arguments:
+        geojson_plots: a dictionary of plot names and their associated GeoJSON geometry
+        footprints: the list of footprint OGR geometries, in the same coordinate system as the plots
+    Return:
+        Returns a dictionary of the intersecting plots and their geometries, in their original order
+    """
+    plot_names = list(geojson_plots)
+    plot_bounds = [get_geometry_bounds(geojson_plots[one_name]) for one_name in plot_names]
+    index = STRtree(plot_bounds)
+
+    found = set()
+    footprint_info = _get_footprint_info(footprints)
+    for footprint_idx, (footprint_bounds, _, _) in enumerate(footprint_info):
+        for plot_idx in index.query(footprint_bounds):
+            if plot_idx not in found and _plot_in_footprints(geojson_plots[plot_names[plot_idx]], plot_bounds[plot_idx],
+                                                            footprint_info, [footprint_idx]):
+                found.add(plot_idx)
+
+    return {plot_names[idx]: geojson_plots[plot_names[idx]] for idx in sorted(found)}
+
+
+def iter_plots_in_footprints(geojson_plots: Iterable[tuple], footprints: list) -> Iterator[tuple]:
+    """Returns each plot that intersects any of the footprints, checking the plots as they're received
+    Arguments:
+        geojson_plots: tuples of plot names and their associated GeoJSON geometry
+        footprints: the list of footprint OGR geometries, in the same coordinate system as the plots
+    Return:
+        Returns a tuple of the plot name and its geometry for each intersecting plot
+    """
+    footprint_info = _get_footprint_info(footprints)
+    for plot_name, plot_geometry in geojson_plots:
+        if _plot_in_footprints(plot_geometry, get_geometry_bounds(plot_geometry), footprint_info):
+            yield plot_name, plot_geometry
+
+
+def _get_footprint_info(footprints: list) -> list:
+    """Prepares the footprints for checking plots against them
+    Arguments:
+        footprints: the list of footprint OGR geometries
+    Return:
+        Returns a list of tuples containing the bounding box of a footprint, the footprint, and whether the footprint
+        fills its bounding box
+    """
+    footprint_info = []
+    for one_footprint in footprints:
+        min_x, max_x, min_y, max_y = one_footprint.GetEnvelope()
+        box_area = (max_x - min_x) * (max_y - min_y)
+        footprint_info.append(((min_x, min_y, max_x, max_y), one_footprint,
+                               abs(box_area - one_footprint.GetArea()) <= box_area * 1e-12))
+    return footprint_info
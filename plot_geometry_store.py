@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+"""Compact, indexed binary file of plot geometries that can be read without loading all of it
+
+The file holds each plot's name and geometry (as ISO WKB) along with a packed Hilbert R-tree of the plot bounding
+boxes and an index of the plot names, in the spirit of FlatGeobuf. Readers memory-map the file and only touch the
+parts needed to find the requested plots.
+
+File layout (little endian):
+    header          HEADER_FORMAT
+    crs name        UTF-8 text of header's crs length; empty when the plots are in WGS84
+    feature table   FEATURE_FORMAT entry per plot, in Hilbert order of the bounding box centers
+    name index      uint32 feature numbers sorted by plot name
+    tree            the bounding boxes of each tree level above the features, from the lowest level up
+    data            the plot names and geometries referred to by the feature table
+"""
+
+import argparse
+import collections
+import json
+import math
+import mmap
+import struct
+import sys
+from typing import Iterable, Iterator, Optional
+from osgeo import ogr
+
+MAGIC = b'PLOTGEOM'
+VERSION = 1
+
+# The number of children of each tree node
+NODE_SIZE = 16
+
+# Header: magic, version, node size, number of features, CRS name length, feature table, name index, tree and data
+# offsets
+HEADER_FORMAT = '<8sHHII4Q'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Feature table entry: bounding box, name offset and length, and geometry offset and length in the data section
+FEATURE_FORMAT = '<4dQIQI'
+FEATURE_SIZE = struct.calcsize(FEATURE_FORMAT)
+
+BOX_FORMAT = '<4d'
+BOX_SIZE = struct.calcsize(BOX_FORMAT)
+
+# ISO WKB geometry type codes, without and with Z values
+WKB_POLYGON = (3, 1003)
+WKB_MULTIPOLYGON = (6, 1006)
+
+# The number of cells along each side of the grid used when calculating Hilbert values
+HILBERT_GRID_SIZE = 1 << 16
+
+# Where the parts of an open file are, from its header
+_StoreLayout = collections.namedtuple('_StoreLayout', ['node_size', 'num_features', 'feature_offset',
+                                                      'name_index_offset', 'tree_offset', 'data_offset'])
+
+# The default feature property holding the plot name
+DEFAULT_NAME_FIELD = 'observationUnitName'
+
+
+def _encode_wkb_polygon(rings: list, has_z: bool) -> bytes:
+    """Encodes the rings of a polygon as WKB
+    Arguments:
+        rings: the list of rings, each a list of coordinates
+        has_z: set to True to write 3D coordinates
+    Return:
+        Returns the WKB of the polygon
+    """
+    num_dims = 3 if has_z else 2
+    parts = [struct.pack('<BII', 1, WKB_POLYGON[has_z], len(rings))]
+    for one_ring in rings:
+        parts.append(struct.pack('<I', len(one_ring)))
+        parts.append(struct.pack('<%dd' % (len(one_ring) * num_dims),
+                                 *[one_point[idx] if idx < len(one_point) else 0.0
+                                   for one_point in one_ring for idx in range(num_dims)]))
+    return b''.join(parts)
+
+
+def geojson_to_wkb(geometry: dict) -> bytes:
+    """Converts a GeoJSON geometry to ISO WKB
+    Arguments:
+        geometry: the GeoJSON geometry to convert
+    Return:
+        Returns the WKB of the geometry
+    Exceptions:
+        Exceptions may be raised from OGR library calls
+    Notes:
+        Polygons and multipolygons are encoded directly; OGR is used for all other geometry types
+    """
+    if geometry['type'] in ('Polygon', 'MultiPolygon'):
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        has_z = any(len(one_point) > 2 for one_polygon in polygons for one_ring in one_polygon
+                    for one_point in one_ring)
+        if geometry['type'] == 'Polygon':
+            return _encode_wkb_polygon(geometry['coordinates'], has_z)
+        return struct.pack('<BII', 1, WKB_MULTIPOLYGON[has_z], len(polygons)) + \
+            b''.join(_encode_wkb_polygon(one_polygon, has_z) for one_polygon in polygons)
+
+    return bytes(ogr.CreateGeometryFromJson(json.dumps(geometry)).ExportToIsoWkb())
+
+
+def _decode_wkb_polygon(wkb, offset: int) -> tuple:
+    """Decodes a WKB polygon
+    Arguments:
+        wkb: the buffer containing the WKB
+        offset: the starting offset of the polygon in the buffer
+    Return:
+        Returns a tuple of the polygon's list of rings, and the offset after the polygon
+    Exceptions:
+        A ValueError is raised if the WKB isn't a little endian polygon
+    """
+    byte_order, geom_type, num_rings = struct.unpack_from('<BII', wkb, offset)
+    if byte_order != 1 or geom_type not in WKB_POLYGON:
+        raise ValueError('Expected a little endian WKB polygon')
+    num_dims = 3 if geom_type == WKB_POLYGON[1] else 2
+    offset += 9
+
+    rings = []
+    for _ in range(num_rings):
+        num_points = struct.unpack_from('<I', wkb, offset)[0]
+        offset += 4
+        values = struct.unpack_from('<%dd' % (num_points * num_dims), wkb, offset)
+        offset += num_points * num_dims * 8
+        rings.append([list(values[idx:idx + num_dims]) for idx in range(0, len(values), num_dims)])
+
+    return rings, offset
+
+
+def wkb_to_geojson(wkb) -> dict:
+    """Converts ISO WKB to a GeoJSON geometry
+    Arguments:
+        wkb: the WKB to convert
+    Return:
+        Returns the GeoJSON geometry as a dict
+    Exceptions:
+        Exceptions may be raised from OGR library calls
+    Notes:
+        Little endian polygons and multipolygons are decoded directly; OGR is used for all other geometry types
+    """
+    byte_order, geom_type = struct.unpack_from('<BI', wkb, 0)
+    if byte_order == 1 and geom_type in WKB_POLYGON:
+        return {'type': 'Polygon', 'coordinates': _decode_wkb_polygon(wkb, 0)[0]}
+    if byte_order == 1 and geom_type in WKB_MULTIPOLYGON:
+        num_polygons = struct.unpack_from('<I', wkb, 5)[0]
+        offset = 9
+        polygons = []
+        for _ in range(num_polygons):
+            rings, offset = _decode_wkb_polygon(wkb, offset)
+            polygons.append(rings)
+        return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+    return json.loads(ogr.CreateGeometryFromWkb(bytes(wkb)).ExportToJson())
+
+
+def _get_wkb_bounds(wkb: bytes, geometry: dict) -> tuple:
+    """Returns the bounding box of a geometry
+    Arguments:
+        wkb: the WKB of the geometry
+        geometry: the GeoJSON of the geometry
+    Return:
+        Returns the minimum X, minimum Y, maximum X, and maximum Y of the geometry
+    Exceptions:
+        Exceptions may be raised from OGR library calls
+    """
+    if geometry['type'] not in ('Polygon', 'MultiPolygon'):
+        envelope = ogr.CreateGeometryFromWkb(wkb).GetEnvelope()
+        return envelope[0], envelope[2], envelope[1], envelope[3]
+
+    polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+    x_values = [one_point[0] for one_polygon in polygons for one_ring in one_polygon for one_point in one_ring]
+    y_values = [one_point[1] for one_polygon in polygons for one_ring in one_polygon for one_point in one_ring]
+    return min(x_values), min(y_values), max(x_values), max(y_values)
+
+
+def _hilbert_value(x_value: int, y_value: int) -> int:
+    """Returns the distance along the Hilbert curve of a grid cell
+    Arguments:
+        x_value: the column of the cell
+        y_value: the row of the cell
+    Return:
+        Returns the distance of the cell along the curve
+    """
+    distance = 0
+    step = HILBERT_GRID_SIZE // 2
+    while step > 0:
+        rx_value = 1 if x_value & step else 0
+        ry_value = 1 if y_value & step else 0
+        distance += step * step * ((3 * rx_value) ^ ry_value)
+        # Rotate the quadrant so the curve stays continuous
+        if ry_value == 0:
+            if rx_value == 1:
+                x_value = step - 1 - x_value
+                y_value = step - 1 - y_value
+            x_value, y_value = y_value, x_value
+        step //= 2
+    return distance
+
+
+def _get_level_sizes(num_features: int, node_size: int) -> list:
+    """Returns the number of entries in each level of the tree, starting with the features
+    Arguments:
+        num_features: the number of features
+        node_size: the number of children of each node
+    Return:
+        Returns the list of level sizes; the last level has the single root node unless there's one or no features
+    """
+    sizes = [num_features]
+    while sizes[-1] > 1:
+        sizes.append(math.ceil(sizes[-1] / node_size))
+    return sizes
+
+
+def _gather_plots(geojson_plots: Iterable[tuple]) -> list:
+    """Encodes the plots and finds their bounds
+    Arguments:
+        geojson_plots: tuples of plot names and their GeoJSON geometry
+    Return:
+        Returns the list of tuples of each plot's bounding box, UTF-8 encoded name, and WKB
+    Exceptions:
+        Exceptions may be raised from OGR library calls
+    """
+    plots = []
+    for plot_name, geometry in geojson_plots:
+        wkb = geojson_to_wkb(geometry)
+        plots.append((_get_wkb_bounds(wkb, geometry), plot_name.encode('utf-8'), wkb))
+    return plots
+
+
+def _sort_by_hilbert(plots: list) -> None:
+    """Sorts the plots along the Hilbert curve of their bounding box centers so nearby plots are stored together
+    Arguments:
+        plots: the list of plots to sort in place, each starting with its bounding box
+    """
+    if not plots:
+        return
+
+    min_x = min(one_plot[0][0] for one_plot in plots)
+    min_y = min(one_plot[0][1] for one_plot in plots)
+    width = (max(one_plot[0][2] for one_plot in plots) - min_x) or 1.0
+    height = (max(one_plot[0][3] for one_plot in plots) - min_y) or 1.0
+    scale = HILBERT_GRID_SIZE - 1
+
+    def hilbert_key(plot: tuple) -> int:
+        """Returns the Hilbert value of the center of the plot's bounds"""
+        bounds = plot[0]
+        return _hilbert_value(int(scale * ((bounds[0] + bounds[2]) / 2 - min_x) / width),
+                              int(scale * ((bounds[1] + bounds[3]) / 2 - min_y) / height))
+
+    plots.sort(key=hilbert_key)
+
+
+def _build_tree_levels(boxes: list, node_size: int) -> list:
+    """Builds the levels of the tree above the features, from the bottom up
+    Arguments:
+        boxes: the bounding boxes of the features, in file order
+        node_size: the number of children of each tree node
+    Return:
+        Returns the list of levels, each a list of the bounding boxes of its nodes
+    """
+    levels = [boxes]
+    for _ in _get_level_sizes(len(boxes), node_size)[1:]:
+        children = levels[-1]
+        levels.append([(min(one_box[0] for one_box in children[idx:idx + node_size]),
+                        min(one_box[1] for one_box in children[idx:idx + node_size]),
+                        max(one_box[2] for one_box in children[idx:idx + node_size]),
+                        max(one_box[3] for one_box in children[idx:idx + node_size]))
+                       for idx in range(0, len(children), node_size)])
+    return levels[1:]
+
+
+def _get_name_index(plots: list) -> bytes:
+    """Returns the name index of the plots
+    Arguments:
+        plots: the list of plots in file order, each with its UTF-8 encoded name second
+    Return:
+        Returns the packed feature numbers of the plots sorted by name
+    """
+    name_order = sorted(range(len(plots)), key=lambda idx: plots[idx][1])
+    return struct.pack('<%dI' % len(name_order), *name_order)
+
+
+def _get_feature_table(plots: list) -> bytes:
+    """Returns the feature table of the plots
+    Arguments:
+        plots: the list of plots in file order, as tuples of bounding box, UTF-8 encoded name, and WKB
+    Return:
+        Returns the packed feature table entries, with the offsets of each plot's name and geometry in the data
+        section
+    """
+    entries = []
+    data_position = 0
+    for bounds, name, wkb in plots:
+        entries.append(struct.pack(FEATURE_FORMAT, *bounds, data_position, len(name), data_position + len(name),
+                                   len(wkb)))
+        data_position += len(name) + len(wkb)
+    return b''.join(entries)
+
+
+def write_plot_store(out_file, geojson_plots: Iterable[tuple], crs_name: str = None,
+                     node_size: int = NODE_SIZE) -> int:
+    """Writes plots to a plot geometry store file
+    Arguments:
+        out_file: the binary file to write to (supports .write() as a file-like object)
+        geojson_plots: tuples of plot names and their GeoJSON geometry
+        crs_name: optional name of the coordinate system of the plots when they're not in WGS84
+        node_size: the number of children of each tree node
+    Return:
+        Returns the number of plots written
+    Exceptions:
+        Exceptions may be raised from OGR library calls
+    Notes:
+        All the plots are held in memory while they're sorted and indexed
+    """
+    plots = _gather_plots(geojson_plots)
+    _sort_by_hilbert(plots)
+    levels = _build_tree_levels([one_plot[0] for one_plot in plots], node_size)
+
+    # Work out where everything goes
+    crs_bytes = (crs_name or '').encode('utf-8')
+    feature_offset = HEADER_SIZE + len(crs_bytes)
+    name_index_offset = feature_offset + len(plots) * FEATURE_SIZE
+    tree_offset = name_index_offset + len(plots) * 4
+    data_offset = tree_offset + sum(len(one_level) for one_level in levels) * BOX_SIZE
+
+    out_file.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, node_size, len(plots), len(crs_bytes), feature_offset,
+                               name_index_offset, tree_offset, data_offset))
+    out_file.write(crs_bytes)
+    out_file.write(_get_feature_table(plots))
+    out_file.write(_get_name_index(plots))
+    for one_level in levels:
+        for one_box in one_level:
+            out_file.write(struct.pack(BOX_FORMAT, *one_box))
+
+    for _, name, wkb in plots:
+        out_file.write(name)
+        out_file.write(wkb)
+
+    return len(plots)
+
+
+class PlotGeometryStore:
+    """Reads plots from a plot geometry store file by name or location using a memory map of the file"""
+
+    def __init__(self, file_path: str):
+        """Opens the file
+        Arguments:
+            file_path: the path of the file to open
+        Exceptions:
+            A RuntimeError is raised if the file isn't a plot geometry store
+        """
+        # pylint: disable=consider-using-with
+        self._file = open(file_path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped
+            self._file.close()
+            raise RuntimeError('File "%s" is not a plot geometry store' % file_path) from None
+
+        if len(self._map) < HEADER_SIZE:
+            self.close()
+            raise RuntimeError('File "%s" is not a plot geometry store' % file_path)
+        magic, version, node_size, num_features, crs_len, *offsets = struct.unpack_from(HEADER_FORMAT, self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise RuntimeError('File "%s" is not a supported plot geometry store' % file_path)
+
+        self._layout = _StoreLayout(node_size, num_features, *offsets)
+        self.crs_name = bytes(self._map[HEADER_SIZE:HEADER_SIZE + crs_len]).decode('utf-8') or None
+        self._level_sizes = _get_level_sizes(num_features, node_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return self._layout.num_features
+
+    def close(self) -> None:
+        """Closes the file"""
+        self._map.close()
+        self._file.close()
+
+    def _feature(self, idx: int) -> tuple:
+        """Returns the feature table entry of a plot
+        Arguments:
+            idx: the number of the plot in the file
+        Return:
+            Returns the tuple of minimum X, minimum Y, maximum X, maximum Y, name offset, name length, geometry offset,
+            and geometry length
+        """
+        return struct.unpack_from(FEATURE_FORMAT, self._map, self._layout.feature_offset + idx * FEATURE_SIZE)
+
+    def _name(self, idx: int) -> str:
+        """Returns the name of a plot
+        Arguments:
+            idx: the number of the plot in the file
+        Return:
+            Returns the plot's name
+        """
+        entry = self._feature(idx)
+        start = self._layout.data_offset + entry[4]
+        return self._map[start:start + entry[5]].decode('utf-8')
+
+    def get_plot(self, idx: int) -> tuple:
+        """Returns a plot
+        Arguments:
+            idx: the number of the plot in the file
+        Return:
+            Returns a tuple of the plot's name, its GeoJSON geometry, and its bounding box as minimum X, minimum Y,
+            maximum X, and maximum Y
+        """
+        entry = self._feature(idx)
+        name_start = self._layout.data_offset + entry[4]
+        geometry_start = self._layout.data_offset + entry[6]
+        return (self._map[name_start:name_start + entry[5]].decode('utf-8'),
+                wkb_to_geojson(memoryview(self._map)[geometry_start:geometry_start + entry[7]]),
+                entry[:4])
+
+    def get_wkb(self, idx: int) -> bytes:
+        """Returns the geometry of a plot as ISO WKB, for passing on to OGR
+        Arguments:
+            idx: the number of the plot in the file
+        Return:
+            Returns the WKB of the plot
+        """
+        entry = self._feature(idx)
+        geometry_start = self._layout.data_offset + entry[6]
+        return self._map[geometry_start:geometry_start + entry[7]]
+
+    def find(self, plot_name: str) -> Optional[int]:
+        """Finds a plot by name
+        Arguments:
+            plot_name: the name of the plot to find
+        Return:
+            Returns the number of the plot in the file, or None if it's not found
+        """
+        # Binary search the sorted names
+        low, high = 0, self._layout.num_features
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(self._name_order(middle)) < plot_name:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._layout.num_features and self._name(self._name_order(low)) == plot_name:
+            return self._name_order(low)
+        return None
+
+    def _name_order(self, position: int) -> int:
+        """Returns the plot at a position of the sorted names
+        Arguments:
+            position: the position in the name index
+        Return:
+            Returns the number of the plot
+        """
+        return struct.unpack_from('<I', self._map, self._layout.name_index_offset + position * 4)[0]
+
+    def query(self, bounds: tuple) -> list:
+        """Finds the plots whose bounding boxes intersect the bounds
+        Arguments:
+            bounds: the minimum X, minimum Y, maximum X, and maximum Y to look in
+        Return:
+            Returns the list of the numbers of the found plots, in file order
+        """
+        def intersects(box: tuple) -> bool:
+            """Checks if a box intersects the bounds"""
+            return box[0] <= bounds[2] and bounds[0] <= box[2] and box[1] <= bounds[3] and bounds[1] <= box[3]
+
+        # Walk down the tree levels keeping the ranges of entries to check at the next level
+        level_offsets = [self._layout.tree_offset]
+        for one_size in self._level_sizes[1:]:
+            level_offsets.append(level_offsets[-1] + one_size * BOX_SIZE)
+        candidates = [range(self._level_sizes[-1])]
+        for level in range(len(self._level_sizes) - 1, 0, -1):
+            next_candidates = []
+            for one_range in candidates:
+                for idx in one_range:
+                    box = struct.unpack_from(BOX_FORMAT, self._map, level_offsets[level - 1] + idx * BOX_SIZE)
+                    if intersects(box):
+                        next_candidates.append(range(idx * self._layout.node_size,
+                                                     min((idx + 1) * self._layout.node_size,
+                                                         self._level_sizes[level - 1])))
+            candidates = next_candidates
+
+        return [idx for one_range in candidates for idx in one_range if intersects(self._feature(idx)[:4])]
+
+    def __iter__(self) -> Iterator[tuple]:
+        """Returns each of the plots as a tuple of its name, GeoJSON geometry and bounding box"""
+        for idx in range(self._layout.num_features):
+            yield self.get_plot(idx)
+
+
+def _get_crs_name(layer: ogr.Layer) -> Optional[str]:
+    """Returns the name of a layer's coordinate system, if it's not WGS84
+    Arguments:
+        layer: the layer to check
+    Return:
+        Returns the OGC URN of the coordinate system's EPSG code, or None if it's WGS84 or not known
+    """
+    srs = layer.GetSpatialRef()
+    if srs is None:
+        return None
+    srs = srs.Clone()
+    if srs.GetAuthorityName(None) != 'EPSG':
+        srs.AutoIdentifyEPSG()
+    if srs.GetAuthorityName(None) != 'EPSG' or srs.GetAuthorityCode(None) in (None, '4326'):
+        return None
+    return 'urn:ogc:def:crs:EPSG::' + srs.GetAuthorityCode(None)
+
+
+def convert_to_plot_store(source_path: str, dest_path: str, name_field: str = DEFAULT_NAME_FIELD) -> int:
+    """Converts a GeoJSON file, shapefile, or other OGR readable file of plots to a plot geometry store
+    Arguments:
+        source_path: the path of the file to convert
+        dest_path: the path of the plot geometry store to write
+        name_field: the feature field containing the plot names; the feature ID is used if the field is missing
+    Return:
+        Returns the number of plots written
+    Exceptions:
+        A RuntimeError is raised if the source file can't be read
+    """
+    source = ogr.Open(source_path)
+    if source is None or source.GetLayerCount() < 1:
+        raise RuntimeError('Unable to read plots from "%s"' % source_path)
+    layer = source.GetLayer(0)
+    name_idx = layer.GetLayerDefn().GetFieldIndex(name_field)
+
+    def iter_plots() -> Iterator[tuple]:
+        """Returns the name and GeoJSON geometry of each feature"""
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+            plot_name = feature.GetFieldAsString(name_idx) if name_idx >= 0 else str(feature.GetFID())
+            yield plot_name, json.loads(geometry.ExportToJson())
+
+    with open(dest_path, 'wb') as out_file:
+        return write_plot_store(out_file, iter_plots(), _get_crs_name(layer))
+
+
+def main() -> None:
+    """Converts a file of plot geometries to a plot geometry store"""
+    parser = argparse.ArgumentParser(description='Converts GeoJSON or shapefile plot geometries to a plot geometry '
+                                                 'store')
+    parser.add_argument('--name_field', default=DEFAULT_NAME_FIELD,
+                        help='the field containing the plot names (defaults to %s)' % DEFAULT_NAME_FIELD)
+    parser.add_argument('source_file', help='the GeoJSON file, shapefile, or other OGR readable file to convert')
+    parser.add_argument('dest_file', help='the plot geometry store file to write')
+    args = parser.parse_args()
+
+    if not convert_to_plot_store(args.source_file, args.dest_file, args.name_field):
+        raise RuntimeError('No plots were found in "%s"' % args.source_file)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Keeps a local SQLite copy of the BETYdb sites, requesting only the changes since the last sync
+"""
+
+import sqlite3
+from typing import Iterable, Iterator
+
+import betydb_client
+
+# The BETYdb search prefix used to request records with values greater than the one specified
+BETYDB_GREATER_THAN_PREFIX = 'gt'
+
+# Adds a site to the store, or replaces the geometry of a site that's already there
+UPSERT_SITE_SQL = 'INSERT INTO sites (sitename, geometry, updated_at) VALUES (?, ?, ?) ON CONFLICT(sitename) ' \
+                  'DO UPDATE SET geometry=excluded.geometry, updated_at=excluded.updated_at'
+
+# Replaces the geometry of a site in the store when the change is newer than the stored one
+UPDATE_SITE_SQL = 'UPDATE sites SET geometry=?, updated_at=? WHERE sitename=? AND IFNULL(updated_at, \'\') < ?'
+
+
+def open_plot_store(store_path: str) -> sqlite3.Connection:
+    """Opens the plot store, creating it if needed
+    Arguments:
+        store_path: the path to the SQLite file
+    Return:
+        The connection to the store
+    """
+    connection = sqlite3.connect(store_path)
+    connection.execute('CREATE TABLE IF NOT EXISTS sites (sitename TEXT PRIMARY KEY, geometry TEXT NOT NULL, '
+                       'updated_at TEXT)')
+    connection.execute('CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value TEXT)')
+    return connection
+
+
+def _is_newer(record: dict, since: str = None) -> bool:
+    """Checks if a BETYdb record was updated after the sync point
+    Arguments:
+        record: the BETYdb record to check
+        since: the updated_at value of the sync point, or None when everything is new
+    Return:
+        Returns True if the record was updated after the sync point
+    """
+    return since is None or (record.get('updated_at') or '') > since
+
+
+def _store_experiment_sites(connection: sqlite3.Connection, experiments: Iterable[dict], since: str = None) -> tuple:
+    """Adds or updates the sites of new and updated experiments in the plot store
+    Arguments:
+        connection: the connection to the plot store
+        experiments: the experiments retrieved from BETYdb
+        since: the updated_at value of the sync point, or None when all sites are stored
+    Return:
+        A tuple of the number of sites stored and the newest updated_at value seen
+    Notes:
+        BETYdb may ignore the update filter of the request, so the update times are checked here too
+    """
+    num_changed = 0
+    newest = ''
+    for one_exp in experiments:
+        experiment = one_exp.get('experiment', {})
+        newest = max(newest, experiment.get('updated_at') or '')
+        exp_updated = _is_newer(experiment, since)
+        for one_site in experiment.get('sites', []):
+            site = one_site.get('site', {})
+            if 'geometry' not in site or 'sitename' not in site:
+                continue
+            newest = max(newest, site.get('updated_at') or '')
+            if exp_updated or _is_newer(site, since):
+                connection.execute(UPSERT_SITE_SQL, (site['sitename'], site['geometry'], site.get('updated_at')))
+                num_changed += 1
+
+    return num_changed, newest
+
+
+def _update_changed_sites(connection: sqlite3.Connection, betydb_url: str, since: str) -> tuple:
+    """Updates the geometries of sites already in the plot store that changed in BETYdb since the sync point
+    Arguments:
+        connection: the connection to the plot store
+        betydb_url: the url of the BETYdb instance
+        since: the updated_at value of the sync point
+    Return:
+        A tuple of the number of sites updated and the newest updated_at value seen
+    Exceptions:
+        Exceptions may be thrown by the BETYdb request
+    Notes:
+        Sites that were updated more recently, such as by their experiment's sites, are left alone
+    """
+    sites_url = betydb_client.get_betydb_api_url(betydb_url, 'sites')
+    params = {'updated_at': BETYDB_GREATER_THAN_PREFIX + since, 'limit': 'none'}
+
+    num_changed = 0
+    newest = ''
+    for one_entry in betydb_client.stream_betydb_data(sites_url, params):
+        site = one_entry.get('site', one_entry)
+        if 'geometry' in site and 'sitename' in site and _is_newer(site, since):
+            newest = max(newest, site['updated_at'])
+            num_changed += connection.execute(UPDATE_SITE_SQL, (site['geometry'], site['updated_at'],
+                                                                site['sitename'], site['updated_at'])).rowcount
+
+    return num_changed, newest
+
+
+def sync_plot_store(connection: sqlite3.Connection, betydb_url: str = None, full_sync: bool = False) -> int:
+    """Updates the plot store with the sites that changed in BETYdb since the last sync
+    Arguments:
+        connection: the connection to the plot store
+        betydb_url: the url of the BETYdb instance
+        full_sync: when True the store is emptied and all sites are requested from BETYdb
+    Return:
+        Returns the number of sites that were added or updated
+    Exceptions:
+        A RuntimeError is raised if the needed BETYdb access information is not available.
+        Other exceptions may be thrown by BETYdb requests
+    Notes:
+        The newest updated_at value seen is kept as the sync point, so that BETYdb's clock is used throughout.
+        Only sites belonging to updated experiments, and geometry changes to sites already in the store, are found
+        by a delta sync; sites removed from BETYdb are only removed by a full sync
+    """
+    api_url = betydb_client.get_betydb_api_url(betydb_url, 'experiments')
+    sync_state = dict(connection.execute('SELECT name, value FROM sync_state'))
+    since = sync_state.get('last_updated') if not full_sync and sync_state.get('betydb_url') == api_url else None
+
+    with connection:
+        if since is None:
+            connection.execute('DELETE FROM sites')
+
+        delta_params = {'updated_at': BETYDB_GREATER_THAN_PREFIX + since} if since else None
+        experiments = betydb_client.stream_betydb_experiments(betydb_url, query_params=delta_params)
+        num_changed, newest = _store_experiment_sites(connection, experiments, since)
+
+        # Pick up changed geometries of sites we already have, and haven't just updated
+        if since:
+            num_updated, newest_site = _update_changed_sites(connection, betydb_url, since)
+            num_changed += num_updated
+            newest = max(newest, newest_site, since)
+
+        connection.executemany('INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)',
+                               [('betydb_url', api_url), ('last_updated', newest)])
+
+    return num_changed
+
+
+def iter_store_site_geometries(connection: sqlite3.Connection, site_filter: str = None) -> Iterator[tuple]:
+    """Returns each of the sites in the plot store with its geometry as Well Known Text (WKT)
+    Arguments:
+        connection: the connection to the plot store
+        site_filter: optional filter string to apply on sitenames
+    Return:
+        Returns a tuple of the site name (plot name) and its geometry for each site, in the order they were added
+    """
+    cursor = connection.execute('SELECT sitename, geometry FROM sites WHERE instr(sitename, ?) > 0 ORDER BY rowid',
+                                (site_filter or '',))
+    yield from cursor
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Purpose: Benchmark of the WKT to GeoJSON conversion in betydb2geojson.py
+Notes:
+    Run from the main folder: python3 tests/bench_wkt_conversion.py [number of plots]
+"""
+import json
+import sys
+import timeit
+
+from osgeo import ogr
+
+import betydb2geojson as b2j
+
+# The default number of plots to convert
+DEFAULT_NUM_PLOTS = 10000
+
+# The number of times to repeat each conversion when timing
+NUM_REPEATS = 3
+
+
+def make_sites(num_plots: int) -> dict:
+    """Generates plot geometries similar to the ones returned by BETYdb
+    Arguments:
+        num_plots: the number of plots to generate
+    Return:
+        Returns a dict of plot names and their MULTIPOLYGON WKT
+    """
+    sites = {}
+    for idx in range(num_plots):
+        min_x = -111.975 + (idx % 100) * 0.0000285
+        min_y = 33.074 + (idx // 100) * 0.0000450
+        corners = [(min_x, min_y), (min_x + 0.0000285, min_y), (min_x + 0.0000285, min_y + 0.0000450),
+                   (min_x, min_y + 0.0000450), (min_x, min_y)]
+        sites['MAC Field Scanner Season 10 Range %d Column %d' % (idx // 100, idx % 100)] = \
+            'MULTIPOLYGON (((' + ','.join('%.15f %.15f 353' % one_corner for one_corner in corners) + ')))'
+    return sites
+
+
+def ogr_sites_to_geojson(sites: dict) -> dict:
+    """The OGR based conversion: WKT is loaded by OGR and its exported JSON is parsed
+    Arguments:
+        sites: the dict of site names with their geometries in WKT
+    Return:
+        Returns a dict with the geometries converted into GeoJSON format as a dict
+    """
+    plots_geo = {}
+    for site_name in sites:
+        geom = ogr.CreateGeometryFromWkt(sites[site_name])
+        plots_geo[site_name] = json.loads(geom.ExportToJson())
+    return plots_geo
+
+
+def main() -> None:
+    """Times the conversions and reports the results"""
+    num_plots = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUM_PLOTS
+    sites = make_sites(num_plots)
+
+    ogr_time = min(timeit.repeat(lambda: ogr_sites_to_geojson(sites), number=1, repeat=NUM_REPEATS))
+    fast_time = min(timeit.repeat(lambda: b2j.sites_to_geojson(sites), number=1, repeat=NUM_REPEATS))
+
+    print('Converted %d plots' % num_plots)
+    print('  OGR round trip: %.3f seconds' % ogr_time)
+    print('  direct parser:  %.3f seconds (%.1fx)' % (fast_time, ogr_time / fast_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Purpose: Shared fixtures for the unit tests
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import hashlib
+import http.server
+import json
+import threading
+import urllib.parse
+import pytest
+
+
+class _BetydbHandler(http.server.BaseHTTPRequestHandler):
+    """Serves experiments from the server's "experiments" list, honoring limit and offset"""
+
+    def do_GET(self):   # pylint: disable=invalid-name
+        """Returns the experiments requested"""
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        self.server.requests_seen.append(query)
+        if self.server.fail_next > 0:
+            self.server.fail_next -= 1
+            self.send_error(503)
+            return
+
+        experiments = self.server.experiments
+        if urllib.parse.urlparse(self.path).path.endswith('/sites'):
+            experiments = [one_site for one_exp in experiments for one_site in one_exp['experiment']['sites']]
+        if query.get('limit', ['none'])[0] != 'none':
+            offset = int(query.get('offset', ['0'])[0])
+            experiments = experiments[offset:offset + int(query['limit'][0])]
+        body = json.dumps({'metadata': {}, 'data': experiments}).encode('utf-8')
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):   # pylint: disable=arguments-differ
+        """Keeps the test output quiet"""
+
+
+@pytest.fixture(name='betydb_server')
+def fixture_betydb_server():
+    """Runs a local stand-in for a BETYdb instance with one site per experiment"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _BetydbHandler)
+    server.experiments = [{'experiment': {'sites': [{'site': {'sitename': 'plot %d' % idx,
+                                                              'geometry': 'POLYGON ((%d 0,%d 1,0 1,%d 0))' %
+                                                                          (idx, idx, idx)}}]}}
+                          for idx in range(1, 26)]
+    server.requests_seen = []
+    server.fail_next = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
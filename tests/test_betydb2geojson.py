@@ -65,3 +65,126 @@ def test_command_line():
         file_data = json.load(out_file)
         for key in ['type', 'name', 'features']:
             assert key in file_data
+
+
+def test_raster_cache_versions(tmp_path):
+    """Test that replacing an image used by the options changes the key of the cached GeoJSON"""
+    # pylint: disable=import-outside-toplevel
+    import argparse
+    import betydb2geojson as b2j
+    # pylint: disable=protected-access
+    raster_path = tmp_path / 'ortho.tif'
+    raster_path.write_bytes(b'first image')
+    args = argparse.Namespace(clip_to_raster=[str(raster_path)], match_raster=None)
+    first_versions = b2j._get_raster_versions(args)
+    assert b2j._get_raster_versions(args) == first_versions
+
+    raster_path.write_bytes(b'replaced image')
+    assert b2j._get_raster_versions(args) != first_versions
+    assert not b2j._get_raster_versions(argparse.Namespace(clip_to_raster=None, match_raster=None))
+
+
+def test_wkt_to_geojson():
+    """Test converting WKT to GeoJSON with the direct parser and the OGR fallback"""
+    # pylint: disable=import-outside-toplevel
+    import betydb2geojson as b2j
+    wkts = ['POLYGON ((1 2,3 4.5,5 6,1 2))',
+            'MULTIPOLYGON (((1 2,3 4,1 2)),((5 6,7 8,5 6),(0 0,1 1,0 0)))',
+            'POLYGON Z ((1 2 3,4 5 6,1 2 3))',
+            'POINT (1 2)']
+    assert b2j.wkt_to_geojson_batch(wkts) == [
+        {'type': 'Polygon', 'coordinates': [[[1, 2], [3, 4.5], [5, 6], [1, 2]]]},
+        {'type': 'MultiPolygon', 'coordinates': [[[[1, 2], [3, 4], [1, 2]]],
+                                                 [[[5, 6], [7, 8], [5, 6]], [[0, 0], [1, 1], [0, 0]]]]},
+        {'type': 'Polygon', 'coordinates': [[[1, 2, 3], [4, 5, 6], [1, 2, 3]]]},
+        {'type': 'Point', 'coordinates': [1, 2]}
+    ]
+
+    # Malformed and unsupported geometries are left for OGR
+    for one_wkt in ['POLYGON (((1 2,3 4,1 2)))', 'POLYGON ((1 2,3 4,1 2)) x', 'POLYGON ZM ((1 2 3 4,1 2 3 4))',
+                    'POLYGON EMPTY']:
+        assert b2j.parse_polygonal_wkt(one_wkt) is None
+
+
+def test_write_formats(tmp_path):
+    """Test writing plots as a FeatureCollection and as a GeoJSON text sequence, with compression"""
+    # pylint: disable=import-outside-toplevel
+    import gzip
+    import betydb2geojson as b2j
+    plots = {'plot %d' % idx: {'type': 'Polygon', 'coordinates': [[[idx, 0.5], [idx, 1.5], [0, 1], [idx, 0.5]]]}
+             for idx in range(1, 4)}
+
+    out_path = str(tmp_path / 'plots.json.gz')
+    with b2j.open_output(out_path) as out_file:
+        assert b2j.write_geojson(out_file, plots) == len(plots)
+    with gzip.open(out_path, 'rt', encoding='utf-8') as in_file:
+        features = json.load(in_file)['features']
+    assert [one_feature['properties']['observationUnitName'] for one_feature in features] == list(plots)
+    assert [one_feature['geometry'] for one_feature in features] == list(plots.values())
+
+    out_path = str(tmp_path / 'plots.geojsons')
+    with b2j.open_output(out_path) as out_file:
+        assert b2j.write_geojsonseq(out_file, plots) == len(plots)
+    with open(out_path, 'r', encoding='utf-8') as in_file:
+        records = in_file.read().split('\n')
+    assert records[-1] == ''
+    assert [json.loads(one_record.lstrip('\x1e')) for one_record in records[:-1]] == features
+
+
+def test_reduce_plots():
+    """Test rounding plot coordinates and generating bounding boxes"""
+    # pylint: disable=import-outside-toplevel
+    import io
+    import betydb2geojson as b2j
+    plots = {'plot 1': {'type': 'Polygon', 'coordinates': [[[1.0001, 2.0004, 353.7], [1.0004, 2.0001, 353.7],
+                                                            [3.123456, 4.98765, 354.2], [1.0001, 2.0004, 353.7]]]}}
+
+    stats = {}
+    reduced = dict(b2j.iter_reduced_plots(plots.items(), precision=2, stats=stats))
+    assert reduced == {'plot 1': {'type': 'Polygon', 'coordinates': [[[1.0, 2.0, 353.7], [1.0, 2.0, 353.7],
+                                                                      [3.12, 4.99, 354.2], [1.0, 2.0, 353.7]]]}}
+    assert stats['vertices_before'] == stats['vertices_after'] == 4
+    assert stats['size_after'] < stats['size_before']
+
+    out_file = io.StringIO()
+    b2j.write_geojson(out_file, reduced, with_bbox=True)
+    collection = json.loads(out_file.getvalue())
+    assert collection['features'][0]['bbox'] == [1.0, 2.0, 353.7, 3.12, 4.99, 354.2]
+    assert collection['bbox'] == collection['features'][0]['bbox']
+
+
+def test_reproject_plots():
+    """Test that plot points are transformed in batches and placed back into their geometries"""
+    # pylint: disable=import-outside-toplevel
+    import betydb2geojson as b2j
+
+    class OffsetTransform:  # pylint: disable=too-few-public-methods
+        """Stand-in transformation that counts calls and offsets the points"""
+        num_calls = 0
+
+        def TransformPoints(self, points):  # pylint: disable=invalid-name
+            """Offsets the points"""
+            self.num_calls += 1
+            return [(one_point[0] + 100, one_point[1] + 200, 0) for one_point in points]
+
+    plots = [('plot %d' % idx, {'type': 'MultiPolygon', 'coordinates': [[[[idx, 0], [idx, 1], [0, 1], [idx, 0]]],
+                                                                         [[[idx, 5, 3], [idx, 6, 3], [idx, 5, 3]]]]})
+             for idx in range(1, 6)]
+    transform = OffsetTransform()
+    reprojected = list(b2j.iter_reprojected_plots(plots, transform, batch_size=2))
+
+    assert transform.num_calls == 3
+    assert [one_name for one_name, _ in reprojected] == [one_name for one_name, _ in plots]
+    assert reprojected[2][1] == {'type': 'MultiPolygon',
+                                 'coordinates': [[[[103, 200], [103, 201], [100, 201], [103, 200]]],
+                                                 [[[103, 205, 0], [103, 206, 0], [103, 205, 0]]]]}
+
+    class ShortTransform:  # pylint: disable=too-few-public-methods
+        """Stand-in transformation that loses a point"""
+
+        def TransformPoints(self, points):  # pylint: disable=invalid-name
+            """Returns all but the last point"""
+            return points[:-1]
+
+    with pytest.raises(RuntimeError):
+        list(b2j.iter_reprojected_plots(plots, ShortTransform()))
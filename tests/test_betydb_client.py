@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Purpose: Unit testing for betydb_client.py
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import json
+import os
+import pytest
+
+# The name of the source file to test and it's path
+SOURCE_FILE = 'betydb_client.py'
+SOURCE_PATH = os.path.abspath(os.path.join('.', SOURCE_FILE))
+
+
+def test_exists():
+    """Asserts that the source file is available"""
+    assert os.path.isfile(SOURCE_PATH)
+
+
+def test_stream_json_items():
+    """Test incrementally parsing the items of a JSON array"""
+    # pylint: disable=import-outside-toplevel
+    import betydb_client as bc
+    test_json = {'metadata': {'count': 2, 'data': 'not this one'},
+                 'data': [{'experiment': {'sites': [{'site': {'sitename': 'plot 1',
+                                                              'geometry': 'POLYGON ((1 2,3 4,5 6,1 2))'}}]}},
+                          12345, 'text é'],
+                 'trailer': None}
+    raw_json = json.dumps(test_json, ensure_ascii=False).encode('utf-8')
+
+    # Feed the parser with increasing chunk sizes, including ones that split numbers and multi-byte characters
+    for chunk_size in [1, 2, 7, len(raw_json)]:
+        chunks = [raw_json[idx:idx + chunk_size] for idx in range(0, len(raw_json), chunk_size)]
+        assert list(bc.iter_json_array_items(chunks, 'data')) == test_json['data']
+
+    with pytest.raises(RuntimeError):
+        list(bc.iter_json_array_items([b'{"metadata": {}}'], 'data'))
+
+
+def test_paged_fetch(betydb_server, monkeypatch):
+    """Test fetching experiments in concurrent pages with a retried failure"""
+    # pylint: disable=import-outside-toplevel
+    import betydb_client as bc
+    monkeypatch.setattr(bc, 'PAGE_RETRY_BACKOFF', 0)
+    betydb_server.fail_next = 1
+    url = 'http://127.0.0.1:%d/bety' % betydb_server.server_address[1]
+
+    experiments = list(bc.page_betydb_experiments(url, page_size=4, max_workers=3, retries=2))
+    assert experiments == betydb_server.experiments
+
+
+def test_cached_fetch(betydb_server, tmp_path):
+    """Test that cached responses are reused, and revalidated once they're too old"""
+    # pylint: disable=import-outside-toplevel
+    import betydb_client as bc
+    url = 'http://127.0.0.1:%d/bety/api/v1/experiments' % betydb_server.server_address[1]
+    params = {'associations_mode': 'full_info', 'limit': 'none'}
+    cache_dir = str(tmp_path)
+
+    body_path, first_info = bc.fetch_cached_response(url, params, cache_dir, 60)
+    assert len(betydb_server.requests_seen) == 1
+
+    # A fresh response is used without contacting the server
+    assert bc.fetch_cached_response(url, params, cache_dir, 60) == (body_path, first_info)
+    assert len(betydb_server.requests_seen) == 1
+
+    # A stale response is revalidated and the unchanged body is kept
+    _, second_info = bc.fetch_cached_response(url, params, cache_dir, 0)
+    assert len(betydb_server.requests_seen) == 2
+    assert second_info['digest'] == first_info['digest']
+
+    # A changed response replaces the cached one
+    betydb_server.experiments = betydb_server.experiments[:3]
+    _, third_info = bc.fetch_cached_response(url, params, cache_dir, 0)
+    assert third_info['digest'] != first_info['digest']
+    with open(body_path, 'r', encoding='utf-8') as in_file:
+        assert len(json.load(in_file)['data']) == 3
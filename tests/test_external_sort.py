@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Purpose: Unit testing for external_sort.py
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import os
+
+# The name of the source file to test and it's path
+SOURCE_FILE = 'external_sort.py'
+SOURCE_PATH = os.path.abspath(os.path.join('.', SOURCE_FILE))
+
+
+def test_exists():
+    """Asserts that the source file is available"""
+    assert os.path.isfile(SOURCE_PATH)
+
+
+def test_sort(monkeypatch):
+    """Test sorting in memory and through temporary files, keeping records with the same key in order"""
+    # pylint: disable=import-outside-toplevel
+    import external_sort as es
+    monkeypatch.setattr(es, 'SORT_MERGE_WIDTH', 3)
+    records = [((idx % 7,), b'record %d\n' % idx) for idx in range(100)]
+    expected = [b'header\n'] + [one_record for _, one_record in sorted(records, key=lambda entry: entry[0])]
+
+    for memory_limit in [1024 * 1024, es.SORT_ENTRY_SIZE * 4]:
+        sorter = es.ExternalSorter(memory_limit)
+        sorter.headers = [b'header\n']
+        for key, record in records:
+            sorter.add(key, record)
+        try:
+            assert list(sorter) == expected
+        finally:
+            sorter.close()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Purpose: Unit testing for file_utils.py
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import os
+
+import pytest
+
+
+def test_write_file_atomically(tmp_path):
+    """Test that files are replaced in one step and left alone when writing fails"""
+    # pylint: disable=import-outside-toplevel
+    import file_utils
+    file_path = str(tmp_path / 'out.csv')
+    file_utils.write_file_atomically(file_path, lambda out_file: out_file.write('a,b\r\n1,2\n'))
+    with open(file_path, 'rb') as in_file:
+        assert in_file.read() == b'a,b\r\n1,2\n'
+
+    file_utils.write_file_atomically(file_path, lambda out_file: out_file.write(b'\x00\x01'), 'wb')
+    with open(file_path, 'rb') as in_file:
+        assert in_file.read() == b'\x00\x01'
+
+    def fail_writing(out_file):
+        """Writes part of the file and then fails"""
+        out_file.write('partial')
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        file_utils.write_file_atomically(file_path, fail_writing)
+    with open(file_path, 'rb') as in_file:
+        assert in_file.read() == b'\x00\x01'
+    assert os.listdir(str(tmp_path)) == ['out.csv']
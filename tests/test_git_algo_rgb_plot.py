@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Purpose: Unit testing for git_algo_rgb_plot.py
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+from subprocess import getstatusoutput
+import pytest
+
+# The name of the source file to test and it's path
+SOURCE_FILE = 'git_algo_rgb_plot.py'
+SOURCE_PATH = os.path.abspath(os.path.join('.', SOURCE_FILE))
+
+# The identity used for commits to the test repositories
+GIT_USER_ARGS = ['-c', 'user.name=Test User', '-c', 'user.email=test@example.com']
+
+
+def _git(repo_dir: str, *git_args: str) -> str:
+    """Runs a git command in a test repository and returns its output"""
+    res = subprocess.run(['git'] + GIT_USER_ARGS + ['-C', repo_dir] + list(git_args), check=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    return res.stdout.strip()
+
+
+def _commit_file(work_dir: str, file_name: str, contents: str) -> str:
+    """Commits a file to a test repository and returns the commit's SHA"""
+    with open(os.path.join(work_dir, file_name), 'w', encoding='utf-8') as out_file:
+        out_file.write(contents)
+    _git(work_dir, 'add', file_name)
+    _git(work_dir, 'commit', '--quiet', '-m', 'Update ' + file_name)
+    return _git(work_dir, 'rev-parse', 'HEAD')
+
+
+def _make_repo(tmp_path, name: str) -> tuple:
+    """Makes a working repository and a bare repository it pushes to
+    Return:
+        Returns a tuple of the working folder, the file:// URL of the bare repository, and the first commit
+    """
+    work_dir = str(tmp_path / name)
+    bare_dir = str(tmp_path / (name + '.git'))
+    subprocess.run(['git', 'init', '--quiet', '-b', 'main', work_dir], check=True)
+    commit = _commit_file(work_dir, 'algorithm_rgb.py', 'VALUE = 1\n')
+    subprocess.run(['git', 'clone', '--quiet', '--bare', work_dir, bare_dir], check=True)
+    _git(work_dir, 'remote', 'add', 'origin', bare_dir)
+    return work_dir, 'file://' + bare_dir, commit
+
+
+def _read_file(file_path: str) -> str:
+    """Returns the contents of a text file"""
+    with open(file_path, 'r', encoding='utf-8') as in_file:
+        return in_file.read()
+
+
+def test_exists():
+    """Asserts that the source file is available"""
+    assert os.path.isfile(SOURCE_PATH)
+
+
+def test_usage():
+    """Program prints a "usage" statement when requested"""
+    for flag in ['-h', '--help']:
+        cmd = f'python3 {SOURCE_PATH} {flag}'
+        ret_val, out = getstatusoutput(cmd)
+        assert ret_val == 0
+        assert re.match('usage', out, re.IGNORECASE)
+
+
+def test_use_environment(tmp_path, monkeypatch):
+    """Test that an environment is kept when the algorithm's modules can't be installed, and that they're tried again"""
+    # pylint: disable=import-outside-toplevel
+    import git_algo_rgb_plot as gap
+    monkeypatch.setattr(gap, 'ENV_CACHE_DIR', str(tmp_path / 'env_cache'))
+
+    # Installing the module fails the first time and works the second time
+    install_calls = []
+
+    def install_modules(modules: set, _: str) -> set:
+        install_calls.append(set(modules))
+        return set(modules) if len(install_calls) == 1 else set()
+
+    monkeypatch.setattr(gap, '_install_missing_modules', install_modules)
+    base_requirements = tmp_path / 'requirements.txt'
+    base_requirements.write_text('')
+
+    with gap.use_environment(str(base_requirements), None, {'missing_module'}) as python:
+        env_dir = os.path.dirname(os.path.dirname(python))
+        assert os.path.exists(python)
+        assert os.path.exists(os.path.join(env_dir, gap.ENV_COMPLETE_FILE))
+        assert json.loads(_read_file(os.path.join(env_dir, gap.ENV_RETRY_FILE))) == {'modules': ['missing_module']}
+    marker_path = os.path.join(env_dir, 'marker')
+    with open(marker_path, 'w', encoding='utf-8'):
+        pass
+
+    # The environment isn't created again, and the module is installed into it
+    with gap.use_environment(str(base_requirements), None, {'missing_module'}) as python:
+        assert os.path.dirname(os.path.dirname(python)) == env_dir
+    assert os.path.exists(marker_path)
+    assert install_calls == [{'missing_module'}, {'missing_module'}]
+    assert not os.path.exists(os.path.join(env_dir, gap.ENV_RETRY_FILE))
+
+    with gap.use_environment(str(base_requirements), None, {'missing_module'}):
+        pass
+    assert len(install_calls) == 2
+
+
+def test_find_imports(tmp_path):
+    """Test finding the modules imported by an algorithm and the local files it imports"""
+    # pylint: disable=import-outside-toplevel
+    import git_algo_rgb_plot as gap
+
+    files = {
+        'algorithm_rgb.py': '\n'.join([
+            'from __future__ import annotations',
+            'import os.path',
+            'import numpy as np',
+            'from scipy import ndimage',
+            'try:',
+            '    import cv2',
+            'except ImportError:',
+            '    cv2 = None',
+            'try:',
+            '    from fancy import thing',
+            'except (OSError, ModuleNotFoundError):',
+            '    thing = None',
+            'try:',
+            '    import requests',
+            'except ValueError:',
+            '    pass',
+            'from . import helper',
+            'from .missing import other',
+            'import local_pkg',
+            '',
+        ]),
+        'helper.py': 'import pandas\n',
+        'local_pkg/__init__.py': 'from .sub import value\nimport yaml\n',
+        'local_pkg/sub.py': 'value = 1\n',
+    }
+    for file_name, contents in files.items():
+        file_path = tmp_path / file_name
+        file_path.parent.mkdir(exist_ok=True)
+        file_path.write_text(contents)
+
+    modules = gap.find_imports(str(tmp_path / 'algorithm_rgb.py'))
+    assert modules == {'os', 'numpy', 'scipy', 'requests', 'pandas', 'yaml'}
+
+    # Files that can't be parsed are reported and have no imports
+    (tmp_path / 'helper.py').write_text('import (\n')
+    with pytest.raises(SyntaxError):
+        gap.find_imports(str(tmp_path / 'algorithm_rgb.py'))
+    assert gap.get_algorithm_imports(str(tmp_path / 'algorithm_rgb.py')) == set()
+
+
+def test_run_tasks(caplog):
+    """Test that tasks run after the tasks they depend on, are given their results, and have their timings logged"""
+    # pylint: disable=import-outside-toplevel
+    import git_algo_rgb_plot as gap
+
+    order = []
+    given = {}
+    order_lock = threading.Lock()
+
+    def make_task(name: str, value: int):
+        """Returns a task function that records when it ran and the results it was given"""
+        def run_task(done: dict) -> int:
+            with order_lock:
+                order.append(name)
+                given[name] = done
+            return value
+        return run_task
+
+    caplog.set_level(logging.INFO)
+    results = gap.run_tasks({
+        'last': (make_task('last', 100), ('middle', 'first b')),
+        'middle': (make_task('middle', 10), ('first a',)),
+        'first a': (make_task('first a', 1), ()),
+        'first b': (make_task('first b', 2), ()),
+    })
+    assert order.index('middle') > order.index('first a')
+    assert order.index('last') > max(order.index('middle'), order.index('first b'))
+    assert results == {'first a': 1, 'first b': 2, 'middle': 10, 'last': 100}
+    # Each task is given the results of the tasks that finished before it
+    assert given['middle']['first a'] == 1
+    assert given['last'] == {'first a': 1, 'first b': 2, 'middle': 10}
+    for name in ('first a', 'first b', 'middle', 'last'):
+        assert any(re.match(f'{name}: [0-9.]+ seconds$', one_message) for one_message in caplog.messages)
+    assert any(one_message.startswith('Setup took') for one_message in caplog.messages)
+    assert not gap.run_tasks({})
+
+
+def test_run_tasks_errors():
+    """Test that the first task error is raised again and that bad dependencies are reported"""
+    # pylint: disable=import-outside-toplevel
+    import git_algo_rgb_plot as gap
+
+    ran = []
+
+    def fail(_: dict) -> None:
+        raise ValueError('task failed')
+
+    with pytest.raises(ValueError, match='task failed'):
+        gap.run_tasks({
+            'fail': (fail, ()),
+            'after': (lambda _: ran.append('after'), ('fail',)),
+        })
+    assert not ran
+
+    with pytest.raises(RuntimeError, match='unknown'):
+        gap.run_tasks({
+            'first': (lambda _: ran.append('first'), ()),
+            'second': (lambda _: None, ('first', 'missing')),
+        })
+    assert not ran
+
+    with pytest.raises(RuntimeError, match='depend on each other'):
+        gap.run_tasks({
+            'first': (lambda _: None, ()),
+            'a': (lambda _: None, ('first', 'b')),
+            'b': (lambda _: None, ('a',)),
+        })
+
+
+def test_load_file_list(tmp_path):
+    """Test loading the plot images from a JSON file"""
+    # pylint: disable=import-outside-toplevel
+    import git_algo_rgb_plot as gap
+
+    file_list_path = str(tmp_path / 'files.json')
+    with open(file_list_path, 'w', encoding='utf-8') as out_file:
+        json.dump({'FILE_LIST': [{'FILE': '/input/p1/image.tif', 'DIR': '/input/p1/'},
+                                 {'FILE': '/input/p2/image.tif', 'DIR': '/input/p2/'}]}, out_file)
+    assert gap.load_file_list(file_list_path) == [('/input/p1/image.tif', '/input/p1/'),
+                                                  ('/input/p2/image.tif', '/input/p2/')]
+
+    for bad_contents in ({'FILES': []}, {'FILE_LIST': [{'FILE': '/input/p1/image.tif'}]},
+                         {'FILE_LIST': ['/input/p1/image.tif']}, ['/input/p1/image.tif']):
+        with open(file_list_path, 'w', encoding='utf-8') as out_file:
+            json.dump(bad_contents, out_file)
+        with pytest.raises(RuntimeError):
+            gap.load_file_list(file_list_path)
+
+
+def test_run_batch(tmp_path):
+    """Test that the algorithm is run on each plot image and the failed ones are counted"""
+    # pylint: disable=import-outside-toplevel
+    import git_algo_rgb_plot as gap
+
+    run_file = tmp_path / 'transformer.py'
+    run_file.write_text('\n'.join([
+        'import argparse, os, sys',
+        'parser = argparse.ArgumentParser()',
+        'parser.add_argument("--working_space")',
+        'parser.add_argument("file")',
+        'args = parser.parse_args()',
+        'if "exit" in args.file:',
+        '    sys.exit(3)',
+        'if "raise" in args.file:',
+        '    raise ValueError("bad plot image")',
+        'with open(os.path.join(args.working_space, "result.txt"), "w") as out_file:',
+        '    out_file.write(args.file)',
+        '',
+    ]))
+    file_list = []
+    for one_name in ('plot1', 'plot2', 'exit', 'raise'):
+        (tmp_path / one_name).mkdir()
+        file_list.append((str(tmp_path / one_name / 'image.tif'), str(tmp_path / one_name)))
+
+    assert gap.run_batch(str(run_file), sys.executable, file_list, [], num_jobs=2) == 2
+    for plot_file, plot_dir in file_list:
+        result_path = os.path.join(plot_dir, 'result.txt')
+        if 'plot' in plot_file:
+            assert _read_file(result_path) == plot_file
+        else:
+            assert not os.path.exists(result_path)
+
+
+def test_checkout_repo(tmp_path, monkeypatch):
+    """Test checking out branches, tags, and commits through the cached mirror"""
+    # pylint: disable=import-outside-toplevel
+    import git_algo_rgb_plot as gap
+    monkeypatch.setattr(gap, 'GIT_CACHE_DIR', str(tmp_path / 'cache'))
+
+    work_dir, repo_url, first_commit = _make_repo(tmp_path, 'algo')
+    _git(work_dir, 'tag', 'v1')
+    _git(work_dir, 'push', '--quiet', 'origin', 'v1')
+
+    checkout_dir = str(tmp_path / 'checkout')
+    assert gap.checkout_repo(repo_url, 'main', checkout_dir) == first_commit
+    assert _read_file(os.path.join(checkout_dir, 'algorithm_rgb.py')) == 'VALUE = 1\n'
+    gap.remove_checkout(repo_url, checkout_dir)
+    assert not os.path.exists(checkout_dir)
+
+    # The branch isn't fetched again until the mirror is older than the maximum age
+    second_commit = _commit_file(work_dir, 'algorithm_rgb.py', 'VALUE = 2\n')
+    _git(work_dir, 'push', '--quiet', 'origin', 'main')
+    assert gap.checkout_repo(repo_url, 'main', checkout_dir) == first_commit
+    gap.remove_checkout(repo_url, checkout_dir)
+
+    monkeypatch.setattr(gap, 'GIT_CACHE_MAX_AGE', 0)
+    assert gap.checkout_repo(repo_url, 'main', checkout_dir) == second_commit
+    assert _read_file(os.path.join(checkout_dir, 'algorithm_rgb.py')) == 'VALUE = 2\n'
+    gap.remove_checkout(repo_url, checkout_dir)
+
+    assert gap.checkout_repo(repo_url, 'v1', checkout_dir) == first_commit
+    gap.remove_checkout(repo_url, checkout_dir)
+    assert gap.checkout_repo(repo_url, second_commit, checkout_dir) == second_commit
+    gap.remove_checkout(repo_url, checkout_dir)
+
+    # The removed checkouts aren't left registered with the mirror
+    worktrees = _git(gap._get_mirror_dir(repo_url), 'worktree', 'list')  # pylint: disable=protected-access
+    assert len(worktrees.splitlines()) == 1
+
+    with pytest.raises(RuntimeError):
+        gap.checkout_repo(repo_url, 'no-such-branch', checkout_dir)
+
+
+def test_evict_cache(tmp_path, monkeypatch):
+    """Test that the least recently used mirrors are removed, except for the ones being kept"""
+    # pylint: disable=import-outside-toplevel
+    import git_algo_rgb_plot as gap
+    # pylint: disable=protected-access
+    monkeypatch.setattr(gap, 'GIT_CACHE_DIR', str(tmp_path / 'cache'))
+
+    repo_urls = [_make_repo(tmp_path, one_name)[1] for one_name in ('first', 'second', 'third')]
+    checkout_dir = str(tmp_path / 'checkout')
+    for index, one_url in enumerate(repo_urls):
+        gap.checkout_repo(one_url, 'main', checkout_dir)
+        gap.remove_checkout(one_url, checkout_dir)
+        # Make the first repository the least recently used one
+        mirror_dir = gap._get_mirror_dir(one_url)
+        cache_info = gap._load_cache_info(mirror_dir)
+        cache_info['used'] = index + 1
+        gap._save_cache_info(mirror_dir, cache_info)
+
+    gap.evict_cache(max_size=1000)
+    assert all(os.path.isdir(gap._get_mirror_dir(one_url)) for one_url in repo_urls)
+
+    gap.evict_cache(max_size=0, keep=(repo_urls[0],))
+    assert os.path.isdir(gap._get_mirror_dir(repo_urls[0]))
+    assert not os.path.exists(gap._get_mirror_dir(repo_urls[1]))
+    assert not os.path.exists(gap._get_mirror_dir(repo_urls[2]))
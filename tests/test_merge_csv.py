@@ -8,6 +8,7 @@ import errno
 import os
 import re
 from subprocess import getstatusoutput
+import pytest
 
 # The name of the source file to test and it's path
 SOURCE_FILE = 'merge_csv.py'
@@ -118,3 +119,374 @@ def test_simple():
 
     # Check for any errors
     assert total_found == len(saved_csv)
+
+
+def test_ignore_dirs():
+    """Test matching folders to ignore"""
+    # pylint: disable=import-outside-toplevel
+    import merge_csv as mc
+    assert mc.compile_ignore_dirs([]) is None
+
+    is_ignored_dir = mc.compile_ignore_dirs(['test', 'path/ignore', 'plot_*/tmp', 'bad[0-9]'])
+    for one_path in ['/data/test', '/data/test/1', '/data/path/ignore', '/plot_12/tmp', '/data/bad3/x']:
+        assert is_ignored_dir(one_path)
+    for one_path in ['/data/testing/1', '/data/path/ignored', '/data/ignore', '/plot_12/x/tmp', '/data/bad']:
+        assert not is_ignored_dir(one_path)
+
+
+def test_find_source_files(tmp_path):
+    """Test walking folders, with and without threads"""
+    # pylint: disable=import-outside-toplevel
+    import merge_csv as mc
+    for one_dir in ['a/1', 'a/2', 'b/tmp', 'c']:
+        os.makedirs(tmp_path / one_dir)
+        (tmp_path / one_dir / 'plot.csv').write_text('1,2\n', encoding='utf-8')
+
+    found = list(mc.find_source_files(str(tmp_path), mc.compile_ignore_dirs(['tmp'])))
+    assert sorted(os.path.relpath(one_path, str(tmp_path)) for one_path in found) == \
+        [os.path.join('a', '1', 'plot.csv'), os.path.join('a', '2', 'plot.csv'), os.path.join('c', 'plot.csv')]
+    # Files nearer the top of the tree are found first
+    assert os.path.relpath(found[-1], str(tmp_path)).startswith('a')
+    assert list(mc.find_source_files(str(tmp_path), mc.compile_ignore_dirs(['tmp']), num_threads=3)) == found
+
+
+def _text_merge(source_path: str, target_path: str, skip_lines: int) -> None:
+    """Merges a file line by line in text mode, as merge_csv.py originally did"""
+    with open(target_path, 'a', encoding='utf-8') as out_file:
+        with open(source_path, 'r', encoding='utf-8') as in_file:
+            for one_line in in_file:
+                if skip_lines > 0:
+                    skip_lines -= 1
+                    continue
+                out_file.write(one_line if one_line.endswith('\n') else one_line + '\n')
+
+
+def test_block_copy(tmp_path, monkeypatch):
+    """Test that copying in blocks gives the same result as merging line by line in text mode"""
+    # pylint: disable=import-outside-toplevel
+    import merge_csv as mc
+    sources = ['a,b\n1,2\n3,4\n', 'a,b\r\n1,2\r\n3,4', 'a,b\r1,2\r3,4\r', 'a,b', '', 'a,b\n', '\ufeffa,b\n\n5,6\r\r\n',
+               'a,b\r\n' + '1,2\r\n' * 50 + '\r']
+    # Use small blocks so that headers and line endings are split across blocks
+    monkeypatch.setattr(mc, 'COPY_BLOCK_SIZE', 3)
+    for skip_lines in [0, 1, 2]:
+        expected_path = str(tmp_path / ('expected_%d.csv' % skip_lines))
+        merged_path = str(tmp_path / ('merged_%d.csv' % skip_lines))
+        for idx, one_source in enumerate(sources):
+            source_path = str(tmp_path / ('source_%d.csv' % idx))
+            with open(source_path, 'w', encoding='utf-8', newline='') as out_file:
+                out_file.write(one_source)
+            _text_merge(source_path, expected_path, skip_lines)
+            with open(merged_path, 'ab') as out_file:
+                with open(source_path, 'rb') as in_file:
+                    mc._copy_csv_data(in_file, out_file, skip_lines)  # pylint: disable=protected-access
+
+        with open(expected_path, 'rb') as expected_file, open(merged_path, 'rb') as merged_file:
+            assert merged_file.read() == expected_file.read()
+
+
+def test_destination_pool(tmp_path):
+    """Test merging into more files than are kept open"""
+    # pylint: disable=import-outside-toplevel,protected-access
+    import merge_csv as mc
+    source_path = str(tmp_path / 'source.csv')
+    with open(source_path, 'w', encoding='utf-8') as out_file:
+        out_file.write('name,value\nplot,1\n')
+    (tmp_path / 'dest_0.csv').write_text('name,value\nexisting,0\n', encoding='utf-8')
+
+    with mc._DestinationPool(max_open=2) as pool:
+        for _ in range(3):
+            for idx in range(4):
+                mc._merge_csv(source_path, pool.get(str(tmp_path / ('dest_%d.csv' % idx))))
+                assert len([one_dest for one_dest in pool.destinations.values() if one_dest.file]) <= 2
+
+    assert (tmp_path / 'dest_0.csv').read_text(encoding='utf-8') == 'name,value\nexisting,0\n' + 'plot,1\n' * 3
+    for idx in range(1, 4):
+        assert (tmp_path / ('dest_%d.csv' % idx)).read_text(encoding='utf-8') == 'name,value\n' + 'plot,1\n' * 3
+
+
+def test_parallel_merge(tmp_path):
+    """Test that merging in parallel gives the same files as merging serially"""
+    source_dir = tmp_path / 'source'
+    for plot_idx in range(12):
+        plot_dir = source_dir / ('plot_%d' % plot_idx)
+        os.makedirs(plot_dir)
+        for one_name in ['canopycover.csv', 'greenness.csv', 'rgb_plot.csv']:
+            (plot_dir / one_name).write_text('plot,value\n%d,%s\n' % (plot_idx, one_name), encoding='utf-8')
+
+    for one_dir, flags in [('serial', ''), ('parallel', '--jobs 3')]:
+        os.makedirs(tmp_path / one_dir)
+        ret_val, _ = getstatusoutput(f'{SOURCE_PATH} {flags} {source_dir} {tmp_path / one_dir}')
+        assert ret_val == 0
+
+    for one_name in ['canopycover.csv', 'greenness.csv', 'rgb_plot.csv']:
+        merged = (tmp_path / 'parallel' / one_name).read_text(encoding='utf-8')
+        assert merged == (tmp_path / 'serial' / one_name).read_text(encoding='utf-8')
+        assert merged.count('plot,value\n') == 1
+        assert len(merged.splitlines()) == 13
+
+
+def test_incremental_merge(tmp_path):
+    """Test that merging again only adds new and changed files"""
+    source_dir = tmp_path / 'source'
+    target_dir = tmp_path / 'target'
+    os.makedirs(target_dir)
+    for plot_idx in range(3):
+        os.makedirs(source_dir / ('plot_%d' % plot_idx))
+        (source_dir / ('plot_%d' % plot_idx) / 'plots.csv').write_text('plot\n%d\n' % plot_idx, encoding='utf-8')
+
+    cmd = f'{SOURCE_PATH} --incremental --hash-sources {source_dir} {target_dir}'
+    assert getstatusoutput(cmd)[0] == 0
+    merged = (target_dir / 'plots.csv').read_text(encoding='utf-8')
+    assert sorted(merged.splitlines()) == ['0', '1', '2', 'plot']
+    assert os.path.exists(target_dir / 'plots.csv.manifest.json')
+
+    # Nothing new
+    assert getstatusoutput(cmd)[0] == 0
+    assert (target_dir / 'plots.csv').read_text(encoding='utf-8') == merged
+
+    # A touched file isn't merged again, while new and changed files are
+    os.utime(source_dir / 'plot_0' / 'plots.csv', ns=(1, 1))
+    (source_dir / 'plot_1' / 'plots.csv').write_text('plot\n1\n11\n', encoding='utf-8')
+    os.makedirs(source_dir / 'plot_3')
+    (source_dir / 'plot_3' / 'plots.csv').write_text('plot\n3\n', encoding='utf-8')
+    assert getstatusoutput(cmd)[0] == 0
+    added = (target_dir / 'plots.csv').read_text(encoding='utf-8')[len(merged):]
+    assert sorted(added.splitlines()) == ['1', '11', '3']
+
+
+def test_dedupe(tmp_path):
+    """Test leaving out duplicate rows, both in memory and after switching to the Bloom filter"""
+    # pylint: disable=import-outside-toplevel,protected-access
+    import merge_csv as mc
+    for idx, contents in enumerate(['plot,date,value\n1,d1,0.5\n2,d1,0.7\n', 'date,plot,value\nd1,1,0.5\nd2,1,0.6\n',
+                                    'plot,date,value\n2,d1,0.8\n"3","d1","multi\nline"\n3,d1,"multi\nline"\n']):
+        (tmp_path / ('source_%d.csv' % idx)).write_text(contents, encoding='utf-8')
+
+    for memory_limit in [mc.DEDUPE_MEMORY, mc.DEDUPE_ENTRY_SIZE]:
+        for key_columns, expected in [(None, 'plot,date,value\n1,d1,0.5\n2,d1,0.7\nd1,1,0.5\nd2,1,0.6\n2,d1,0.8\n'
+                                             '"3","d1","multi\nline"\n3,d1,"multi\nline"\n'),
+                                      (['plot', 'date'], 'plot,date,value\n1,d1,0.5\n2,d1,0.7\nd2,1,0.6\n'
+                                                         '"3","d1","multi\nline"\n')]:
+            dest_path = str(tmp_path / 'merged.csv')
+            options = mc._DestinationOptions(dedupe=mc._DedupeOptions(key_columns, memory_limit))
+            if os.path.exists(dest_path):
+                os.unlink(dest_path)
+            with mc._DestinationPool(options=options) as pool:
+                for idx in range(3):
+                    mc._merge_csv(str(tmp_path / ('source_%d.csv' % idx)), pool.get(dest_path))
+            with open(dest_path, 'r', encoding='utf-8') as in_file:
+                assert in_file.read() == expected
+
+            # Merging again doesn't add anything
+            with mc._DestinationPool(options=options) as pool:
+                mc._merge_csv(str(tmp_path / 'source_0.csv'), pool.get(dest_path))
+            with open(dest_path, 'r', encoding='utf-8') as in_file:
+                assert in_file.read() == expected
+
+
+def test_parquet_output(tmp_path):
+    """Test writing Parquet files with the columns of all the source files"""
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    source_dir = tmp_path / 'source'
+    for idx, contents in enumerate(['plot,date,cover\n1,2020-06-01,0.5\n2,2020-06-01,0.25\n',
+                                    'date,plot,cover,flagged\n2020-06-02,1,,true\n',
+                                    'plot,date,cover\n3,2020-06-03,0.75\n']):
+        os.makedirs(source_dir / str(idx))
+        (source_dir / str(idx) / 'canopycover.csv').write_text(contents, encoding='utf-8')
+
+    cmd = f'{SOURCE_PATH} --output-format parquet --row-group-size 2 --column-types plot:string {source_dir} {tmp_path}'
+    ret_val, out = getstatusoutput(cmd)
+    assert ret_val == 0, out
+
+    table = pyarrow_parquet.read_table(str(tmp_path / 'canopycover.parquet'))
+    assert table.column_names == ['plot', 'date', 'cover', 'flagged']
+    assert [str(one_field.type) for one_field in table.schema] == ['string', 'string', 'double', 'string']
+    assert sorted(table.to_pylist(), key=lambda row: (row['date'], row['plot'])) == [
+        {'plot': '1', 'date': '2020-06-01', 'cover': 0.5, 'flagged': None},
+        {'plot': '2', 'date': '2020-06-01', 'cover': 0.25, 'flagged': None},
+        {'plot': '1', 'date': '2020-06-02', 'cover': None, 'flagged': 'true'},
+        {'plot': '3', 'date': '2020-06-03', 'cover': 0.75, 'flagged': None}]
+
+
+def test_parquet_widened_types(tmp_path):
+    """Test that Parquet column types found from the first rows are widened when later values don't fit"""
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    source_dir = tmp_path / 'source'
+    os.makedirs(source_dir)
+    (source_dir / 'plots.csv').write_text('plot,value,flagged\n1,2,yes\n2,3,no\n3,1.5,no\n4,2.5,maybe\n5,x,\n',
+                                          encoding='utf-8')
+
+    ret_val, out = getstatusoutput(f'{SOURCE_PATH} --output-format parquet --row-group-size 2 {source_dir} {tmp_path}')
+    assert ret_val == 0, out
+    table = pyarrow_parquet.read_table(str(tmp_path / 'plots.parquet'))
+    assert [str(one_field.type) for one_field in table.schema] == ['int64', 'string', 'string']
+    assert table.column('plot').to_pylist() == [1, 2, 3, 4, 5]
+    # Values written before a column is widened to a string are converted from their earlier type
+    assert table.column('value').to_pylist() == ['2', '3', '1.5', '2.5', 'x']
+    assert table.column('flagged').to_pylist() == ['true', 'false', 'no', 'maybe', None]
+
+    # Declared types aren't widened, and values that don't fit are reported without a traceback
+    ret_val, out = getstatusoutput(f'{SOURCE_PATH} --output-format parquet --column-types value:int {source_dir} '
+                                   f'{tmp_path}')
+    assert ret_val != 0
+    assert 'Traceback' not in out and 'Column "value"' in out
+
+
+def test_compressed_files(tmp_path):
+    """Test merging compressed source files into compressed merged files"""
+    # pylint: disable=import-outside-toplevel
+    import gzip
+    import merge_csv as mc
+    source_dir = tmp_path / 'source'
+    os.makedirs(source_dir / '1')
+    os.makedirs(source_dir / '2')
+    (source_dir / 'plots.csv').write_bytes(b'plot,value\r\n1,0.5\r\n')
+    with gzip.open(source_dir / '1' / 'plots.csv.gz', 'wb') as out_file:
+        out_file.write(b'plot,value\n2,0.25')
+    compressions = ['gz']
+    if mc.zstandard is not None:
+        compressions.append('zst')
+        with mc.zstandard.open(source_dir / '2' / 'plots.csv.zst', 'wb') as out_file:
+            out_file.write(b'plot,value\n3,0.75\n')
+
+    expected = [b'1,0.5', b'2,0.25'] + ([b'3,0.75'] if mc.zstandard is not None else [])
+    for one_compression in compressions:
+        target_dir = tmp_path / one_compression
+        os.makedirs(target_dir)
+        ret_val, out = getstatusoutput(f'{SOURCE_PATH} --compress {one_compression} {source_dir} {target_dir}')
+        assert ret_val == 0, out
+        assert os.listdir(target_dir) == ['plots.csv.' + one_compression]
+        # pylint: disable=protected-access
+        with mc._open_file(str(target_dir / ('plots.csv.' + one_compression))) as in_file:
+            merged = in_file.read().split(b'\n')
+        assert merged[0] == b'plot,value' and merged[-1] == b''
+        assert sorted(merged[1:-1]) == expected
+
+
+def test_aggregate(tmp_path):
+    """Test calculating summary statistics while merging, including rows from an earlier merge"""
+    # pylint: disable=import-outside-toplevel
+    import csv
+    import statistics
+    source_dir = tmp_path / 'source'
+    values = {'plot_1': [0.5, 0.25, 0.75], 'plot_2': [0.125]}
+    for idx, (plot_name, cover) in enumerate([(name, value) for name, plot_values in values.items()
+                                              for value in plot_values]):
+        os.makedirs(source_dir / str(idx))
+        (source_dir / str(idx) / 'canopycover.csv').write_text('plot,date,cover,greenness\n%s,d%d,%s,NA\n' %
+                                                               (plot_name, idx, cover), encoding='utf-8')
+
+    cmd = f'{SOURCE_PATH} --incremental --aggregate key=plot values=cover,greenness {source_dir} {tmp_path}'
+    assert getstatusoutput(cmd)[0] == 0
+
+    # Add another file and merge again
+    os.makedirs(source_dir / 'new')
+    (source_dir / 'new' / 'canopycover.csv').write_text('date,plot,cover\nd9,plot_2,0.375\n', encoding='utf-8')
+    values['plot_2'].append(0.375)
+    ret_val, out = getstatusoutput(cmd)
+    assert ret_val == 0, out
+
+    with open(tmp_path / 'canopycover_summary.csv', 'r', encoding='utf-8') as in_file:
+        rows = list(csv.DictReader(in_file))
+    assert sorted(one_row['plot'] for one_row in rows) == ['plot_1', 'plot_2']
+    for one_row in rows:
+        plot_values = values[one_row['plot']]
+        assert int(one_row['cover_count']) == len(plot_values)
+        assert float(one_row['cover_mean']) == pytest.approx(statistics.mean(plot_values))
+        assert float(one_row['cover_std']) == pytest.approx(statistics.stdev(plot_values))
+        assert float(one_row['cover_min']) == min(plot_values)
+        assert float(one_row['cover_max']) == max(plot_values)
+        assert one_row['greenness_count'] == '0' and one_row['greenness_mean'] == ''
+
+
+def test_sort_by(tmp_path):
+    """Test sorting the merged rows using a small amount of memory, including rows from an earlier merge"""
+    # pylint: disable=import-outside-toplevel
+    import csv
+    import random
+    source_dir = tmp_path / 'source'
+    rows = []
+    for idx in range(8):
+        os.makedirs(source_dir / str(idx))
+        file_rows = [('plot_%d' % random.randrange(20), str(random.randrange(1000) / 8), 'file_%d' % idx)
+                     for _ in range(250)]
+        rows.extend(file_rows)
+        (source_dir / str(idx) / 'canopycover.csv').write_text(
+            'plot,cover,file\n' + ''.join(','.join(one_row) + '\n' for one_row in file_rows), encoding='utf-8')
+
+    cmd = f'{SOURCE_PATH} --incremental --sort-by plot,cover --sort-memory 0.001 {source_dir} {tmp_path}'
+    ret_val, out = getstatusoutput(cmd)
+    assert ret_val == 0, out
+
+    # Add another file and merge again
+    os.makedirs(source_dir / 'new')
+    (source_dir / 'new' / 'canopycover.csv').write_text('plot,cover,file\nplot_0,-1,new\nplot_5,2.5,new\n',
+                                                        encoding='utf-8')
+    rows.extend([('plot_0', '-1', 'new'), ('plot_5', '2.5', 'new')])
+    ret_val, out = getstatusoutput(cmd)
+    assert ret_val == 0, out
+
+    with open(tmp_path / 'canopycover.csv', 'r', encoding='utf-8') as in_file:
+        merged = list(csv.reader(in_file))
+    assert merged[0] == ['plot', 'cover', 'file']
+    # Numbers are sorted numerically
+    keys = [(one_row[0], float(one_row[1])) for one_row in merged[1:]]
+    assert keys == sorted(keys)
+    assert sorted(tuple(one_row) for one_row in merged[1:]) == sorted(rows)
+
+
+def test_empty_compressed_destination(tmp_path):
+    """Test that a compressed merged file with nothing in it still gets headers on the next merge"""
+    # pylint: disable=import-outside-toplevel
+    import gzip
+    source_dir = tmp_path / 'source'
+    os.makedirs(source_dir / '1')
+    (source_dir / '1' / 'plots.csv').write_bytes(b'')
+    ret_val, out = getstatusoutput(f'{SOURCE_PATH} --compress gz {source_dir} {tmp_path}')
+    assert ret_val == 0, out
+
+    os.makedirs(source_dir / '2')
+    (source_dir / '2' / 'plots.csv').write_bytes(b'plot,value\n1,2\n')
+    ret_val, out = getstatusoutput(f'{SOURCE_PATH} --compress gz {source_dir / "2"} {tmp_path}')
+    assert ret_val == 0, out
+    with gzip.open(tmp_path / 'plots.csv.gz', 'rb') as in_file:
+        assert in_file.read() == b'plot,value\n1,2\n'
+
+
+def test_saved_state(tmp_path):
+    """Test that later merges use the saved summary statistics and row hashes instead of reading the merged file,
+    unless the merged file has changed since they were saved"""
+    # pylint: disable=import-outside-toplevel
+    import csv
+    source_dir = tmp_path / 'source'
+    os.makedirs(source_dir / '1')
+    (source_dir / '1' / 'plots.csv').write_text('plot,cover\np1,1\np1,3\n', encoding='utf-8')
+    cmd = f'{SOURCE_PATH} --dedupe --aggregate key=plot values=cover {source_dir} {tmp_path}'
+    ret_val, out = getstatusoutput(cmd)
+    assert ret_val == 0, out
+    assert os.path.exists(tmp_path / 'plots_summary.state.json') and os.path.exists(tmp_path / 'plots.csv.dedupe')
+
+    def read_summary() -> dict:
+        """Returns the count and mean of each plot in the summary"""
+        with open(tmp_path / 'plots_summary.csv', 'r', encoding='utf-8') as in_file:
+            return {one_row['plot']: (int(one_row['cover_count']), float(one_row['cover_mean']))
+                    for one_row in csv.DictReader(in_file)}
+
+    # Changing the merged file without changing its size shows that it isn't read again
+    (tmp_path / 'plots.csv').write_text('plot,cover\np2,5\np2,7\n', encoding='utf-8')
+    os.makedirs(source_dir / '2')
+    (source_dir / '2' / 'plots.csv').write_text('plot,cover\np1,1\np1,5\n', encoding='utf-8')
+    ret_val, out = getstatusoutput(f'{SOURCE_PATH} --dedupe --aggregate key=plot values=cover {source_dir / "2"} '
+                                   f'{tmp_path}')
+    assert ret_val == 0, out
+    assert read_summary() == {'p1': (3, 3.0)}
+
+    # Once the merged file's size changes, its rows are read again
+    with open(tmp_path / 'plots.csv', 'a', encoding='utf-8') as out_file:
+        out_file.write('p3,2\n')
+    ret_val, out = getstatusoutput(cmd)
+    assert ret_val == 0, out
+    assert read_summary() == {'p2': (2, 6.0), 'p1': (3, 3.0), 'p3': (1, 2.0)}
+    with open(tmp_path / 'plots.csv', 'r', encoding='utf-8') as in_file:
+        assert in_file.read() == 'plot,cover\np2,5\np2,7\np1,5\np3,2\np1,1\np1,3\n'
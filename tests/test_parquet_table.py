@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Purpose: Unit testing for parquet_table.py
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import os
+import pytest
+
+# The name of the source file to test and it's path
+SOURCE_FILE = 'parquet_table.py'
+SOURCE_PATH = os.path.abspath(os.path.join('.', SOURCE_FILE))
+
+
+def test_exists():
+    """Asserts that the source file is available"""
+    assert os.path.isfile(SOURCE_PATH)
+
+
+def test_column_types():
+    """Test finding the column types from the values, and widening them when later values don't fit"""
+    # pylint: disable=import-outside-toplevel
+    import parquet_table as pt
+    assert pt.convert_values(['1', '', '3'], 'int') == [1, None, 3]
+    assert pt.convert_values(['Yes', 'f'], 'bool') == [True, False]
+    with pytest.raises(ValueError):
+        pt.convert_values(['maybe'], 'bool')
+
+    types = pt.ColumnTypes(['plot', 'count', 'cover', 'flagged'], {'plot': 'string'})
+    types.infer([('1', '2'), ('1', '2'), ('0.5', ''), ('true', 'n')])
+    assert types.types == {'plot': 'string', 'count': 'int', 'cover': 'float', 'flagged': 'bool'}
+
+    assert types.widen([('x',), ('2.5',), ('0.25',), ('unknown',)]) == {'count': 'float', 'flagged': 'string'}
+    assert types.types == {'plot': 'string', 'count': 'float', 'cover': 'float', 'flagged': 'string'}
+    assert not types.widen([('y',), ('3',), ('1',), ('t',)])
+
+
+def test_write_table(tmp_path):
+    """Test writing row groups, including widening a column after a row group is written"""
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    # pylint: disable=import-outside-toplevel
+    import parquet_table as pt
+    out_path = str(tmp_path / 'table.parquet')
+    table = pt.ParquetTable(out_path, ['plot', 'value'], row_group_size=2)
+    for one_row in [['1', '5'], ['2', '6'], ['3', '6.5'], ['4', '']]:
+        table.add_row(one_row)
+    table.close()
+
+    assert table.num_rows == 4
+    assert not [one_name for one_name in os.listdir(str(tmp_path)) if one_name.startswith('.merge_')]
+    written = pyarrow_parquet.read_table(out_path)
+    assert written.column('plot').to_pylist() == [1, 2, 3, 4]
+    assert written.column('value').to_pylist() == [5.0, 6.0, 6.5, None]
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Purpose: Unit testing for plot_footprints.py
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import os
+import pytest
+
+# The name of the source file to test and it's path
+SOURCE_FILE = 'plot_footprints.py'
+SOURCE_PATH = os.path.abspath(os.path.join('.', SOURCE_FILE))
+
+
+def test_exists():
+    """Asserts that the source file is available"""
+    assert os.path.isfile(SOURCE_PATH)
+
+
+def test_spatial_filter():
+    """Test finding plots using the spatial index, and filtering plots to a footprint"""
+    # pylint: disable=import-outside-toplevel
+    import plot_footprints as pf
+    plots = {}
+    for idx in range(1000):
+        min_x, min_y = (idx % 40) * 2.0, (idx // 40) * 2.0
+        plots['plot %d' % idx] = {'type': 'Polygon', 'coordinates': [[[min_x, min_y], [min_x + 1, min_y],
+                                                                      [min_x + 1, min_y + 1], [min_x, min_y + 1],
+                                                                      [min_x, min_y]]]}
+    boxes = [pf.get_geometry_bounds(one_geometry) for one_geometry in plots.values()]
+
+    index = pf.STRtree(boxes)
+    for bounds in [(10.5, 10.5, 15.5, 12.5), (0, 0, 100, 100), (1.2, 1.2, 1.8, 1.8), (-10, -10, -5, -5)]:
+        # pylint: disable=protected-access
+        assert index.query(bounds) == [idx for idx, one_box in enumerate(boxes)
+                                       if pf._bounds_intersect(one_box, bounds)]
+
+    footprints = pf.get_footprints((10.5, 10.5, 15.5, 12.5))
+    assert list(pf.filter_plots_to_footprints(plots, footprints)) == \
+           ['plot 205', 'plot 206', 'plot 207', 'plot 245', 'plot 246', 'plot 247']
+    assert list(pf.iter_plots_in_footprints(plots.items(), footprints)) == \
+           list(pf.filter_plots_to_footprints(plots, footprints).items())
+
+
+def test_raster_footprints(tmp_path):
+    """Test getting the footprint of georeferenced images"""
+    # pylint: disable=import-outside-toplevel
+    from osgeo import gdal, osr
+    import plot_footprints as pf
+
+    raster_path = str(tmp_path / 'ortho.tif')
+    raster = gdal.GetDriverByName('GTiff').Create(raster_path, 100, 50, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform((10.0, 0.01, 0, 12.0, 0, -0.01))
+    raster_srs = osr.SpatialReference()
+    raster_srs.ImportFromEPSG(4326)
+    raster.SetProjection(raster_srs.ExportToWkt())
+    raster = None
+
+    footprints = pf.get_footprints((0, 0, 1, 1), [raster_path])
+    assert len(footprints) == 2
+    assert footprints[0].GetEnvelope() == pytest.approx((0, 1, 0, 1))
+    assert footprints[1].GetEnvelope() == pytest.approx((10.0, 11.0, 11.5, 12.0))
+
+    plain_path = str(tmp_path / 'plain.tif')
+    raster = gdal.GetDriverByName('GTiff').Create(plain_path, 10, 10, 1, gdal.GDT_Byte)
+    raster = None
+    with pytest.raises(RuntimeError):
+        pf.get_footprints(raster_paths=[plain_path])
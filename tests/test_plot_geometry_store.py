@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Purpose: Unit testing for plot_geometry_store.py
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import os
+import re
+from subprocess import getstatusoutput
+
+# The name of the source file to test and it's path
+SOURCE_FILE = 'plot_geometry_store.py'
+SOURCE_PATH = os.path.abspath(os.path.join('.', SOURCE_FILE))
+
+
+def test_exists():
+    """Asserts that the source file is available"""
+    assert os.path.isfile(SOURCE_PATH)
+
+
+def test_usage():
+    """Program prints a "usage" statement when requested"""
+    for flag in ['-h', '--help']:
+        cmd = f'{SOURCE_PATH} {flag}'
+        ret_val, out = getstatusoutput(cmd)
+        assert ret_val == 0
+        assert re.match('usage', out, re.IGNORECASE)
+
+
+def test_wkb_round_trip():
+    """Test converting polygons to WKB and back"""
+    # pylint: disable=import-outside-toplevel
+    import plot_geometry_store as pgs
+    polygon = {'type': 'Polygon', 'coordinates': [[[1.5, 2.5], [3.0, 2.5], [3.0, 4.0], [1.5, 2.5]]]}
+    multi_polygon = {'type': 'MultiPolygon', 'coordinates': [[[[0.0, 0.0, 1.0], [1.0, 0.0, 1.0], [1.0, 1.0, 2.0],
+                                                               [0.0, 0.0, 1.0]]],
+                                                             [[[5.0, 5.0, 1.0], [6.0, 5.0, 1.0], [6.0, 6.0, 2.0],
+                                                               [5.0, 5.0, 1.0]]]]}
+    for geometry in [polygon, multi_polygon]:
+        assert pgs.wkb_to_geojson(pgs.geojson_to_wkb(geometry)) == geometry
+
+
+def test_plot_store(tmp_path):
+    """Test writing a plot geometry store and finding plots by name and location"""
+    # pylint: disable=import-outside-toplevel
+    import plot_geometry_store as pgs
+    plots = {}
+    for row in range(30):
+        for col in range(20):
+            plots['plot %d-%d' % (row, col)] = {'type': 'Polygon',
+                                                'coordinates': [[[col, row], [col + 0.9, row], [col + 0.9, row + 0.9],
+                                                                 [col, row + 0.9], [col, row]]]}
+
+    store_path = str(tmp_path / 'plots.pgs')
+    with open(store_path, 'wb') as out_file:
+        assert pgs.write_plot_store(out_file, plots.items(), 'urn:ogc:def:crs:EPSG::32612') == len(plots)
+
+    with pgs.PlotGeometryStore(store_path) as store:
+        assert len(store) == len(plots)
+        assert store.crs_name == 'urn:ogc:def:crs:EPSG::32612'
+        assert {one_plot[0]: one_plot[1] for one_plot in store} == plots
+
+        plot_name, geometry, bounds = store.get_plot(store.find('plot 12-7'))
+        assert plot_name == 'plot 12-7'
+        assert geometry == plots['plot 12-7']
+        assert bounds == (7, 12, 7.9, 12.9)
+        assert store.find('plot 99-99') is None
+
+        query_bounds = (4.95, 10.5, 6.5, 12.2)
+        found = sorted(store.get_plot(idx)[0] for idx in store.query(query_bounds))
+        assert found == sorted('plot %d-%d' % (row, col) for row in range(10, 13) for col in range(5, 7))
+        assert store.query((100, 100, 101, 101)) == []
+
+    empty_path = str(tmp_path / 'empty.pgs')
+    with open(empty_path, 'wb') as out_file:
+        assert pgs.write_plot_store(out_file, []) == 0
+    with pgs.PlotGeometryStore(empty_path) as store:
+        assert len(store) == 0
+        assert store.crs_name is None
+        assert store.find('plot 1') is None
+        assert store.query((0, 0, 1, 1)) == []
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Purpose: Unit testing for plot_store_sync.py
+Notes:
+    This file assumes it's in a subfolder off the main folder
+"""
+import os
+
+# The name of the source file to test and it's path
+SOURCE_FILE = 'plot_store_sync.py'
+SOURCE_PATH = os.path.abspath(os.path.join('.', SOURCE_FILE))
+
+
+def test_exists():
+    """Asserts that the source file is available"""
+    assert os.path.isfile(SOURCE_PATH)
+
+
+def test_plot_store_sync(betydb_server, tmp_path):
+    """Test that a delta sync of the plot store picks up only changed sites"""
+    # pylint: disable=import-outside-toplevel
+    import plot_store_sync as pss
+    url = 'http://127.0.0.1:%d/bety' % betydb_server.server_address[1]
+    for one_exp in betydb_server.experiments:
+        one_exp['experiment']['updated_at'] = '2020-01-01T00:00:00Z'
+        one_exp['experiment']['sites'][0]['site']['updated_at'] = '2020-01-01T00:00:00Z'
+
+    connection = pss.open_plot_store(str(tmp_path / 'plots.sqlite'))
+    assert pss.sync_plot_store(connection, url) == len(betydb_server.experiments)
+
+    # Nothing has changed
+    assert pss.sync_plot_store(connection, url) == 0
+    assert betydb_server.requests_seen[-1]['updated_at'] == ['gt2020-01-01T00:00:00Z']
+
+    # Change one site
+    changed_site = betydb_server.experiments[4]['experiment']['sites'][0]['site']
+    changed_site['geometry'] = 'POLYGON ((0 0,1 1,0 1,0 0))'
+    changed_site['updated_at'] = '2020-02-01T00:00:00Z'
+    assert pss.sync_plot_store(connection, url) == 1
+
+    sites = list(pss.iter_store_site_geometries(connection))
+    assert len(sites) == len(betydb_server.experiments)
+    assert sites[4] == (changed_site['sitename'], changed_site['geometry'])
+    assert list(pss.iter_store_site_geometries(connection, 'plot 2')) == [sites[1]] + sites[19:25]
+    connection.close()